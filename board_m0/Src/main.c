@@ -35,7 +35,7 @@ static void MX_USART1_UART_Init(void);
 
 /// UART interface
 uint8_t header[4];
-uint8_t waiting_for; // 0 -> HEADER , 1-> DATA
+uint8_t waiting_for; // 0 -> HEADER , 1-> DATA, 2-> DROPPED FRAME
 uint8_t *dest;
 
 // PRNG handling
@@ -54,6 +54,41 @@ uint32_t k[(CRYPTO_KEYBYTES/4)*D];
 uint32_t initial_key[4*D];
 uint32_t clen,adlen,mlen;
 
+// Frames packing multiple inputs and operations
+#define FRAME_DEST 8
+#define FRAME_MAX_LEN 1024
+#define FRAME_OK 0
+#define FRAME_ERR_CRC 1
+#define FRAME_ERR_FORMAT 2
+#define FRAME_ERR_LEN 3
+#define FRAME_ERR_BUSY 4
+// Negotiation of the UART configuration
+#define CONFIG_DEST 9
+#define UART_MIN_BAUDRATE 1200
+// A frame is received in one slot while the other one is processed in the
+// main loop. The host waits for the response of a frame before sending the
+// second next one. A frame targeting a slot that is still pending is
+// discarded and answered with FRAME_ERR_BUSY. Likewise, the body of a frame
+// with an invalid length is received and dropped before the error reply.
+uint8_t frame[2][FRAME_MAX_LEN];
+uint32_t frame_len[2];
+volatile uint8_t frame_ready[2];
+uint8_t frame_rx; // slot of the next received frame
+uint8_t frame_out[FRAME_MAX_LEN]; // responses built by the main loop
+volatile uint32_t frames_received;
+uint32_t frames_done;
+// Replies decided in the IRQ (errors, configuration) have their own buffer.
+// They are sent by the main loop after the responses of the frames received
+// before them, and the reception is stalled until then.
+#define REPLY_MAX_LEN 16
+uint8_t reply[REPLY_MAX_LEN];
+volatile uint32_t reply_len; // 0 if no reply is pending
+volatile uint32_t reply_after; // number of frames answered before the reply
+uint32_t reply_baudrate; // baudrate set after the reply
+uint8_t config_req[4];
+uint32_t discard_len; // bytes of a rejected frame still to be received
+uint8_t discard_status; // status replied once the rejected frame is dropped
+
 void SystemClock_Config(void);
 static void simple_refresh(uint32_t *out,uint32_t *in){
     uint32_t r,s;
@@ -74,47 +109,303 @@ void USART1_IRQHandler(void){
     HAL_UART_IRQHandler(&huart1);
 }
 
-void HAL_UART_RxCpltCallback(UART_HandleTypeDef *huart){
-    if(header[0]==5 && waiting_for==1){ // We just received
+/////////////////////////////////
+/////////////// Inputs and operations
+///////////////////////////////
+// returns the buffer of the input dest and its maximum length
+static uint8_t *select_dest(uint8_t field,uint32_t len,uint32_t *max_len){
+    switch(field){
+        case 0:
+            clen = len;
+            *max_len = MAX_LEN+CRYPTO_ABYTES;
+            return c;
+        case 1:
+            adlen = len;
+            *max_len = MAX_LEN;
+            return ad;
+        case 2:
+            mlen = len;
+            *max_len = MAX_LEN;
+            return m;
+        case 3:
+            *max_len = CRYPTO_NPUBBYTES;
+            return npub;
+        case 4:
+            *max_len = 4*4*D;
+            return (uint8_t*) k;
+        case 5:
+            *max_len = 16;
+            return (uint8_t *) seed;
+        case 6:
+            *max_len = 4;
+            return (uint8_t *) &N;
+        case 7:
+            *max_len = 4;
+            return (uint8_t *) &fixed_key;
+        default:
+            *max_len = 0;
+            return NULL;
+    }
+}
+
+// actions once the input dest has been written
+static void field_received(uint8_t field){
+    if(field==5){ // We just received a seed
         for(int i=0;i<4;i++)
             memset(prng_state[i],0,16);
         memcpy(prng_state[0],seed,16);
-    }else if(header[0]==4 && waiting_for==1){ //received a key
+    }else if(field==4){ //received a key
         memcpy(initial_key,k,16*D);
     }
+}
 
-    if(waiting_for == 0){ // received an header
-        unsigned long long len = header[2] + header[3]*256;
-        switch(header[0]){
-            case 0:
-                dest = c;
-                clen = len;
-                break;
-            case 1:
-                dest = ad;
-                adlen = len;
-                break;
-            case 2:
-                dest = m;
-                mlen = len;
-                break;
-            case 3:
-                dest = npub;
-                break;
-            case 4:
-                dest = (uint8_t*) k;
-                break;
-            case 5:
-                dest = (uint8_t *) seed;
-                break;
-            case 6:
-                dest = (uint8_t *) &N;
+// runs N encryptions, the inputs are updated on chip after each of them
+static void run_encrypt(){
+    HAL_GPIO_WritePin(GPIOC, LD3_Pin, GPIO_PIN_RESET);  // LED OF
+    for(int n =0; n<N;n++){
+        init_rng(prng_state[0]);
+        fill_table();
+
+        HAL_GPIO_WritePin(GPIOC, LD4_Pin, GPIO_PIN_RESET); // trig on
+        HAL_GPIO_WritePin(GPIOB, GPIO_PIN_13, GPIO_PIN_SET); // trig on
+        crypto_aead_encrypt(
+                c,&clen,
+                m,mlen,
+                ad,adlen,
+                NULL,npub,k);
+        HAL_GPIO_WritePin(GPIOB, GPIO_PIN_13, GPIO_PIN_RESET); // trig of
+        HAL_GPIO_WritePin(GPIOC, LD4_Pin, GPIO_PIN_RESET); // trig on
+        /// END ENCRYPT
+
+        shadow(prng_state);             // exectute one shadow
+        memcpy(npub,&prng_state[1][0],16); // change the nonce
+        init_rng(prng_state[2]);       // reset prng
+        fill_table();
+
+        if(fixed_key==0){
+            for(int i=0;i<(4*D);i++){
+                k[i] = get_random();
+            }
+        }else{
+            simple_refresh(k,initial_key);
+        }
+    }
+    memcpy(initial_key,k,D*16);
+}
+
+static void run_decrypt(){
+    HAL_GPIO_WritePin(GPIOB, GPIO_PIN_13, GPIO_PIN_SET); // trig on
+    HAL_GPIO_WritePin(GPIOC, LD3_Pin, GPIO_PIN_RESET);  // LED OF
+
+    crypto_aead_decrypt(
+            m,&mlen,NULL,
+            c,clen,
+            ad,adlen,
+            npub,k);
+
+    HAL_GPIO_WritePin(GPIOB, GPIO_PIN_13, GPIO_PIN_RESET); // trig of
+}
+
+/////////////////////////////////
+/////////////// Frames (see interface/protocol.py)
+///////////////////////////////
+static uint32_t crc32(const uint8_t *data,uint32_t len){
+    uint32_t crc = 0xFFFFFFFF;
+    for(uint32_t i=0;i<len;i++){
+        crc ^= data[i];
+        for(int b=0;b<8;b++)
+            crc = (crc>>1) ^ (0xEDB88320 & (-(crc&1)));
+    }
+    return ~crc;
+}
+
+// blocking transmission that does not lock huart1 (HAL_UART_Transmit does)
+// such that the reception can be re-armed by the IRQ meanwhile
+static void uart_send(const uint8_t *data,uint32_t len){
+    for(uint32_t i=0;i<len;i++){
+        while(!(USART1->ISR & USART_ISR_TXE));
+        USART1->TDR = data[i];
+    }
+    while(!(USART1->ISR & USART_ISR_TC));
+}
+
+// writes the response header and CRC around the len bytes at buf[3]
+static uint32_t encode_response(uint8_t *buf,uint8_t status,uint32_t len){
+    buf[0] = status;
+    buf[1] = len&0xFF;
+    buf[2] = len>>8;
+    uint32_t crc = crc32(buf,len+3);
+    memcpy(&buf[len+3],&crc,4);
+    return len+7;
+}
+
+static void send_frame_response(uint8_t status,uint32_t len){
+    uart_send(frame_out,encode_response(frame_out,status,len));
+}
+
+// called from the IRQ, the reception is re-armed by send_reply
+static void queue_reply(uint8_t status,uint32_t len){
+    reply_after = frames_received;
+    reply_len = encode_response(reply,status,len);
+}
+
+// called from the main loop once the previous frames are answered
+static void send_reply(void){
+    uart_send(reply,reply_len);
+    if(reply_baudrate != huart1.Init.BaudRate){
+        huart1.Init.BaudRate = reply_baudrate;
+        if (HAL_UART_Init(&huart1) != HAL_OK)
+        {
+            Error_Handler();
+        }
+    }
+    reply_len = 0;
+    waiting_for = 0;
+    // bytes received during the stall are dropped
+    __HAL_UART_CLEAR_OREFLAG(&huart1);
+    HAL_UART_Receive_IT(&huart1,header,4);
+}
+
+static void process_frame(const uint8_t *frame,uint32_t frame_len){
+    uint32_t crc,pos,out_len,len,max_len,body_len;
+    uint8_t status = FRAME_OK;
+    out_len = 0;
+
+    if(frame_len < 6){
+        send_frame_response(FRAME_ERR_FORMAT,0);
+        return;
+    }
+    body_len = frame_len-4;
+    memcpy(&crc,&frame[body_len],4);
+    if(crc != crc32(frame,body_len)){
+        send_frame_response(FRAME_ERR_CRC,0);
+        return;
+    }
+
+    uint32_t n_records = frame[0] | (frame[1]<<8);
+    pos = 2;
+    for(uint32_t r=0;r<n_records && status==FRAME_OK;r++){
+        if(pos+2 > body_len){
+            status = FRAME_ERR_FORMAT;
+            break;
+        }
+        uint8_t n_fields = frame[pos];
+        uint8_t op = frame[pos+1];
+        pos += 2;
+        for(uint32_t f=0;f<n_fields;f++){
+            if(pos+3 > body_len){
+                status = FRAME_ERR_FORMAT;
                 break;
-            case 7:
-                dest = (uint8_t *) &fixed_key;
+            }
+            uint8_t field = frame[pos];
+            len = frame[pos+1] | (frame[pos+2]<<8);
+            pos += 3;
+            uint8_t *d = select_dest(field,len,&max_len);
+            if(d==NULL || len>max_len || pos+len>body_len){
+                status = FRAME_ERR_FORMAT;
                 break;
-            default:
+            }
+            memcpy(d,&frame[pos],len);
+            pos += len;
+            field_received(field);
+        }
+        if(status != FRAME_OK)
+            break;
+
+        uint8_t *out = NULL;
+        if(op==1){
+            run_encrypt();
+            out = c;
+            len = clen;
+        }else if(op==2){
+            run_decrypt();
+            out = m;
+            len = mlen;
+        }
+        if(out != NULL){
+            if(out_len+len+7 > FRAME_MAX_LEN){
+                status = FRAME_ERR_LEN;
                 break;
+            }
+            memcpy(&frame_out[3+out_len],out,len);
+            out_len += len;
+        }
+    }
+    if(status != FRAME_OK)
+        out_len = 0;
+    send_frame_response(status,out_len);
+}
+
+// answers with the UART configuration, the main loop switches to the
+// requested baudrate after sending the reply with the previous one
+static void process_config(const uint8_t *req,uint32_t req_len){
+    uint32_t baudrate = huart1.Init.BaudRate;
+    uint32_t requested = 0;
+    uint16_t frame_max_len = FRAME_MAX_LEN;
+    uint16_t max_len = MAX_LEN;
+
+    memcpy(&requested,req,req_len);
+    // USART1 is clocked by SYSCLK with 16x oversampling
+    if(requested >= UART_MIN_BAUDRATE && requested <= HAL_RCC_GetSysClockFreq()/16)
+        baudrate = requested;
+
+    memcpy(&reply[3],&baudrate,4);
+    memcpy(&reply[7],&frame_max_len,2);
+    memcpy(&reply[9],&max_len,2);
+    reply[11] = D;
+    reply_baudrate = baudrate;
+    queue_reply(FRAME_OK,9);
+}
+
+/////////////////////////////////
+/////////////// IRQ UART Handling
+///////////////////////////////
+void HAL_UART_RxCpltCallback(UART_HandleTypeDef *huart){
+    uint32_t max_len;
+    if(waiting_for==2){ // dropping the body of a rejected frame
+        if(discard_len > 0){
+            max_len = discard_len > REPLY_MAX_LEN ? REPLY_MAX_LEN : discard_len;
+            discard_len -= max_len;
+            HAL_UART_Receive_IT(&huart1,reply,max_len);
+        }else{
+            queue_reply(discard_status,0);
+        }
+        return;
+    }
+    if(waiting_for==1){ // We just received data
+        field_received(header[0]);
+    }
+
+    if(waiting_for == 0){ // received an header
+        unsigned long long len = header[2] + header[3]*256;
+        reply_baudrate = huart1.Init.BaudRate;
+        if(header[0]==FRAME_DEST || header[0]==CONFIG_DEST){
+            max_len = header[0]==FRAME_DEST ? FRAME_MAX_LEN : 4;
+            // the announced body is dropped such that the next header
+            // is found at the expected position
+            discard_status = FRAME_OK;
+            if(len > max_len)
+                discard_status = FRAME_ERR_LEN;
+            else if(len == 0)
+                discard_status = FRAME_ERR_FORMAT;
+            else if(header[0]==FRAME_DEST && frame_ready[frame_rx])
+                discard_status = FRAME_ERR_BUSY;
+            if(discard_status != FRAME_OK){
+                waiting_for = 2;
+                discard_len = len;
+                HAL_UART_RxCpltCallback(huart);
+                return;
+            }
+            if(header[0]==CONFIG_DEST){
+                dest = config_req;
+            }else{
+                frame_len[frame_rx] = len;
+                dest = frame[frame_rx];
+            }
+        }else{
+            uint8_t *d = select_dest(header[0],len,&max_len);
+            if(d != NULL)
+                dest = d;
         }
         HAL_GPIO_WritePin(GPIOC, LD3_Pin, GPIO_PIN_RESET); // LED ON
         waiting_for = 1; // waiting for data now
@@ -123,55 +414,22 @@ void HAL_UART_RxCpltCallback(UART_HandleTypeDef *huart){
         else
             HAL_UART_Receive_IT(&huart1,header,4);
 
-    }else if(header[1]==1 && waiting_for==1){ // received data and want to encrypt
-        /// ENCRYPT
+    }else if(header[0]==FRAME_DEST){ // received a frame, processed in main
         HAL_GPIO_WritePin(GPIOC, LD3_Pin, GPIO_PIN_RESET);  // LED OF
-        for(int n =0; n<N;n++){
-            init_rng(prng_state[0]);
-            fill_table();
-
-            HAL_GPIO_WritePin(GPIOC, LD4_Pin, GPIO_PIN_RESET); // trig on
-            HAL_GPIO_WritePin(GPIOB, GPIO_PIN_13, GPIO_PIN_SET); // trig on
-            crypto_aead_encrypt(
-                    c,&clen,
-                    m,mlen,
-                    ad,adlen,
-                    NULL,npub,k);
-            HAL_GPIO_WritePin(GPIOB, GPIO_PIN_13, GPIO_PIN_RESET); // trig of
-            HAL_GPIO_WritePin(GPIOC, LD4_Pin, GPIO_PIN_RESET); // trig on
-            /// END ENCRYPT
-            
-            shadow(prng_state);             // exectute one shadow
-            memcpy(npub,&prng_state[1][0],16); // change the nonce
-            init_rng(prng_state[2]);       // reset prng
-            fill_table();
-
-            if(fixed_key==0){
-                for(int i=0;i<(4*D);i++){
-                    k[i] = get_random();
-                }
-            }else{
-                simple_refresh(k,initial_key);
-            }
-        }
-        memcpy(initial_key,k,D*16);
+        frame_ready[frame_rx] = 1;
+        frame_rx ^= 1;
+        frames_received++;
+        waiting_for = 0;
+        HAL_UART_Receive_IT(&huart1,header,4);
+    }else if(header[0]==CONFIG_DEST){ // received a configuration request
+        process_config(config_req,header[2] + header[3]*256);
+    }else if(header[1]==1 && waiting_for==1){ // received data and want to encrypt
+        run_encrypt();
         waiting_for = 0;
         HAL_UART_Transmit(&huart1,c,clen,100);
         HAL_UART_Receive_IT(&huart1,header,4);
     }else if(header[1]==2 && waiting_for==1){ // received data and want to decrypt
-        /// ENCRYPT
-        HAL_GPIO_WritePin(GPIOB, GPIO_PIN_13, GPIO_PIN_SET); // trig on
-        HAL_GPIO_WritePin(GPIOC, LD3_Pin, GPIO_PIN_RESET);  // LED OF
-
-        crypto_aead_decrypt(
-                m,&mlen,NULL,
-                c,clen,
-                ad,adlen,
-                npub,k);
-
-        HAL_GPIO_WritePin(GPIOB, GPIO_PIN_13, GPIO_PIN_RESET); // trig of
-        /// END ENCRYPT
-
+        run_decrypt();
         waiting_for = 0;
         HAL_UART_Transmit(&huart1,m,mlen,100);
         HAL_UART_Receive_IT(&huart1,header,4);
@@ -200,7 +458,17 @@ int main(void)
     HAL_GPIO_WritePin(GPIOB, GPIO_PIN_13, GPIO_PIN_RESET);
 
     HAL_UART_Receive_IT(&huart1,header,4);
+    uint8_t frame_proc = 0;
     while (1){
+        // the next frame can be received while this one is processed
+        if(reply_len != 0 && frames_done == reply_after){
+            send_reply();
+        }else if(frame_ready[frame_proc]){
+            process_frame(frame[frame_proc],frame_len[frame_proc]);
+            frame_ready[frame_proc] = 0;
+            frames_done++;
+            frame_proc ^= 1;
+        }
     }
 }
 
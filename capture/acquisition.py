@@ -0,0 +1,206 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import time
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+class BufferRing:
+    def __init__(self,buffers,wait_release=False):
+        """ Ring of acquisition buffers used in turn by result_acquire.
+
+            The buffers are reused at every lap. CapturePipeline reads out
+            each batch in the next buffer and releases it once the batch is
+            appended to the TraceWriter. The buffers can also be shared
+            memory blocks read by another process (see shared and attach).
+
+            buffers: list of (batch_size,n_samples) C-contiguous int16 arrays.
+                The scope driver writes directly in them.
+            wait_release: if True, next waits until the buffer has been
+                released by the consumer (see release). Otherwise, the traces
+                must be consumed before len(buffers) other batches are
+                acquired, else they are overwritten.
+        """
+        self.buffers = buffers
+        self.index = 0
+        self._shm = []
+        self._free = threading.Semaphore(len(buffers)) if wait_release else None
+
+    @classmethod
+    def shared(cls,n,batch_size,n_samples):
+        """ creates a ring of n buffers in shared memory. Other processes
+            read them without copy with BufferRing.attach(ring.names,...).
+        """
+        shape = (batch_size,n_samples)
+        size = int(np.prod(shape))*np.dtype(np.int16).itemsize
+        shm = [shared_memory.SharedMemory(create=True,size=size) for _ in range(n)]
+        ring = cls([np.ndarray(shape,dtype=np.int16,buffer=x.buf) for x in shm])
+        ring._shm = shm
+        return ring
+
+    @classmethod
+    def attach(cls,names,batch_size,n_samples):
+        """ maps the shared buffers created by another process.
+        """
+        shm = [shared_memory.SharedMemory(name=name) for name in names]
+        ring = cls([np.ndarray((batch_size,n_samples),dtype=np.int16,buffer=x.buf) for x in shm])
+        ring._shm = shm
+        return ring
+
+    @property
+    def names(self):
+        return [x.name for x in self._shm]
+
+    def next(self):
+        """ returns the next buffer of the ring.
+        """
+        if self._free is not None:
+            self._free.acquire()
+        buf = self.buffers[self.index]
+        self.index = (self.index+1)%len(self.buffers)
+        return buf
+
+    def release(self):
+        """ marks the oldest buffer returned by next as consumed.
+        """
+        if self._free is not None:
+            self._free.release()
+
+    def close(self,unlink=False):
+        """ releases the shared memory. The process that created the ring
+            should unlink it.
+        """
+        self.buffers = []
+        for x in self._shm:
+            x.close()
+            if unlink:
+                x.unlink()
+        self._shm = []
+
+class AsyncAcquisition:
+    """ Non-blocking readout of block captures.
+
+        This is mixed in the scope classes (SCAScope and MockScope) which must
+        provide runBlock(pretrig,callback), isReady() and
+        getDataRawBulk(data,fromSegment) as in the picoscope library.
+
+        If ready_callback is set, the driver calls back when the capture is
+        complete (lpReady argument of ps5000aRunBlock) and the readout thread
+        waits on an event. Otherwise (MockScope), the readiness is polled by
+        the readout thread which sleeps between polls. In both cases, the
+        calling thread is free while the scope fills its segments.
+    """
+    ready_callback = False
+    readout_timeout = 60.0 # s, default timeout of the readout
+    min_poll = 0.0005 # s
+    max_poll = 0.02 # s
+
+    def start_acquire(self):
+        self._ready = threading.Event()
+        self._ready_status = 0
+        if self.ready_callback:
+            self.runBlock(pretrig=0,callback=self._block_ready) # no samples before trigger
+        else:
+            self.runBlock(pretrig=0)
+
+    def _block_ready(self,handle,status,param):
+        # called by the driver in its own thread
+        self._ready_status = status
+        self._ready.set()
+
+    def wait_ready(self,timeout=None):
+        """ sleeps until the scope is ready. Returns False if timeout (s)
+            expired. Without ready_callback, the polling period doubles from
+            min_poll up to max_poll.
+        """
+        if self.ready_callback:
+            if not self._ready.wait(timeout):
+                return False
+            if self._ready_status != 0:
+                raise Exception("Block capture failed with status %d"%(self._ready_status))
+            return True
+        t_end = None if timeout is None else time.monotonic()+timeout
+        poll = self.min_poll
+        while not self.isReady():
+            if t_end is not None and time.monotonic() > t_end:
+                return False
+            time.sleep(poll)
+            poll = min(2*poll,self.max_poll)
+        return True
+
+    def set_buffer_ring(self,ring):
+        """ registers a BufferRing (None to remove it). Then, result_acquire
+            without destination returns the next buffer of the ring instead
+            of the same buffer at every call.
+        """
+        if ring is not None:
+            for buf in ring.buffers:
+                self._check_buffer(buf)
+        self._ring = ring
+
+    def _check_buffer(self,dest):
+        # the driver only writes in place in C-contiguous int16 segments
+        if (dest.dtype != np.int16 or not dest.flags["C_CONTIGUOUS"]
+                or dest.shape != (self.noSegments,self.noSamples)):
+            raise ValueError("Acquisition buffers must be C-contiguous (%d,%d) int16 arrays"%(
+                self.noSegments,self.noSamples))
+
+    def result_acquire_async(self,dest=None,callback=None,timeout=None):
+        """ waits for the capture started by start_acquire and downloads the
+            traces in dest in a background thread.
+
+            dest: (batch_size,n_samples) int16 array where the traces are written.
+                If None, the next buffer of the registered BufferRing is used.
+            callback: called with the traces once they are downloaded, in the
+                background thread. Its exceptions are raised by the Future.
+            timeout: maximum wait (s) for the capture, defaults to
+                readout_timeout. The Future raises a TimeoutError after it.
+
+            returns a concurrent.futures.Future resolving to the traces. In
+            asyncio code, it can be awaited with asyncio.wrap_future.
+        """
+        if timeout is None:
+            timeout = self.readout_timeout
+        if dest is None and getattr(self,"_ring",None) is not None:
+            dest = self._ring.next()
+        if dest is not None:
+            self._check_buffer(dest)
+        if getattr(self,"_readout_pool",None) is None:
+            self._readout_pool = ThreadPoolExecutor(max_workers=1)
+        return self._readout_pool.submit(self._readout,dest,timeout,callback)
+
+    def result_acquire(self, dest=None, timeout=None):
+        """Warning: if dest is None and no BufferRing is registered, returns
+        the same buffer at every call."""
+        return self.result_acquire_async(dest,timeout=timeout).result()
+
+    def _readout(self,dest,timeout,callback=None):
+        if not self.wait_ready(timeout):
+            raise TimeoutError("Scope not ready after %g s"%(timeout))
+        # getDataRawBulk returns (data,numSamples,overflow)
+        data = self.getDataRawBulk(data=dest,fromSegment=0)[0]
+        if callback is not None:
+            callback(data)
+        return data
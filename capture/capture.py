@@ -66,6 +66,24 @@ if __name__=="__main__":
             type=int,
             help='Number of cycles to measure'
     )
+    parser.add_argument(
+            '-d',
+            '--shares',
+            default=D,
+            type=int,
+            help='Number of shares of the target'
+    )
+    parser.add_argument(
+            '-t',
+            '--timeout',
+            default=None,
+            type=float,
+            help='Maximum time of a batch (s), defaults to 1 s per encryption'
+    )
+    parser.add_argument('--mock-scope', dest='mock_scope', action='store_true',
+            help='Use a simulated scope instead of the PicoScope')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+            help='Resume an interrupted capture to the same file')
     parser.add_argument('--capture', dest='capture', action='store_true', help='Capture the traces')
     parser.add_argument('--no-capture', dest='capture', action='store_false')
     parser.set_defaults(capture=True)
@@ -78,14 +96,20 @@ if __name__=="__main__":
     n_clk_cycles= args.cycles
     assert N%batch_size == 0
     fixed_key = args.keyfixed
+    D = args.shares
     ###########################################
 
     # Create device
-    dev = SpookTopLevel(target="MCU",PORT="/dev/ttyUSB0")
+    dev = SpookTopLevel(target="MCU",PORT="/dev/ttyUSB0",D=D)
 
     ### Setup up the scope
     if capture:
-        import scope
+        if args.mock_scope:
+            import mock_scope as scope
+            SCAScope = scope.MockScope
+        else:
+            import scope
+            SCAScope = scope.SCAScope
         sample_freq = 500e6
         clk_cycle = 1/48E6
         samples_per_clk_cycle = sample_freq*clk_cycle
@@ -96,16 +120,11 @@ if __name__=="__main__":
         voffset = 0.000
         resolution="12"
         n_samples = int(n_clk_cycles * samples_per_clk_cycle)
-        ps = scope.SCAScope(batch_size=batch_size, n_samples=n_samples,
+        ps = SCAScope(batch_size=batch_size, n_samples=n_samples,
                 sample_freq=sample_freq,resolution=resolution,voffset=voffset,
                 vrange=vrange,delay=int(n_clk_delay*samples_per_clk_cycle))
         Ns = ps.noSamples
 
-        traces = np.zeros((N,Ns),dtype=np.int16)
-    keys = np.zeros((N,4*D),dtype=np.uint32)
-    nonces = np.zeros((N,4),dtype=np.uint32)
-    seeds = np.zeros((N,4),dtype=np.uint32)
-
     # set batch size to the target
     seed = np.random.randint(0,2**32,4,dtype=np.uint32)
     npub = np.random.randint(0,2**32,4,dtype=np.uint32)
@@ -117,6 +136,14 @@ if __name__=="__main__":
     m = np.zeros(1,dtype=np.uint32)
     ad = np.zeros(1,dtype=np.uint32)
 
+    # traces are streamed to fname.part/ and exported to fname at the end
+    n_start = 0
+    if capture:
+        from trace_writer import TraceWriter
+        writer = TraceWriter(fname+".part",N,Ns,D,m,ad,batch_size=batch_size,
+                resume=args.resume)
+        n_start = writer.n_done
+
     # send data to the chip
     dev.set_data(np.array([batch_size],dtype=np.uint32).tobytes(),"N",enc_flag=0)
     dev.set_data(np.array([fixed_key],dtype=np.uint32).tobytes(),"f",enc_flag=0)
@@ -126,27 +153,17 @@ if __name__=="__main__":
     dev.set_data(m.tobytes(),"m",enc_flag=0)
     dev.set_data(ad.tobytes(),"ad",enc_flag=0)
 
-    for i in tqdm(range(0, N, batch_size),desc="recording traces",smoothing=0):
-        if capture:
-            ps.start_acquire()
-
-        #trig encryption on the target
-        enc_cor = dev.set_data(m.tobytes(),"m",enc_flag=1)
-
-        #get input data to the chip, next uses spook_masked.py to generate all intermediate data
-        keys[i:(i+batch_size)],seeds[i:(i+batch_size)],nonces[i:(i+batch_size)] = dev.unroll_inputs(batch_size)
-
-        if capture:
-            ps.result_acquire(traces[i:(i+batch_size),:])
+    # trig encryptions on the target, record the traces and get input data to
+    # the chip (next uses spook_masked.py to generate all intermediate data).
+    # The stages run concurrently (see pipeline.py).
+    from pipeline import CapturePipeline
+    pipeline = CapturePipeline(dev,ps if capture else None,writer if capture else None,
+            batch_size,m,timeout=args.timeout)
+    with tqdm(total=N,initial=n_start,desc="recording traces",smoothing=0) as pbar:
+        pipeline.run(n_start,N,callback=pbar.update)
 
-    um_keys = umask(keys);
     dev.close()
     if capture:
         del scope
-        with open(fname, 'wb') as f:
-            np.savez(f, msk_keys=keys,umsk_keys = um_keys,
-                    seeds=seeds,
-                    nonces=nonces,
-                    m=m,
-                    ad=ad,
-                    traces=traces)
+        writer.to_npz(fname)
+        writer.close(remove=True)
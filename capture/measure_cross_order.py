@@ -59,10 +59,10 @@ for i,d in enumerate(D):
     os.system(" mkdir -p "+DIR_R)
     for j in range(N_profile):
         for _ in range(N_warmup):
-            os.system("python36 capture/capture.py -b 500 -n %d -k 0 -c %d -f tmp.npz"%(Nm_p_w,N_cycles[i]))
+            os.system("python36 capture/capture.py -b 500 -n %d -k 0 -c %d -d %d -f tmp.npz"%(Nm_p_w,N_cycles[i],d))
 
         file_name = DIR_R+"/rkey_D%d_%d.npz"%(d,j)
-        os.system("python36 capture/capture.py -b 500 -n %d -k 0 -c %d -f %s"%(Nm_p,N_cycles[i],file_name))
+        os.system("python36 capture/capture.py -b 500 -n %d -k 0 -c %d -d %d -f %s"%(Nm_p,N_cycles[i],d,file_name))
 
     DIR_F = DIR+"/fixed_key/"
     os.system("mkdir -p "+(DIR_F))
@@ -74,8 +74,8 @@ for i,d in enumerate(D):
         for j in range(N_per_attack):
             file_name = DIR_F_i+"/fkey_D%d_%d.npz"%(d,j)
             for _ in range(N_warmup):
-                os.system("python36 capture/capture.py -b 500 -n %d -k 0 -c %d -f tmp.npz"%(Nm_p_w,N_cycles[i]))
+                os.system("python36 capture/capture.py -b 500 -n %d -k 0 -c %d -d %d -f tmp.npz"%(Nm_p_w,N_cycles[i],d))
 
-            os.system("python36 capture/capture.py -b 500 -n %d -k 1 -c %d -f %s"%(Nm_p,
-                N_cycles[i],file_name))
+            os.system("python36 capture/capture.py -b 500 -n %d -k 1 -c %d -d %d -f %s"%(Nm_p,
+                N_cycles[i],d,file_name))
         os.system("mv secret_key.npz "+DIR_F_i)
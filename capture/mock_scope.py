@@ -0,0 +1,66 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import time
+import numpy as np
+from acquisition import AsyncAcquisition
+
+class MockScope(AsyncAcquisition):
+    def __init__(self,
+            n_samples=1000,
+            batch_size=1,
+            capture_time=0.0, #s
+            **kwargs
+            ):
+        """ Scope without hardware. It has the same interface as SCAScope
+            and returns gaussian noise as traces. It is used to run the
+            capture scripts without a PicoScope.
+
+            n_samples: number of samples per trace
+            batch_size: number of traces per block capture
+            capture_time: time between start_acquire and the scope being ready
+            kwargs: other SCAScope parameters, ignored
+        """
+        self.noSamples = n_samples
+        self.noSegments = batch_size
+        self.capture_time = capture_time
+        self._t_ready = None
+        self._rng = np.random.default_rng()
+        self._data = None
+
+    def runBlock(self,pretrig=0.0,segmentIndex=0):
+        self._t_ready = time.monotonic() + self.capture_time
+
+    def isReady(self):
+        if self._t_ready is None:
+            raise Exception("isReady called before runBlock")
+        return time.monotonic() >= self._t_ready
+
+    def getDataRawBulk(self,data=None,fromSegment=0,**kwargs):
+        if data is None:
+            if self._data is None:
+                self._data = np.zeros((self.noSegments,self.noSamples),dtype=np.int16)
+            data = self._data
+        data[:] = self._rng.normal(0,100,data.shape)
+        self._t_ready = None
+        return (data,self.noSamples,0)
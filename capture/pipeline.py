@@ -0,0 +1,168 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import queue
+import threading
+import numpy as np
+from acquisition import BufferRing
+
+class CapturePipeline:
+    def __init__(self,dev,ps,writer,batch_size,m,depth=2,timeout=None):
+        """ Pipelined acquisition of batches of traces.
+
+            The capture is split in four stages running concurrently and
+            connected by bounded queues:
+                - trigger: arms the scope and triggers a batch of encryptions
+                - readout: waits for the scope and downloads the batch in the
+                  next buffer of a BufferRing of depth+1 buffers
+                - derive: derives the inputs of the batch with dev.unroll_inputs
+                - write: appends complete batches to the writer (calling thread)
+                  and releases their buffers
+            Hence, the inputs of batch i are derived while batch i+1 is
+            captured. The scope is armed again as soon as the previous batch
+            has been downloaded, and the readout waits for a free buffer if
+            the writer lags behind.
+
+            dev: SpookTopLevel already configured for batches of batch_size
+            ps: SCAScope, or None if no traces are recorded
+            writer: TraceWriter, or None if nothing is stored
+            batch_size: number of traces in a batch
+            m: message sent to trigger the batches
+            depth: maximum number of batches waiting in each queue
+            timeout: maximum time (s) of a batch, for the answer of dev and
+                the readout of the scope. Defaults to batch_size times the
+                read timeout of dev, which bounds a single encryption.
+        """
+        self.dev = dev
+        self.ps = ps
+        self.writer = writer
+        self.batch_size = batch_size
+        self.m = m
+        self.depth = depth
+        if timeout is None and dev.timeout is not None:
+            timeout = batch_size*dev.timeout
+        self.timeout = timeout
+
+    def run(self,start,stop,callback=None):
+        """ capture the traces with index in [start,stop). callback(n) is
+            called each time n traces have been written.
+        """
+        if (stop-start)%self.batch_size != 0:
+            raise ValueError("Cannot capture %d traces in batches of %d"%(
+                stop-start,self.batch_size))
+        self._error = None
+        self._scope_free = threading.Semaphore(1)
+        ring = None
+        if self.ps is not None:
+            shape = (self.batch_size,self.ps.noSamples)
+            ring = BufferRing([np.empty(shape,dtype=np.int16) for _ in range(self.depth+1)],
+                    wait_release=True)
+            self.ps.set_buffer_ring(ring)
+        dev_timeout = self.dev.timeout
+        self.dev.timeout = self.timeout
+        try:
+            self._run(start,stop,ring,callback)
+        finally:
+            self.dev.timeout = dev_timeout
+            if ring is not None:
+                self.ps.set_buffer_ring(None)
+
+    def _run(self,start,stop,ring,callback):
+        q_readout = queue.Queue(self.depth)
+        q_derive = queue.Queue(self.depth)
+        q_write = queue.Queue(2*self.depth)
+        batches = range(start,stop,self.batch_size)
+
+        stages = [threading.Thread(target=self._guard,args=(f,)+args,daemon=True)
+                for f,args in ((self._trigger,(batches,q_readout,q_derive)),
+                    (self._readout,(q_readout,q_write)),
+                    (self._derive,(q_derive,q_write)))]
+        for t in stages:
+            t.start()
+
+        # write stage, batches are committed in order
+        traces = {}
+        inputs = {}
+        for i in batches:
+            while not (i in traces and i in inputs):
+                try:
+                    msg = q_write.get(timeout=0.1)
+                except queue.Empty:
+                    if self._error is not None:
+                        raise self._error
+                    continue
+                if msg[0] == "traces":
+                    traces[msg[1]] = msg[2]
+                else:
+                    inputs[msg[1]] = msg[2]
+            keys,seeds,nonces = inputs.pop(i)
+            batch = traces.pop(i)
+            if self.writer is not None:
+                self.writer.append(keys,seeds,nonces,traces=batch)
+            if ring is not None:
+                ring.release()
+            if callback is not None:
+                callback(self.batch_size)
+
+        for t in stages:
+            t.join()
+        if self._error is not None:
+            raise self._error
+
+    def _guard(self,f,*args):
+        try:
+            f(*args)
+        except Exception as e:
+            self._error = e
+
+    def _trigger(self,batches,q_readout,q_derive):
+        for i in batches:
+            self._scope_free.acquire()
+            if self.ps is not None:
+                self.ps.start_acquire()
+            c = self.dev.set_data(self.m.tobytes(),"m",enc_flag=1)
+            if len(c) != len(self.m.tobytes())+16:
+                raise TimeoutError("Traces %d to %d not answered within %s s"%(
+                    i,i+self.batch_size,self.timeout))
+            q_readout.put(i)
+            q_derive.put(i)
+        q_readout.put(None)
+        q_derive.put(None)
+
+    def _readout(self,q_readout,q_write):
+        while True:
+            i = q_readout.get()
+            if i is None:
+                return
+            batch = None
+            if self.ps is not None:
+                batch = self.ps.result_acquire(timeout=self.timeout) # next buffer of the ring
+            self._scope_free.release()
+            q_write.put(("traces",i,batch))
+
+    def _derive(self,q_derive,q_write):
+        while True:
+            i = q_derive.get()
+            if i is None:
+                return
+            q_write.put(("inputs",i,self.dev.unroll_inputs(self.batch_size)))
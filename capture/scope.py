@@ -23,8 +23,12 @@
 
 import numpy as np
 from picoscope import ps5000a
+from acquisition import AsyncAcquisition
+
+class SCAScope(AsyncAcquisition,ps5000a.PS5000a):
+    # the driver signals the end of the captures (see AsyncAcquisition)
+    ready_callback = True
 
-class SCAScope(ps5000a.PS5000a):
     def __init__(self,
             resolution="12", # bits
             vrange=0.10, #V
@@ -77,12 +81,5 @@ class SCAScope(ps5000a.PS5000a):
         print("n_samples: {}".format(n_samples))
         print("resolution: {}".format(self.resolution))
 
-    def start_acquire(self):
-        self.runBlock(pretrig=0) # no samples before trigger
-
-    def result_acquire(self, dest=None):
-        """Warning: returns the same buffer at every call."""
-        self.waitReady() # TODO replace this with non-busy wait and callback
-        # https://docs.python.org/2/library/ctypes.html
-        # https://stackoverflow.com/questions/5114292/break-interrupt-a-time-sleep-in-python/46346184
-        self.getDataRawBulk(data=dest,fromSegment=0)
+    # start_acquire, result_acquire and result_acquire_async are provided
+    # by AsyncAcquisition.
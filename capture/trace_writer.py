@@ -0,0 +1,153 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import json
+import shutil
+import numpy as np
+from interface.utils import umask
+
+class TraceWriter:
+    def __init__(self,path,n_traces,n_samples,D,m,ad,batch_size=1,resume=False):
+        """ Append-only storage of a capture campaign.
+
+            Each field of the .npz trace files (see README.md) is a memory
+            mapped .npy file within the directory path. The traces are written
+            batch by batch and the number of complete traces is stored in
+            meta.json after each batch. Hence, the memory usage does not depend
+            on n_traces and an interrupted capture can be resumed.
+
+            path: directory of the capture
+            n_traces: total number of traces
+            n_samples: number of samples per trace
+            D: number of shares
+            m,ad: message and associated data used for all the traces
+            batch_size: number of traces per batch. A capture can only be
+                resumed with the batch size it has been created with, such
+                that the remaining batches exactly fill the n_traces rows.
+            resume: continue the capture stored in path if any
+        """
+        self.path = path
+        self.n_traces = n_traces
+        self.n_samples = n_samples
+        self.D = D
+        self.batch_size = batch_size
+        self.n_done = 0
+
+        meta = self._load_meta() if resume else None
+        if meta is not None:
+            if (meta["n_traces"],meta["n_samples"],meta["D"]) != (n_traces,n_samples,D):
+                raise ValueError("Cannot resume %s: it has been created with other parameters"%(path))
+            if meta.get("batch_size",batch_size) != batch_size:
+                raise ValueError("Cannot resume %s: it has been created with batch size %d, not %d"%(
+                    path,meta["batch_size"],batch_size))
+            # captures stored without batch_size only need aligned batches
+            if (n_traces-meta["n_done"])%batch_size != 0:
+                raise ValueError("Cannot resume %s: %d remaining traces are not a multiple of the batch size %d"%(
+                    path,n_traces-meta["n_done"],batch_size))
+            self.n_done = meta["n_done"]
+            mode = "r+"
+        else:
+            os.makedirs(path,exist_ok=True)
+            np.save(self._fname("m"),m)
+            np.save(self._fname("ad"),ad)
+            mode = "w+"
+
+        self.traces = self._open("traces",np.int16,(n_traces,n_samples),mode)
+        self.msk_keys = self._open("msk_keys",np.uint32,(n_traces,4*D),mode)
+        self.umsk_keys = self._open("umsk_keys",np.uint32,(n_traces,4),mode)
+        self.seeds = self._open("seeds",np.uint32,(n_traces,4),mode)
+        self.nonces = self._open("nonces",np.uint32,(n_traces,4),mode)
+        self._save_meta()
+
+    def _fname(self,field):
+        return os.path.join(self.path,field+".npy")
+
+    def _open(self,field,dtype,shape,mode):
+        return np.lib.format.open_memmap(self._fname(field),mode=mode,dtype=dtype,shape=shape)
+
+    def _load_meta(self):
+        try:
+            with open(os.path.join(self.path,"meta.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save_meta(self):
+        # write then rename such that meta.json is never partially written
+        meta = {"n_traces":self.n_traces,"n_samples":self.n_samples,
+                "D":self.D,"batch_size":self.batch_size,"n_done":self.n_done}
+        tmp = os.path.join(self.path,"meta.json.tmp")
+        with open(tmp,"w") as f:
+            json.dump(meta,f)
+        os.replace(tmp,os.path.join(self.path,"meta.json"))
+
+    def traces_window(self,n,start=None):
+        """ returns the rows of the traces where the next n traces are
+            stored. The scope can directly write in it.
+
+            start: index of the first trace, defaults to the next one to be
+                committed. It is used to fill batches ahead of append.
+        """
+        if start is None:
+            start = self.n_done
+        return self.traces[start:start+n]
+
+    def append(self,msk_keys,seeds,nonces,traces=None):
+        """ commit the next batch.
+
+            msk_keys,seeds,nonces: inputs of the batch (see SpookTopLevel.unroll_inputs)
+            traces: traces of the batch. If None, the traces must have already
+                been written in traces_window(len(msk_keys)).
+        """
+        n = len(msk_keys)
+        s = slice(self.n_done,self.n_done+n)
+        if traces is not None:
+            self.traces[s] = traces
+        self.msk_keys[s] = msk_keys
+        self.umsk_keys[s] = umask(msk_keys,self.D)
+        self.seeds[s] = seeds
+        self.nonces[s] = nonces
+        for x in (self.traces,self.msk_keys,self.umsk_keys,self.seeds,self.nonces):
+            x.flush()
+        self.n_done += n
+        self._save_meta()
+
+    def to_npz(self,fname):
+        """ export the capture to the .npz format of the data-sets.
+        """
+        with open(fname, 'wb') as f:
+            np.savez(f, msk_keys=self.msk_keys[:self.n_done],
+                    umsk_keys=self.umsk_keys[:self.n_done],
+                    seeds=self.seeds[:self.n_done],
+                    nonces=self.nonces[:self.n_done],
+                    m=np.load(self._fname("m")),
+                    ad=np.load(self._fname("ad")),
+                    traces=self.traces[:self.n_done])
+
+    def close(self,remove=False):
+        """ release the memory maps. If remove, the directory is deleted.
+        """
+        del self.traces,self.msk_keys,self.umsk_keys,self.seeds,self.nonces
+        if remove:
+            shutil.rmtree(self.path)
@@ -23,7 +23,10 @@
 #include "parameters.h"
 #include "utils_masking.h"
 #include "clyde_masked.h"
-#define MAX 256
+#ifndef PRNG_MAX
+#define PRNG_MAX 256
+#endif
+#define MAX PRNG_MAX
 static uint32_t prng_tab[MAX];
 static uint32_t prng_index;
 static shadow_state prng_state_core;
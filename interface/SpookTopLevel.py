@@ -22,17 +22,19 @@
 
 
 import serial, time
+import threading
 from interface.spook import shadow,bytes2state,state2bytes
 import numpy as np
-from tqdm import tqdm
 import os
 from interface.parameters import *
 from interface.utils import *
+from interface.protocol import *
+from interface.firmware import FirmwareModel,unroll_batch
 ########################
 # INTERFACE
 ########################
 class SpookTopLevel:
-    def __init__(self,target,PORT="/dev/ttyUSB0"):
+    def __init__(self,target,PORT="/dev/ttyUSB0",D=D,ser=None,baudrate=None,timeout=1.0,buffer_size=None):
         """ This object allows to interact with Spook v2 modules (MCU or Python3 ones).
 
             It used to trigger encryption/decryption with choosen inputs as well as random ones.
@@ -40,14 +42,30 @@ class SpookTopLevel:
             can be triggered. This is usefull to speed up measurement process by reducing communication
             time.
 
-            target: "MCU","Python"
+            target: "MCU","Python". The Python target emulates the firmware
+                    on the host (see firmware.py), the ciphertexts of the last
+                    batch are then in self.ciphertexts.
             PORT:   serial port for the communication
+            D:      number of shares of the target (defaults to parameters.py)
+            ser:    already configured serial port to use instead of PORT
+                    (e.g. loopback.LoopbackSerial)
+            baudrate: if not None, baudrate negotiated with the MCU (see configure)
+            timeout: read timeout of the serial port (s)
+            buffer_size: size of the serial driver buffers (Windows only)
         """
+        self._target = target
+        self._D = D
+        self._frame_max_len = FRAME_MAX_LEN
         if target == "MCU":
-            self._ser = init_serial(PORT)
+            self._ser = init_serial(PORT,timeout=timeout) if ser is None else ser
             self._ser.open()
+            if buffer_size is not None and hasattr(self._ser,"set_buffer_size"):
+                self._ser.set_buffer_size(rx_size=buffer_size,tx_size=buffer_size)
+            if baudrate is not None:
+                self.configure(baudrate)
+        elif target == "Python":
+            self._firmware = FirmwareModel(D)
 
-        self._target = target
         self._N = 1 #default batchsize is 1
         self._f = 1 #default with fixed key
 
@@ -58,10 +76,7 @@ class SpookTopLevel:
         k: key
         n: nonce
         """
-        self.set_data(ad,dest="ad",enc_flag=0)
-        self.set_data(m,dest="m",enc_flag=0)
-        self.set_data(k,dest="k",enc_flag=0)
-        return self.set_data(n,dest="npub",enc_flag=1)
+        return self.set_fields([("ad",ad),("m",m),("k",k),("npub",n)],enc_flag=1)
 
     def encrypt(self,ad,m,n):
         """ encrypt associated data and plaintext with the preloaded key
@@ -69,9 +84,7 @@ class SpookTopLevel:
         m: message
         n: nonce
         """
-        self.set_data(ad,dest="ad",enc_flag=0)
-        self.set_data(m,dest="m",enc_flag=0)
-        return self.set_data(n,dest="npub",enc_flag=1)
+        return self.set_fields([("ad",ad),("m",m),("npub",n)],enc_flag=1)
 
     def decrypt_key(self,ad,c,k,n):
         """ decrypt associated data and ciphertext
@@ -80,10 +93,7 @@ class SpookTopLevel:
         k: key
         n: nonce
         """
-        self.set_data(ad,dest="ad",enc_flag=0)
-        self.set_data(k,dest="k",enc_flag=0)
-        self.set_data(c,dest="c",enc_flag=0)
-        return self.set_data(n,dest="npub",enc_flag=2)
+        return self.set_fields([("ad",ad),("k",k),("c",c),("npub",n)],enc_flag=2)
 
 
     def decrypt(self,ad,c,n):
@@ -93,55 +103,190 @@ class SpookTopLevel:
         k: key
         n: nonce
         """
-        self.set_data(ad,dest="ad",enc_flag=0)
-        self.set_data(c,dest="c",enc_flag=0)
-        return self.set_data(n,dest="npub",enc_flag=2)
+        return self.set_fields([("ad",ad),("c",c),("npub",n)],enc_flag=2)
 
     def unroll_inputs(self,N):
         """
         This function is used to predict the inputs given to the
         spook module on the MCU for batches of size N.
-        These are derived from a PRNG.
+        These are derived from a PRNG: the chain of PRNG states is computed
+        first, then the keys of the whole batch at once (see firmware.unroll_batch).
+        """
+        k = np.frombuffer(self._k,dtype=np.uint32)
+        key,seeds,nonces,self._prng_state,npub,k = unroll_batch(self._prng_state,
+                np.frombuffer(self._npub,dtype=np.uint32),k,k,self._f,N,self._D)
+        self._npub = npub.tobytes()
+        self._k = k.tobytes()
+        self._seed = self._prng_state[0]
+        return key,seeds,nonces
+
+    def configure(self,baudrate=0):
+        """ switches the MCU and the serial port to baudrate. The size of
+            the frame buffers of the MCU is fetched at the same time.
+
+            baudrate: requested baudrate, 0 to keep the current one
+
+            returns the configuration of the MCU (see protocol.decode_config)
         """
-        nonces = np.zeros((N,4),dtype=np.uint32)
-        key = np.zeros((N,4*D),dtype=np.uint32)
-        seeds = np.zeros((N,4),dtype=np.uint32)
-
-        # set inputs to what was in memory
-        nonces[0,:] = np.frombuffer(self._npub,dtype=np.uint32)
-        key[0,:] = np.frombuffer(self._k,dtype=np.uint32)
-        seeds[0,:] = self._prng_state[0]
-
-        for i in tqdm(range(0,N),desc="Derive inputs"):
-
-            #peform encryption on chip
-            self._prng_state = shadow(self._prng_state)
-            if i != (N-1):
-                if self._f == 1:
-                    simple_refresh(key[i+1,:],
-                            np.frombuffer(self._k,dtype=np.uint32),
-                            self._prng_state[2])
-                else:
-                    key[i+1,:],_ = get_random_tape(self._prng_state[2],D*4)
-
-                seeds[i+1,:] = self._prng_state[0]
-                nonces[i+1,:] = self._prng_state[1][:]
+        self._ser.write(encode_config(baudrate))
+        config = decode_config(read_response(self._ser))
+        if config["D"] != self._D:
+            raise Exception("The MCU uses %d shares, expected %d"%(config["D"],self._D))
+        if baudrate != 0 and config["baudrate"] != baudrate:
+            raise ValueError("The MCU does not support baudrate %d"%(baudrate))
+        if config["baudrate"] != self._ser.baudrate:
+            self._ser.baudrate = config["baudrate"]
+            time.sleep(0.01) # let the MCU restart its UART
+        self._frame_max_len = config["frame_max_len"]
+        return config
+
+    def set_fields(self,fields,enc_flag=0):
+        """ same as calling set_data for each field, but all the fields and
+            the operation are sent to the MCU in a single frame.
+
+            fields: list of (dest,data)
+            enc_flag: operation started once all the fields are written
+        """
+        return self.set_records([(fields,enc_flag)])[0]
+
+    def encrypt_many(self,ads,ms,ks=None,ns=None):
+        """ encrypt many chosen inputs. On the MCU, the inputs are streamed in
+            frames and the ciphertexts of a frame are read back while the next
+            frame is sent.
+
+            ads: associated data of each encryption
+            ms: message of each encryption
+            ks: masked key of each encryption. If None (or for the None entries),
+                the key of the target is used (and updated on chip after each
+                encryption, see unroll_inputs)
+            ns: nonce of each encryption. If None (or for the None entries), the
+                nonce of the target is used (and updated on chip after each
+                encryption)
+
+            returns the list of ciphertexts.
+        """
+        n = len(ms)
+        ads = [_to_bytes(x) for x in ads]
+        ms = [_to_bytes(x) for x in ms]
+        ks = [None]*n if ks is None else [_to_bytes(x) for x in ks]
+        ns = [None]*n if ns is None else [_to_bytes(x) for x in ns]
+
+        if self._target == "Python":
+            self._N = 1
+            out = self._firmware.encrypt_many(ads,ms,ks,ns)
+            self._ad,self._m = ads[-1],ms[-1]
+            if ks[-1] is not None:
+                self._k = ks[-1]
+            if ns[-1] is not None:
+                self._npub = ns[-1]
+            return out
+
+        records = []
+        for ad,m,k,npub in zip(ads,ms,ks,ns):
+            fields = [("ad",ad),("m",m)]
+            if k is not None:
+                fields.append(("k",k))
+            if npub is not None:
+                fields.append(("npub",npub))
+            records.append((fields,1))
+        if self._N != 1:
+            # one encryption per record
+            records[0][0].insert(0,("N",np.array([1],dtype=np.uint32).tobytes()))
+        return self.set_records(records)
+
+    def set_records(self,records,window=FRAME_SLOTS):
+        """ sends the inputs of many operations at once. The records are packed
+            in as few frames as possible (see protocol.py).
+
+            records: list of (fields,enc_flag) as the arguments of set_fields
+            window: maximum number of frames sent to the MCU before reading their
+                response. With 1, nothing is received while the MCU encrypts.
+
+            returns the outputs of each record, None if enc_flag is 0.
+        """
+        if self._target != "MCU":
+            outputs = []
+            for fields,enc_flag in records:
+                for dest,data in fields[:-1]:
+                    self.set_data(data,dest,enc_flag=0)
+                dest,data = fields[-1]
+                outputs.append(self.set_data(data,dest,enc_flag=enc_flag))
+            return outputs
+
+        encoded = []
+        out_lens = []
+        for fields,enc_flag in records:
+            for dest,data in fields:
+                self._store(data,dest)
+            encoded.append(encode_record(fields,enc_flag))
+            if enc_flag == 1:
+                out_lens.append(len(self._m)+16)
+            elif enc_flag == 2:
+                out_lens.append(len(self._c)-16)
             else:
-                self._npub = np.array(self._prng_state[1][:],dtype=np.uint32).tobytes()
-                tmp = np.zeros(4*D,dtype=np.uint32)
-                if self._f == 1:
-                    simple_refresh(tmp,
-                            np.frombuffer(self._k,dtype=np.uint32),
-                            self._prng_state[2])
-                else:
-                    tmp,_ = get_random_tape(self._prng_state[2],D*4)
-
-                self._k = tmp.tobytes()
-                self._seed = self._prng_state[0]
-                self._npub = np.array(self._prng_state[1][:],dtype=np.uint32).tobytes()
+                out_lens.append(0)
+
+        frames = split_records(encoded,out_lens,self._frame_max_len)
+        responses = []
+        errors = []
+        in_flight = threading.Semaphore(window)
+        reader = threading.Thread(target=self._read_responses,
+                args=(frames,responses,errors,in_flight),daemon=True)
+        reader.start()
+        for frame,_ in frames:
+            in_flight.acquire()
+            if not reader.is_alive():
+                break
+            self._ser.write(encode_frame(frame,self._frame_max_len))
+        reader.join()
+        if len(errors) > 0:
+            raise errors[0]
+        if len(responses) != len(frames):
+            raise FrameError("Received %d responses for %d frames"%(len(responses),len(frames)))
+
+        outputs = []
+        i = 0
+        for (frame,out_len),out in zip(frames,responses):
+            if len(out) != out_len:
+                raise FrameError("Expected %d output bytes, received %d"%(out_len,len(out)))
+            pos = 0
+            for l,(_,enc_flag) in zip(out_lens[i:i+len(frame)],records[i:i+len(frame)]):
+                outputs.append(out[pos:pos+l] if enc_flag != 0 else None)
+                pos += l
+            i += len(frame)
+        return outputs
+
+    def _read_responses(self,frames,responses,errors,in_flight):
+        # reads the responses of set_records, a new frame can be sent after each.
+        # Any error stops the reader and is raised by set_records.
+        for _ in frames:
+            try:
+                responses.append(read_response(self._ser))
+            except Exception as e:
+                errors.append(e)
+                return
+            finally:
+                in_flight.release()
 
-        return key,seeds,nonces
     def set_data(self,data,dest,enc_flag):
+        self._store(data,dest)
+
+        if self._target == "MCU":
+            send_data_uart(self._ser,data,enc_flag=enc_flag,dest=dest)
+
+            if enc_flag==1:
+                return self._ser.read(len(self._m)+16)
+            elif enc_flag==2:
+                return self._ser.read(len(self._m))
+        elif self._target == "Python":
+            self._firmware.set_field(dest,data)
+            if enc_flag == 1:
+                return self._firmware.encrypt()
+            elif enc_flag == 2:
+                return self._firmware.decrypt()
+
+    def _store(self,data,dest):
+        # local copy of the inputs of the target
         if dest == "c":
             self._c = data
         elif dest == "ad":
@@ -163,31 +308,57 @@ class SpookTopLevel:
         else:
             print("Does not match dest")
 
+    @property
+    def timeout(self):
+        """ read timeout of the serial port (s), None for the Python target.
+            It bounds the time of an operation, including a whole batch of
+            encryptions triggered by set_data.
+        """
         if self._target == "MCU":
-            send_data_uart(self._ser,data,enc_flag=enc_flag,dest=dest)
+            return self._ser.timeout
+        return None
+
+    @timeout.setter
+    def timeout(self,timeout):
+        if self._target == "MCU":
+            self._ser.timeout = timeout
+
+    @property
+    def ciphertexts(self):
+        """ ciphertexts of all the encryptions of the last batch (Python target).
+        """
+        return self._firmware.ciphertexts
 
-            if enc_flag==1:
-                return self._ser.read(len(self._m)+16)
-            elif enc_flag==2:
-                return self._ser.read(len(self._m))
-        elif self._target == "Python":
-            if enc_flag == 1:
-                return spook.spook_encrypt(ad=self._ad, m=self._m, k=self._k, p=self._p,n=self._n)
-            elif enc_flag == 2:
-                return spook.spook_decrypt(ad=self._ad, c=self._c, k=self._k, p=self._p,n=self._n)
     def close(self):
-        self._ser.close()
+        if self._target == "MCU":
+            if self._ser.baudrate != DEFAULT_BAUDRATE:
+                # such that the next session starts at the default rate
+                try:
+                    self.configure(DEFAULT_BAUDRATE)
+                except FrameError:
+                    pass
+            self._ser.close()
+
+def _to_bytes(x):
+    if x is None or isinstance(x,bytes):
+        return x
+    return np.asarray(x,dtype=np.uint8).tobytes()
+
+def init_serial(PORT="/dev/ttyUSB0",baudrate=DEFAULT_BAUDRATE,timeout=1.0):
+    """ serial port to the MCU, it must be opened afterwards.
 
-def init_serial(PORT="/dev/ttyUSB0"):
+        baudrate: must be the one of the MCU (DEFAULT_BAUDRATE after reset)
+        timeout: read timeout (s)
+    """
     ser = serial.Serial()
     ser.port = PORT
-    ser.baudrate = 115200
+    ser.baudrate = baudrate
     ser.bytesize = serial.EIGHTBITS #number of bits per bytes
     ser.parity = serial.PARITY_NONE #set parity check: no parity
     ser.stopbits = serial.STOPBITS_ONE #number of stop bits
     # ser.timeout = 0               #non-block read
     ser.xonxoff = False             #disable software flow control
-    ser.timeout = True              #block read
+    ser.timeout = timeout           #block read
     ser.rtscts = False              #disable hardware (RTS/CTS) flow control
     ser.dsrdtr = False              #disable hardware (DSR/DTR) flow control
     return ser
@@ -200,30 +371,7 @@ def send_data_uart(ser,data,enc_flag=1,dest="m"):
         enc_flag: ask to start encryption
         dest: "m"|"ad"|"k"|"npub"|"c"|"N"|"f"|"s"
     """
-    stream = np.zeros(4).astype(np.uint8)
-
-    if dest == "c":
-        stream[0] = 0
-    elif dest == "ad":
-        stream[0] = 1
-    elif dest == "m":
-        stream[0] = 2
-    elif dest == "npub":
-        stream[0] = 3
-    elif dest == "k":
-        stream[0] = 4
-    elif dest == "s":
-        stream[0] = 5
-    elif dest == "N":
-        stream[0] = 6
-    elif dest == "f":
-        stream[0] = 7
-    else:
+    if dest not in DEST_CODES:
         print("Does not match dest")
-
-    stream[1] = enc_flag
-    stream[2] = len(data)%256
-    stream[3] = len(data)//256
-
-    header= np.ndarray.tobytes(stream)
+    header = encode_header(DEST_CODES.get(dest,0),enc_flag,len(data))
     ser.write(header+data)
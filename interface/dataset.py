@@ -0,0 +1,308 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+Lazy access to the data-sets (see README.md for the file format).
+
+A data-set is a directory of capture files. Each file is either a .npz file
+or a directory of .npy files (one per field) as written by TraceWriter or by
+Dataset.convert. The files are indexed once when the Dataset is opened: only
+the headers of the arrays are read. The fields with one row per trace are
+exposed as columns of n_total rows which are read from disk when sliced:
+
+    ds = Dataset("d8/random_key/")
+    traces = ds["traces"][1000:30000,200:400] # spans 3 files
+    for batch in ds.batches(10000,["traces","nonces"]):
+        ...
+
+The members of uncompressed .npz files (np.savez) and the .npy files are
+memory mapped. The members of compressed .npz files (np.savez_compressed)
+cannot be mapped, they are decompressed when accessed and the last one of
+each field is kept in memory. Dataset.convert writes the data-set once in
+the mappable layout.
+"""
+
+import os
+import json
+import zipfile
+import numpy as np
+
+def _npy_header(f):
+    """ reads the header of the .npy file f. Returns (shape,fortran_order,dtype).
+        f is positioned at the beginning of the data afterwards.
+    """
+    version = np.lib.format.read_magic(f)
+    if version == (1,0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+class _Member:
+    """ one array within a capture file, mapped or loaded when first read.
+    """
+    def __init__(self,fname,shape,order,dtype,offset=None,member=None):
+        self.fname = fname
+        self.shape = shape
+        self.order = order
+        self.dtype = dtype
+        self.offset = offset
+        self.member = member
+        self._array = None
+
+    def array(self):
+        if self._array is not None:
+            return self._array
+        if self.offset is None:
+            # compressed member
+            with np.load(self.fname) as f:
+                return f[self.member]
+        if np.prod(self.shape) == 0:
+            self._array = np.zeros(self.shape,dtype=self.dtype)
+        else:
+            self._array = np.memmap(self.fname,dtype=self.dtype,mode="r",
+                    offset=self.offset,shape=self.shape,order=self.order)
+        return self._array
+
+    @property
+    def mapped(self):
+        return self.offset is not None
+
+def _index_npz(fname):
+    members = {}
+    with zipfile.ZipFile(fname) as z, open(fname,"rb") as raw:
+        for info in z.infolist():
+            field = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+            with z.open(info) as f:
+                shape,order,dtype = _npy_header(f)
+            offset = None
+            if info.compress_type == zipfile.ZIP_STORED:
+                # local header: 30 bytes, file name and extra field of its own
+                raw.seek(info.header_offset+26)
+                name_len,extra_len = np.frombuffer(raw.read(4),dtype="<u2")
+                raw.seek(info.header_offset+30+int(name_len)+int(extra_len))
+                _npy_header(raw)
+                offset = raw.tell()
+            members[field] = _Member(fname,shape,"F" if order else "C",dtype,
+                    offset=offset,member=field)
+    return members
+
+def _index_dir(path):
+    members = {}
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(".npy"):
+            continue
+        fname = os.path.join(path,name)
+        with open(fname,"rb") as f:
+            shape,order,dtype = _npy_header(f)
+            offset = f.tell()
+        members[name[:-4]] = _Member(fname,shape,"F" if order else "C",dtype,offset=offset)
+    return members
+
+def _n_rows(path,members):
+    """ number of traces in a capture file.
+    """
+    try:
+        # capture in progress (see TraceWriter)
+        with open(os.path.join(path,"meta.json")) as f:
+            return json.load(f)["n_done"]
+    except (FileNotFoundError,NotADirectoryError):
+        pass
+    for field in ("nonces","traces","seeds"):
+        if field in members:
+            return members[field].shape[0]
+    raise ValueError("Cannot find the number of traces of %s"%(path))
+
+class Column:
+    """ virtual (n_total,...) array made of the rows of a field in all the
+        files of a Dataset. Indexing reads only the requested rows.
+    """
+    def __init__(self,ds,field):
+        self.ds = ds
+        self.field = field
+        first = ds.files[0][field]
+        self.shape = (ds.n_total,)+tuple(first.shape[1:])
+        self.dtype = first.dtype
+        self._last = (None,None)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self,dtype=None,copy=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+    def __getitem__(self,key):
+        if not isinstance(key,tuple):
+            key = (key,)
+        rows,rest = key[0],key[1:]
+        scalar = np.ndim(rows) == 0 and not isinstance(rows,slice)
+        if isinstance(rows,slice):
+            start,stop,step = rows.indices(self.shape[0])
+            if step == 1:
+                return self._read_range(start,max(start,stop),rest)
+            rows = np.arange(start,stop,step)
+        idx = np.arange(self.shape[0])[rows].reshape(-1)
+        out = self._read_index(idx,rest)
+        return out[0] if scalar else out
+
+    def _part(self,f):
+        # rows of the field in the f-th file
+        member = self.ds.files[f][self.field]
+        if member.mapped:
+            return member.array()
+        if self._last[0] != f:
+            self._last = (None,None)
+            self._last = (f,member.array())
+        return self._last[1]
+
+    def _read_range(self,start,stop,rest):
+        parts = []
+        f = max(0,np.searchsorted(self.ds.offsets,start,side="right")-1)
+        while start < stop:
+            end = min(stop,self.ds.offsets[f+1])
+            lo = start-self.ds.offsets[f]
+            parts.append(self._part(f)[(slice(lo,lo+end-start),)+rest])
+            start = end
+            f += 1
+        return self._concat(parts,rest)
+
+    def _read_index(self,idx,rest):
+        files = np.searchsorted(self.ds.offsets,idx,side="right")-1
+        parts = []
+        for f in np.unique(files):
+            sel = np.nonzero(files == f)[0]
+            local = idx[sel]-self.ds.offsets[f]
+            parts.append((sel,self._part(f)[(local,)+rest]))
+        if len(parts) == 0:
+            return self._concat([],rest)
+        out = np.empty((len(idx),)+parts[0][1].shape[1:],dtype=self.dtype)
+        for sel,x in parts:
+            out[sel] = x
+        return out
+
+    def _concat(self,parts,rest):
+        if len(parts) == 0:
+            empty = np.zeros((0,)+self.shape[1:],dtype=self.dtype)
+            return empty[(slice(None),)+rest]
+        if len(parts) == 1:
+            return np.asarray(parts[0])
+        return np.concatenate(parts)
+
+class Dataset:
+    def __init__(self,path,pattern=".npz"):
+        """ Capture files of a data-set.
+
+            path: directory of the data-set, or list of capture files
+            pattern: extension of the capture files. The directories in path
+                are capture files as well.
+
+            files: list of dictionaries (one per file) mapping each field to
+                its array description
+            offsets: index of the first trace of each file, followed by n_total
+            fields: fields with one row per trace, shared by all the files
+        """
+        if isinstance(path,str):
+            fnames = [os.path.join(path,x) for x in sorted(os.listdir(path))]
+            fnames = [x for x in fnames if x.endswith(pattern) or os.path.isdir(x)]
+        else:
+            fnames = list(path)
+        if len(fnames) == 0:
+            raise ValueError("No capture file in %s"%(path))
+
+        self.fnames = fnames
+        self.files = [_index_dir(x) if os.path.isdir(x) else _index_npz(x) for x in fnames]
+        n_rows = [_n_rows(x,m) for x,m in zip(fnames,self.files)]
+        self.offsets = np.concatenate(([0],np.cumsum(n_rows))).astype(np.int64)
+        self.n_total = int(self.offsets[-1])
+
+        # per trace fields have at least as many rows as traces in every file
+        self.fields = [k for k,v in self.files[0].items()
+                if len(v.shape) > 0 and v.shape[0] >= n_rows[0]]
+        for m,n in zip(self.files,n_rows):
+            self.fields = [k for k in self.fields if k in m and len(m[k].shape) > 0
+                    and m[k].shape[0] >= n and m[k].shape[1:] == self.files[0][k].shape[1:]]
+        self._columns = {}
+
+    def __len__(self):
+        return self.n_total
+
+    def __getitem__(self,field):
+        if field not in self.fields:
+            raise KeyError("%s is not a per trace field (%s)"%(field,",".join(self.fields)))
+        if field not in self._columns:
+            self._columns[field] = Column(self,field)
+        return self._columns[field]
+
+    @property
+    def mapped(self):
+        """ True if all the fields of all the files are memory mapped.
+        """
+        return all(v.mapped for m in self.files for v in m.values())
+
+    @property
+    def D(self):
+        return self["msk_keys"].shape[1]//4
+
+    def load(self,i,field):
+        """ returns the field of the i-th file (e.g., m or ad).
+        """
+        return np.asarray(self.files[i][field].array())
+
+    def batches(self,batch_size,fields,start=0,stop=None):
+        """ iterates over the traces in [start,stop) by batches of batch_size
+            rows. Yields dictionaries mapping each field to its rows.
+        """
+        stop = self.n_total if stop is None else stop
+        for i in range(start,stop,batch_size):
+            j = min(i+batch_size,stop)
+            yield {field:self[field][i:j] for field in fields}
+
+    def convert(self,out_dir):
+        """ writes each file of the data-set in out_dir as a directory of .npy
+            files which are memory mapped. The files already converted are
+            skipped such that the conversion is done once. The meta.json of
+            TraceWriter marks a completed file.
+
+            returns the Dataset in out_dir.
+        """
+        os.makedirs(out_dir,exist_ok=True)
+        paths = []
+        for i,(fname,members) in enumerate(zip(self.fnames,self.files)):
+            name = os.path.splitext(os.path.basename(fname.rstrip(os.sep)))[0]
+            path = os.path.join(out_dir,name)
+            paths.append(path)
+            if os.path.exists(os.path.join(path,"meta.json")):
+                continue
+            os.makedirs(path,exist_ok=True)
+            n = int(self.offsets[i+1]-self.offsets[i])
+            for field,member in members.items():
+                x = member.array()
+                if field in self.fields:
+                    x = x[:n]
+                np.save(os.path.join(path,field+".npy"),x)
+            meta = {"n_traces":n,"n_done":n,
+                    "n_samples":members["traces"].shape[1] if "traces" in members else 0,
+                    "D":members["msk_keys"].shape[1]//4 if "msk_keys" in members else 0}
+            with open(os.path.join(path,"meta.json"),"w") as f:
+                json.dump(meta,f)
+        return Dataset(paths)
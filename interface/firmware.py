@@ -0,0 +1,233 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Model of the firmware of board_m0/Src/main.c running on the host.
+
+FirmwareModel holds the memory of the MCU (the inputs written through the
+UART, the PRNG state and the initial key) and runs the same operations:
+    - encryption of a batch of N inputs. After each encryption, the PRNG
+      state goes through shadow, the nonce becomes its second LS state and the
+      masked key is either drawn at random (f=0) or refreshed from the initial
+      key (f=1) with the PRNG seeded by its third LS state.
+    - decryption with the current inputs.
+The ciphertexts are computed with the batched Spook of spook.py such that
+large batches are encrypted at once. This is the backend of
+SpookTopLevel(target="Python") and of loopback.LoopbackSerial.
+"""
+
+import struct
+import numpy as np
+from interface import spook
+from interface.parameters import *
+from interface.utils import random_tape,simple_refresh,umask
+
+def shadow_state(x):
+    """ shadow on the (4,4) uint32 state of the PRNG of the firmware.
+    """
+    return shadow_chain(x,1)[1]
+
+def shadow_chain(x,N):
+    """ applies shadow N times in a row on the (4,4) state x of the PRNG.
+
+        returns the (N+1,4,4) array of the successive states, starting with x.
+    """
+    states = np.zeros((N+1,4,4),dtype=np.uint32)
+    states[0] = x
+    p = spook.pack_state(states[0])
+    packed = [p]
+    for _ in range(N):
+        p = spook.shadow_packed(p)
+        packed.append(p)
+    # all the states are unpacked at once: row r of LS state i is in lane i
+    # of the r-th packed integer
+    lanes = np.array(packed,dtype=object).reshape(N+1,4,1) >> np.arange(0,128,32).reshape(1,1,4)
+    states[:] = np.array(lanes & 0xFFFFFFFF,dtype=np.uint32).transpose(0,2,1)
+    return states
+
+def refresh_keys(initial_key,seeds,fixed_key,D=D):
+    """ masked keys written by the firmware after reseeding its PRNG with
+        each of the seeds.
+
+        initial_key: (4*D,) masked key refreshed if fixed_key
+        seeds: (n,4) PRNG seeds
+        fixed_key: 0 for random keys, 1 for simple_refresh of initial_key
+
+        returns a (n,4*D) array.
+    """
+    if fixed_key == 0:
+        return random_tape(seeds.T,4*D).T.copy()
+    keys = np.zeros((len(seeds),4*D),dtype=np.uint32)
+    simple_refresh(keys,initial_key,seeds,D)
+    return keys
+
+def unroll_batch(prng_state,npub,k,initial_key,fixed_key,N,D=D):
+    """ inputs of a batch of N encryptions on the MCU. The chain of PRNG
+        states is derived first, then the keys of all the encryptions are
+        derived at once from the corresponding states.
+
+        prng_state: (4,4) state of the PRNG before the batch
+        npub,k: (4,) nonce and (4*D,) masked key of the first encryption
+        initial_key: (4*D,) key refreshed if fixed_key
+        fixed_key: 0 for random keys, 1 for simple_refresh of initial_key
+        N: number of encryptions
+
+        returns the (N,4*D) keys, (N,4) seeds and (N,4) nonces of the
+        encryptions, and the PRNG state, nonce and key after the batch.
+    """
+    states = shadow_chain(prng_state,N)
+    new_keys = refresh_keys(initial_key,states[1:,2],fixed_key,D)
+    keys = np.vstack((np.asarray(k,dtype=np.uint32).reshape(1,4*D),new_keys[:-1]))
+    seeds = states[:N,0].copy()
+    nonces = np.vstack((np.asarray(npub,dtype=np.uint32).reshape(1,4),states[1:N,1]))
+    return keys,seeds,nonces,states[N],states[N,1].copy(),new_keys[-1].copy()
+
+def encrypt_grouped(ads,ms,keys,nonces):
+    """ encryption of lists of inputs with various lengths. The inputs with
+        the same lengths are encrypted together with spook_encrypt_batch.
+
+        ads,ms: lists of bytes
+        keys: (n,16) uint8 array of unmasked keys
+        nonces: (n,16) uint8 array
+
+        returns the list of ciphertexts.
+    """
+    out = [None]*len(ms)
+    groups = {}
+    for i,(ad,m) in enumerate(zip(ads,ms)):
+        groups.setdefault((len(ad),len(m)),[]).append(i)
+    for idx in groups.values():
+        c = spook.spook_encrypt_batch(
+                np.array([np.frombuffer(ads[i],dtype=np.uint8) for i in idx]).reshape(len(idx),-1),
+                np.array([np.frombuffer(ms[i],dtype=np.uint8) for i in idx]).reshape(len(idx),-1),
+                keys[idx],nonces[idx])
+        for j,i in enumerate(idx):
+            out[i] = c[j].tobytes()
+    return out
+
+class FirmwareModel:
+    def __init__(self,D=D,MAX_LEN=256):
+        """ D: number of shares of the firmware
+            MAX_LEN: size of the m and ad buffers of the firmware
+        """
+        self.D = D
+        self.MAX_LEN = MAX_LEN
+        # same initial values as in main()
+        self.inputs = {"c":b"","ad":b"","m":b"","npub":bytes(16),"k":bytes(16*D),
+                "s":bytes(16),"N":struct.pack("<I",1),"f":struct.pack("<I",1)}
+        self.prng_state = np.zeros((4,4),dtype=np.uint32)
+        self.initial_key = np.zeros(4*D,dtype=np.uint32)
+        self.ciphertexts = []
+
+    def max_len(self,dest):
+        """ size of the buffer of the input dest.
+        """
+        return {"c":self.MAX_LEN+16,"ad":self.MAX_LEN,"m":self.MAX_LEN,"npub":16,
+                "k":16*self.D,"s":16,"N":4,"f":4}[dest]
+
+    def set_field(self,dest,data):
+        """ writes data in the input dest (see protocol.DEST_CODES).
+        """
+        # only the first bytes of the fixed size inputs are overwritten
+        old = self.inputs[dest]
+        if dest in ("c","ad","m"):
+            self.inputs[dest] = bytes(data)
+        else:
+            self.inputs[dest] = bytes(data)+old[len(data):]
+        if dest == "s":
+            self.prng_state[:] = 0
+            self.prng_state[0] = np.frombuffer(self.inputs["s"],dtype=np.uint32)
+        elif dest == "k":
+            self.initial_key[:] = np.frombuffer(self.inputs["k"],dtype=np.uint32)
+
+    def step(self,N):
+        """ updates the memory as after N encryptions.
+
+            returns the (N,4*D) masked keys, (N,4) seeds and (N,4) nonces used
+            by the N encryptions.
+        """
+        fixed_key, = struct.unpack("<I",self.inputs["f"])
+        keys,seeds,nonces,self.prng_state,npub,k = unroll_batch(self.prng_state,
+                np.frombuffer(self.inputs["npub"],dtype=np.uint32),
+                np.frombuffer(self.inputs["k"],dtype=np.uint32),
+                self.initial_key,fixed_key,N,self.D)
+        self.inputs["npub"] = npub.tobytes()
+        self.inputs["k"] = k.tobytes()
+        self.initial_key = k.copy()
+        return keys,seeds,nonces
+
+    def encrypt(self):
+        """ runs a batch of N encryptions as the firmware does. All the
+            ciphertexts are kept in self.ciphertexts.
+
+            returns the ciphertext of the last encryption.
+        """
+        N, = struct.unpack("<I",self.inputs["N"])
+        if N == 0:
+            return self.inputs["c"]
+        keys,_,nonces = self.step(N)
+        self.ciphertexts = encrypt_grouped([self.inputs["ad"]]*N,[self.inputs["m"]]*N,
+                umask(keys,self.D).view(np.uint8),nonces.view(np.uint8))
+        self.inputs["c"] = self.ciphertexts[-1]
+        return self.inputs["c"]
+
+    def encrypt_many(self,ads,ms,ks,ns):
+        """ same as writing the inputs of each encryption then running an
+            encryption with N=1.
+
+            ks,ns: lists of masked keys and nonces, None to keep the ones in
+                memory (updated after each encryption)
+
+            returns the list of ciphertexts.
+        """
+        self.set_field("N",struct.pack("<I",1))
+        keys,nonces = [],[]
+        for k,npub in zip(ks,ns):
+            if k is not None:
+                self.set_field("k",k)
+            if npub is not None:
+                self.set_field("npub",npub)
+            k,_,npub = self.step(1)
+            keys.append(k[0])
+            nonces.append(npub[0])
+        out = encrypt_grouped(ads,ms,umask(np.array(keys),self.D).view(np.uint8),
+                np.array(nonces).view(np.uint8))
+        if len(out) > 0:
+            self.inputs["ad"],self.inputs["m"],self.inputs["c"] = ads[-1],ms[-1],out[-1]
+        self.ciphertexts = out
+        return out
+
+    def decrypt(self):
+        """ decrypts the ciphertext in memory. On a wrong tag, the firmware
+            still returns its buffer of mlen bytes, zeros are returned here.
+        """
+        c = self.inputs["c"]
+        n_m = max(len(c)-16,0)
+        k = np.frombuffer(self.inputs["k"],dtype=np.uint32).reshape(1,4*self.D)
+        m,valid = spook.spook_decrypt_batch(
+                np.frombuffer(self.inputs["ad"],dtype=np.uint8).reshape(1,-1),
+                np.frombuffer(c,dtype=np.uint8).reshape(1,-1),
+                umask(k,self.D).view(np.uint8),
+                np.frombuffer(self.inputs["npub"],dtype=np.uint8).reshape(1,-1))
+        self.inputs["m"] = m[0].tobytes() if valid[0] else bytes(n_m)
+        return self.inputs["m"]
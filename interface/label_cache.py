@@ -0,0 +1,204 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+Persistent cache of the labels derived by labeling.py.
+
+The labels of a capture file are identified by the hash of the file content,
+the number of shares D, the (Nr,step) parameters of clyde128_encrypt_masked
+and the variable:
+    - "state": masked state, (nt,4*D) uint32
+    - "umsk_state": unmasked state, (nt,4) uint32
+Each entry is a .npy file in the cache directory named after the sha256 of its
+key, hence renaming or copying a data-set does not invalidate its labels. The
+entries are returned as read-only memory maps. The least recently used ones
+are removed once the cache exceeds max_bytes.
+
+    cache = LabelCache("~/.cache/spook_labels")
+    labels = cache.labels("d8/random_key/file0.npz",Nr=1,step=0)
+
+The cache relies on atomic renames, and the index of the file hashes is
+updated under a file lock, such that it can be shared by concurrent processes.
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+import numpy as np
+from interface.labeling import label_files
+from interface.utils import umask
+
+VARIABLES = ("state","umsk_state")
+
+def file_hash(fname,chunk=2**24):
+    """ sha256 of the content of fname.
+    """
+    h = hashlib.sha256()
+    with open(fname,"rb") as f:
+        while True:
+            x = f.read(chunk)
+            if len(x) == 0:
+                return h.hexdigest()
+            h.update(x)
+
+class LabelCache:
+    def __init__(self,path,max_bytes=16*(2**30),n_jobs=None):
+        """ path: directory of the cache, created if needed
+            max_bytes: size budget of the cached labels
+            n_jobs: number of processes deriving the missing labels
+        """
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        self.n_jobs = n_jobs
+        os.makedirs(self.path,exist_ok=True)
+
+    def _hashes(self):
+        try:
+            with open(os.path.join(self.path,"hashes.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError,ValueError):
+            return {}
+
+    def content_hash(self,fname):
+        """ hash of the capture file fname. It is computed once for each
+            (path,size,mtime) and stored in the cache.
+        """
+        st = os.stat(fname)
+        ident = "%s:%d:%d"%(os.path.abspath(fname),st.st_size,st.st_mtime_ns)
+        h = self._hashes().get(ident)
+        if h is None:
+            h = file_hash(fname)
+            # read-modify-write of the index, other processes may add hashes
+            with open(os.path.join(self.path,"hashes.lock"),"w") as lock:
+                fcntl.flock(lock,fcntl.LOCK_EX)
+                hashes = self._hashes()
+                hashes[ident] = h
+                self._write_json("hashes.json",hashes)
+        return h
+
+    def key(self,fname,D,Nr,step,variable="state"):
+        """ name of the entry of the given labels.
+        """
+        if variable not in VARIABLES:
+            raise ValueError("Unknown variable %s, expected one of %s"%(variable,",".join(VARIABLES)))
+        desc = "%s:D%d:Nr%d:step%d:%s"%(self.content_hash(fname),D,Nr,step,variable)
+        return hashlib.sha256(desc.encode()).hexdigest()
+
+    def _fname(self,key):
+        return os.path.join(self.path,key+".npy")
+
+    def get(self,key):
+        """ returns the cached entry key as a memory map, None if missing.
+        """
+        fname = self._fname(key)
+        try:
+            out = np.load(fname,mmap_mode="r")
+            os.utime(fname) # mark as recently used
+        except FileNotFoundError:
+            return None
+        return out
+
+    def put(self,key,labels):
+        """ stores labels under key, then evicts the least recently used
+            entries. Returns the stored entry.
+        """
+        fd,tmp = tempfile.mkstemp(dir=self.path,suffix=".tmp")
+        with os.fdopen(fd,"wb") as f:
+            np.save(f,labels)
+        return self._move(key,tmp)
+
+    def _move(self,key,path):
+        # path must be a .npy file within the cache directory (same filesystem)
+        os.replace(path,self._fname(key))
+        self.evict(keep=key)
+        return self.get(key)
+
+    def labels(self,fname,Nr=1,step=0,variable="state"):
+        """ labels of the capture file fname, derived with labeling.py if
+            they are not cached.
+        """
+        with np.load(fname) as f:
+            D = f["msk_keys"].shape[1]//4
+        key = self.key(fname,D,Nr,step,variable)
+        out = self.get(key)
+        if out is not None:
+            return out
+
+        state_key = self.key(fname,D,Nr,step,"state")
+        state = self.get(state_key)
+        if state is None:
+            # the labels are derived in the cache directory and renamed
+            with tempfile.TemporaryDirectory(dir=self.path) as tmp:
+                paths = label_files([fname],tmp,[(Nr,step)],n_jobs=self.n_jobs)
+                state = self._move(state_key,paths[0][(Nr,step)])
+        if variable == "umsk_state":
+            return self.put(key,umask(state,D))
+        return state
+
+    def entries(self):
+        """ list of (key,size,last use) of the cached entries.
+        """
+        out = []
+        for name in os.listdir(self.path):
+            if name.endswith(".npy"):
+                try:
+                    st = os.stat(os.path.join(self.path,name))
+                except FileNotFoundError:
+                    continue
+                out.append((name[:-4],st.st_size,st.st_mtime))
+        return out
+
+    @property
+    def n_bytes(self):
+        return sum(x[1] for x in self.entries())
+
+    def evict(self,max_bytes=None,keep=None):
+        """ removes the least recently used entries until the cache holds at
+            most max_bytes (default self.max_bytes). The entry keep is never
+            removed.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self.entries(),key=lambda x: x[2])
+        total = sum(x[1] for x in entries)
+        for key,size,_ in entries:
+            if total <= max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self._fname(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        self.evict(max_bytes=0)
+
+    def _write_json(self,name,x):
+        fd,tmp = tempfile.mkstemp(dir=self.path,suffix=".tmp")
+        with os.fdopen(fd,"w") as f:
+            json.dump(x,f)
+        os.replace(tmp,os.path.join(self.path,name))
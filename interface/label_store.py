@@ -0,0 +1,190 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+Compact storage of share-wise labels and keys.
+
+A field (e.g., msk_keys or a variable recorded with spook_masked.Recorder) is
+a (nt,n_words) matrix of 32-bit words, one column per share of each word. It
+is stored as a struct of arrays: each slice of bits bits of each word is a
+contiguous array of nt classes,
+    bits = 1: 32 bits per word, one class in {0,1} per bit
+    bits = 4: 8 nibbles per word
+    bits = 8: 4 bytes per word
+    bits = 32: the words themselves
+Slice j holds the bits [j*bits,(j+1)*bits) of the word. With packed=True,
+the classes of 1 and 4 bits are packed (8 bits or 2 nibbles of consecutive
+traces per byte), such that the sliced labels take as much memory as the
+words: 32MB per word of the state for 1M traces with D=8 shares.
+
+A template builder reads the classes of one slice of one share without
+unpacking the whole words:
+
+    store = LabelStore(nt,bits=4,packed=True)
+    store.write("msk_keys",msk_keys)
+    for x in store.batches("msk_keys",word=3,j=5,batch_size=10000):
+        ... # (10000,) uint8 classes of nibble 5 of share 3 of the key
+"""
+
+import os
+import json
+import numpy as np
+
+class LabelStore:
+    def __init__(self,n_traces,bits=8,packed=False):
+        """ n_traces: number of traces
+            bits: size of the slices of the words (1, 4, 8 or 32)
+            packed: pack the classes of 1 and 4 bits in bytes
+
+            fields: dictionary mapping each field to its
+                (n_words,n_slices,n_stored) array
+        """
+        if bits not in (1,4,8,32):
+            raise ValueError("bits must be 1, 4, 8 or 32, got %d"%(bits))
+        self.n_traces = n_traces
+        self.bits = bits
+        self.packed = packed and bits in (1,4)
+        self.n_slices = 32//bits
+        self.per_byte = 8//bits if self.packed else 1
+        self.fields = {}
+
+    @property
+    def dtype(self):
+        return np.uint32 if self.bits == 32 else np.uint8
+
+    @property
+    def nbytes(self):
+        return sum(x.nbytes for x in self.fields.values())
+
+    def _alloc(self,field,n_words):
+        n_stored = -(-self.n_traces//self.per_byte)
+        self.fields[field] = np.zeros((n_words,self.n_slices,n_stored),dtype=self.dtype)
+
+    def _slices(self,words):
+        # (n,n_words) uint32 -> (n_words,n_slices,n) classes
+        words = np.asarray(words,dtype=np.uint32).T
+        if self.bits == 32:
+            return words[:,None,:]
+        shifts = np.arange(self.n_slices,dtype=np.uint32)*self.bits
+        return ((words[:,None,:] >> shifts[None,:,None]) & (2**self.bits-1)).astype(np.uint8)
+
+    def write(self,field,words,start=0):
+        """ stores the words of the traces [start,start+n) of field.
+
+            words: (n,n_words) uint32 matrix (e.g., msk_keys or the stacked
+                shares of a recorded variable)
+
+            When packed, start must be a multiple of the number of classes in
+            a byte (8 for bits=1, 2 for bits=4), except for the last rows.
+        """
+        words = np.asarray(words,dtype=np.uint32).reshape(len(words),-1)
+        if field not in self.fields:
+            self._alloc(field,len(words[0]))
+        if start+len(words) > self.n_traces:
+            raise ValueError("Rows [%d,%d) out of the %d traces"%(start,start+len(words),self.n_traces))
+        x = self._slices(words)
+        if not self.packed:
+            self.fields[field][:,:,start:start+len(words)] = x
+            return
+        if start % self.per_byte != 0:
+            raise ValueError("start must be a multiple of %d"%(self.per_byte))
+        pad = -len(words) % self.per_byte
+        x = np.concatenate((x,np.zeros(x.shape[:2]+(pad,),dtype=np.uint8)),axis=2)
+        x = x.reshape(x.shape[:2]+(-1,self.per_byte))
+        shifts = (np.arange(self.per_byte)*self.bits).astype(np.uint8)
+        packed = np.bitwise_or.reduce(x << shifts,axis=3).astype(np.uint8)
+        lo = start//self.per_byte
+        self.fields[field][:,:,lo:lo+len(packed[0,0])] = packed
+
+    def get(self,field,word,j=None,start=0,stop=None):
+        """ classes of the slice j of the word of field for the traces
+            [start,stop). Returns (n,) classes, or (n_slices,n) if j is None.
+        """
+        stop = self.n_traces if stop is None else min(stop,self.n_traces)
+        x = self.fields[field][word]
+        if j is not None:
+            x = x[j:j+1]
+        if self.packed:
+            lo,hi = start//self.per_byte,-(-stop//self.per_byte)
+            x = x[:,lo:hi]
+            shifts = (np.arange(self.per_byte)*self.bits).astype(np.uint8)
+            x = (x[:,:,None] >> shifts) & (2**self.bits-1)
+            x = x.reshape(len(x),-1)[:,start-lo*self.per_byte:stop-lo*self.per_byte]
+        else:
+            x = x[:,start:stop]
+        return x[0] if j is not None else x
+
+    def words(self,field,start=0,stop=None):
+        """ (n,n_words) uint32 words of field for the traces [start,stop).
+        """
+        n_words = len(self.fields[field])
+        out = None
+        for w in range(n_words):
+            x = self.get(field,w,start=start,stop=stop).astype(np.uint32)
+            if out is None:
+                out = np.zeros((len(x[0]),n_words),dtype=np.uint32)
+            shifts = np.arange(self.n_slices,dtype=np.uint32)*self.bits
+            out[:,w] = np.bitwise_or.reduce(x << shifts[:,None],axis=0)
+        return out
+
+    def batches(self,field,word,j=None,batch_size=10000):
+        """ iterates over the classes of get(field,word,j) by batches of
+            batch_size traces.
+        """
+        for start in range(0,self.n_traces,batch_size):
+            yield self.get(field,word,j,start,start+batch_size)
+
+    def save(self,path):
+        """ writes the store in the directory path, one .npy file per field.
+        """
+        os.makedirs(path,exist_ok=True)
+        for field,x in self.fields.items():
+            np.save(os.path.join(path,field+".npy"),x)
+        meta = {"n_traces":self.n_traces,"bits":self.bits,"packed":self.packed,
+                "fields":list(self.fields)}
+        with open(os.path.join(path,"labels.json"),"w") as f:
+            json.dump(meta,f)
+
+    @classmethod
+    def load(cls,path,mmap_mode="r"):
+        """ opens a store written by save. The fields are memory mapped
+            unless mmap_mode is None.
+        """
+        with open(os.path.join(path,"labels.json")) as f:
+            meta = json.load(f)
+        store = cls(meta["n_traces"],bits=meta["bits"],packed=meta["packed"])
+        for field in meta["fields"]:
+            store.fields[field] = np.load(os.path.join(path,field+".npy"),mmap_mode=mmap_mode)
+        return store
+
+    @classmethod
+    def from_dataset(cls,ds,fields=("msk_keys","seeds","nonces"),bits=8,packed=False,batch_size=10000):
+        """ stores the fields of a dataset.Dataset. When packed, batch_size
+            must be a multiple of 8.
+        """
+        store = cls(ds.n_total,bits=bits,packed=packed)
+        for batch_start in range(0,ds.n_total,batch_size):
+            for field in fields:
+                store.write(field,ds[field][batch_start:batch_start+batch_size],batch_start)
+        return store
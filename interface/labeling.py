@@ -0,0 +1,160 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+This file derives the masked intermediate states of whole datasets
+(see README.md for the file format) with spook_masked.py.
+
+The rows of all the input files are split in shards that are labeled
+by a pool of processes. The number of shares D is deduced from the msk_keys
+field of each file such that data-sets of various orders can be labeled by the
+same call. Each target (Nr,step) of each input file is written in its own .npy
+file of shape (nt,4*D) within the output directory:
+
+    out_dir/<file name>/label_Nr<Nr>_step<step>.npy
+
+As an example, the state after the first sbox layer of all the profiling
+traces is obtained with
+
+    python3 interface/labeling.py -o labels/ -t 1,0 d8/random_key/*.npz
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from interface.dataset import Dataset
+from interface.spook_masked import MaskedClyde
+from interface.utils import TapeCache
+
+def label_path(out_dir,fname,Nr,step):
+    """
+        path of the labels of target (Nr,step) for the input file fname.
+    """
+    name = os.path.splitext(os.path.basename(fname))[0]
+    return os.path.join(out_dir,name,"label_Nr%d_step%d.npy"%(Nr,step))
+
+def label_shard(fname,start,stop,targets,out_dir):
+    """
+        derive the targets for the rows [start,stop) of the file fname
+        and write them in the preallocated outputs. The PRNG tape is shared
+        between the targets.
+
+        Only the rows of the shard are read if the inputs can be memory
+        mapped (see dataset.py), compressed files are decompressed.
+    """
+    ds = Dataset([fname])
+    nonces = ds["nonces"][start:stop]
+    msk_keys = ds["msk_keys"][start:stop]
+    seeds = ds["seeds"][start:stop]
+    nt = len(nonces)
+    D = ds.D
+    tweak = np.zeros((4,nt),dtype=np.uint32)
+
+    # longest target first such that the other ones reuse its tape
+    clyde = MaskedClyde(D)
+    targets = sorted(targets,key=lambda x: clyde.n_random_words(*x),reverse=True)
+    clyde.cache = TapeCache(max_bytes=clyde.n_random_words(*targets[0])*nt*4)
+    for Nr,step in targets:
+        msk_state = clyde.encrypt(nonces.T,tweak,msk_keys.T,seeds.T,Nr=Nr,step=step)
+        out = np.load(label_path(out_dir,fname,Nr,step),mmap_mode="r+")
+        out[start:stop] = msk_state
+        out.flush()
+        del out
+    return stop-start
+
+def label_files(fnames,out_dir,targets,shard_size=1000,n_jobs=None):
+    """
+        derive the masked intermediate states of all the traces in fnames.
+
+        fnames: list of .npz capture files
+        out_dir: directory where the labels are stored
+        targets: list of (Nr,step) parameters of clyde128_encrypt_masked
+        shard_size: number of traces labeled by a process at once
+        n_jobs: number of processes, defaults to the number of cores
+
+        output: list of dictionaries (one per file) mapping each target to
+            the path of its labels.
+    """
+    jobs = []
+    paths = []
+    for fname in fnames:
+        ds = Dataset([fname]) # only the headers are read
+        nt = ds.n_total
+        D = ds.D
+
+        paths.append({})
+        for Nr,step in targets:
+            path = label_path(out_dir,fname,Nr,step)
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+            np.lib.format.open_memmap(path,mode="w+",dtype=np.uint32,shape=(nt,4*D))
+            paths[-1][(Nr,step)] = path
+        for start in range(0,nt,shard_size):
+            jobs.append((fname,start,min(start+shard_size,nt)))
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(label_shard,fname,start,stop,targets,out_dir)
+                for fname,start,stop in jobs]
+        for fut in futures:
+            fut.result()
+    return paths
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Label datasets with masked intermediate states')
+    parser.add_argument(
+            'fnames',
+            nargs='+',
+            help='capture files to label'
+            )
+    parser.add_argument(
+            '-o',
+            '--out',
+            default='labels',
+            help='output directory'
+            )
+    parser.add_argument(
+            '-t',
+            '--target',
+            action='append',
+            default=None,
+            help='Nr,step parameters of the target, can be repeated'
+            )
+    parser.add_argument(
+            '-s',
+            '--shard',
+            default=1000,
+            type=int,
+            help='Number of traces in a shard'
+            )
+    parser.add_argument(
+            '-j',
+            '--jobs',
+            default=None,
+            type=int,
+            help='Number of processes'
+            )
+    args = parser.parse_args()
+    if args.target is None:
+        args.target = ["1,0"]
+    targets = [tuple(int(x) for x in t.split(",")) for t in args.target]
+    label_files(args.fnames,args.out,targets,shard_size=args.shard,n_jobs=args.jobs)
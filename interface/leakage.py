@@ -0,0 +1,368 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+One pass leakage assessment over capture files (see README.md).
+
+The statistics are accumulated batch by batch such that the memory usage does
+not depend on the number of traces:
+    - TTest: Welch t-test between two sets (e.g., fixed_key/ and random_key/)
+      at the orders 1 to order. The centered moments of each sample are
+      updated with the pairwise formulas of Pebay (Sandia report 2008-6212),
+      which are numerically stable for high orders.
+    - SNR: signal to noise ratio of each sample for one or many labels. Only
+      the sums of the samples in each class, their number and the global sum
+      of squares are accumulated. It is also used by share_snr.py.
+The accumulators of distinct traces can be merged. Hence, ttest_files and
+snr_files split the files in chunks shared by a pool of processes, each of
+them returns a single accumulator and these are merged:
+
+    python3 interface/leakage.py -f d8/fixed_key/key_0/*.npz d8/random_key/*.npz
+    python3 interface/leakage.py -t 1,0 -s 0,2000 d8/random_key/*.npz
+
+The SNR is computed for each byte of the masked state returned by
+clyde128_encrypt_masked, that is for each byte of each share. Its memory
+usage is proportional to the number of samples, which are selected with -s.
+"""
+
+import os
+import numpy as np
+from math import comb
+from concurrent.futures import ProcessPoolExecutor
+from interface.dataset import Dataset
+from interface.parameters import D
+from interface.spook_masked import MaskedClyde
+
+class Moments:
+    def __init__(self,n_samples,order):
+        """ centered moments of the samples up to order.
+
+            n: number of traces
+            mean: (n_samples,) mean of each sample
+            cs: (order+1,n_samples) where cs[p] is the sum over the traces
+                of (x-mean)**p for p >= 2
+        """
+        self.order = order
+        self.n = 0
+        self.mean = np.zeros(n_samples)
+        self.cs = np.zeros((order+1,n_samples))
+
+    def update(self,traces):
+        """ adds the (n,n_samples) traces.
+        """
+        x = np.asarray(traces,dtype=np.float64)
+        if len(x) == 0:
+            return
+        batch = Moments(len(x[0]),self.order)
+        batch.n = len(x)
+        batch.mean = x.mean(axis=0)
+        x = x-batch.mean
+        xp = x*x
+        for p in range(2,self.order+1):
+            batch.cs[p] = xp.sum(axis=0)
+            xp *= x
+        self.merge(batch)
+
+    def merge(self,other):
+        """ adds the traces accumulated in other.
+        """
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.n,self.mean,self.cs = other.n,other.mean.copy(),other.cs.copy()
+            return
+        na,nb = self.n,other.n
+        n = na+nb
+        delta = other.mean-self.mean
+        cs = self.cs+other.cs
+        for p in range(3,self.order+1):
+            for k in range(1,p-1):
+                cs[p] += comb(p,k)*delta**k*((-nb/n)**k*self.cs[p-k]
+                        + (na/n)**k*other.cs[p-k])
+        for p in range(2,self.order+1):
+            cs[p] += (na*nb/n*delta)**p*(1/nb**(p-1) - (-1/na)**(p-1))
+        self.mean = self.mean+delta*nb/n
+        self.cs = cs
+        self.n = n
+
+    def central(self,p):
+        """ p-th centered moment of each sample.
+        """
+        return self.cs[p]/self.n
+
+class TTest:
+    def __init__(self,n_samples,order=D):
+        """ Welch t-test between two sets of traces for the orders 1 to
+            order. The t-test at order d > 2 is computed on the standardized
+            traces ((x-mean)/std)**d.
+        """
+        self.order = order
+        self.groups = [Moments(n_samples,2*order),Moments(n_samples,2*order)]
+
+    def update(self,traces,group):
+        """ traces: (n,n_samples) traces
+            group: set (0 or 1) of all the traces, or (n,) set of each trace
+        """
+        if np.ndim(group) == 0:
+            self.groups[group].update(traces)
+        else:
+            group = np.asarray(group)
+            for g in (0,1):
+                self.groups[g].update(traces[group == g])
+
+    def merge(self,other):
+        for a,b in zip(self.groups,other.groups):
+            a.merge(b)
+
+    def t(self):
+        """ (order,n_samples) t statistics, row d-1 is the one at order d.
+        """
+        out = np.zeros((self.order,len(self.groups[0].mean)))
+        for d in range(1,self.order+1):
+            mv = []
+            for g in self.groups:
+                if d == 1:
+                    m,v = g.mean,g.central(2)
+                elif d == 2:
+                    m,v = g.central(2),g.central(4)-g.central(2)**2
+                else:
+                    cm2 = g.central(2)
+                    m = g.central(d)/cm2**(d/2)
+                    v = (g.central(2*d)-g.central(d)**2)/cm2**d
+                mv.append((m,v,g.n))
+            (m0,v0,n0),(m1,v1,n1) = mv
+            with np.errstate(divide="ignore",invalid="ignore"):
+                out[d-1] = (m0-m1)/np.sqrt(v0/n0+v1/n1)
+        return out
+
+class SNR:
+    def __init__(self,n_samples,n_vars=1,n_classes=256,samples=None):
+        """ signal to noise ratio of each sample for n_vars labels taking
+            n_classes values.
+
+            samples: indexes of the samples to keep, all of them if None.
+                The memory usage is n_vars*n_classes*len(samples) floats.
+
+            n: number of traces
+            shift: mean of the first batch, reduces the cancellation
+            sq: (len(samples),) sum of squares of the shifted samples
+            counts: (n_vars,n_classes) number of traces in each class
+            sums: (n_vars,n_classes,len(samples)) sum of the shifted samples
+                in each class
+        """
+        self.samples = np.arange(n_samples) if samples is None else np.asarray(samples)
+        self.n_classes = n_classes
+        ns = len(self.samples)
+        self.n = 0
+        self.shift = None
+        self.sq = np.zeros(ns)
+        self.counts = np.zeros((n_vars,n_classes),dtype=np.int64)
+        self.sums = np.zeros((n_vars,n_classes,ns))
+
+    def update(self,traces,labels,var_chunk=16):
+        """ traces: (n,n_samples) traces
+            labels: (n,n_vars) labels of the traces, or (n,) if n_vars is 1
+            var_chunk: number of labels processed at once, bounds the
+                temporary memory to n*var_chunk*n_classes floats
+        """
+        x = np.asarray(traces)[:,self.samples].astype(np.float64)
+        labels = np.asarray(labels).reshape(len(x),-1)
+        if self.shift is None:
+            self.shift = x.mean(axis=0)
+        x -= self.shift
+        self.n += len(x)
+        self.sq += (x*x).sum(axis=0)
+        classes = np.arange(self.n_classes)
+        for i in range(0,len(self.counts),var_chunk):
+            l = labels[:,i:i+var_chunk]
+            onehot = (l[:,:,None] == classes).reshape(len(x),-1).astype(np.float64)
+            self.sums[i:i+var_chunk] += (onehot.T @ x).reshape(len(l[0]),self.n_classes,-1)
+            self.counts[i:i+var_chunk] += onehot.sum(axis=0).reshape(len(l[0]),-1).astype(np.int64)
+
+    def merge(self,other):
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.n,self.shift = other.n,other.shift.copy()
+            self.sq,self.counts,self.sums = other.sq.copy(),other.counts.copy(),other.sums.copy()
+            return
+        # express the sums of other with the shift of self
+        delta = other.shift-self.shift
+        total = other.sums[0].sum(axis=0)
+        self.sq += other.sq + 2*delta*total + other.n*delta**2
+        self.sums += other.sums + other.counts[:,:,None]*delta
+        self.counts += other.counts
+        self.n += other.n
+
+    def snr(self):
+        """ (n_vars,len(samples)) variance of the class means over the
+            variance within the classes (weighted by the class sizes).
+        """
+        mean = self.sums[0].sum(axis=0)/self.n # same for all labels
+        with np.errstate(divide="ignore",invalid="ignore"):
+            between = np.nansum(self.sums**2/self.counts[:,:,None],axis=1)/self.n - mean**2
+            within = self.sq/self.n - mean**2 - between
+            return between/within
+
+def _chunks(fnames,chunk_size):
+    ds = Dataset(fnames)
+    for i,fname in enumerate(fnames):
+        n = int(ds.offsets[i+1]-ds.offsets[i])
+        for start in range(0,n,chunk_size):
+            yield fname,start,min(start+chunk_size,n)
+
+def _split(jobs,n_jobs):
+    # one list of chunks per process, such that each returns one accumulator
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+    return [x for x in (jobs[i::n_jobs] for i in range(n_jobs)) if len(x) > 0]
+
+def ttest_chunks(chunks,order,batch_size=1000):
+    """ t-test accumulator of the traces of chunks, a list of
+        (fname,start,stop,group) where group is 0 or 1.
+    """
+    ttest = None
+    for fname,start,stop,group in chunks:
+        traces = Dataset([fname])["traces"]
+        if ttest is None:
+            ttest = TTest(traces.shape[1],order)
+        for i in range(start,stop,batch_size):
+            ttest.update(traces[i:min(i+batch_size,stop)],group)
+    return ttest
+
+def snr_chunks(chunks,Nr,step,samples=None,batch_size=1000):
+    """ SNR accumulator of the bytes of the masked state (Nr,step) for
+        chunks, a list of (fname,start,stop).
+    """
+    snr = None
+    for fname,start,stop in chunks:
+        ds = Dataset([fname])
+        clyde = MaskedClyde(ds.D)
+        if snr is None:
+            snr = SNR(ds["traces"].shape[1],n_vars=16*ds.D,samples=samples)
+        for i in range(start,stop,batch_size):
+            j = min(i+batch_size,stop)
+            nonces,msk_keys,seeds = ds["nonces"][i:j],ds["msk_keys"][i:j],ds["seeds"][i:j]
+            tweak = np.zeros((4,j-i),dtype=np.uint32)
+            msk_state = clyde.encrypt(nonces.T,tweak,msk_keys.T,seeds.T,Nr=Nr,step=step)
+            snr.update(ds["traces"][i:j],np.ascontiguousarray(msk_state).view(np.uint8))
+    return snr
+
+def _reduce(futures):
+    out = None
+    for fut in futures:
+        if out is None:
+            out = fut.result()
+        else:
+            out.merge(fut.result())
+    return out
+
+def ttest_files(fixed,random,order=D,chunk_size=10000,n_jobs=None):
+    """ t-test between the traces of the files fixed and random.
+        returns a TTest, the statistics are given by its t method.
+
+        chunk_size: number of traces read at once from a file
+        n_jobs: number of processes, defaults to the number of cores
+    """
+    jobs = [x+(0,) for x in _chunks(fixed,chunk_size)]+[x+(1,) for x in _chunks(random,chunk_size)]
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return _reduce([pool.submit(ttest_chunks,chunks,order)
+                for chunks in _split(jobs,n_jobs)])
+
+def snr_files(fnames,Nr=1,step=0,samples=None,chunk_size=10000,n_jobs=None):
+    """ SNR of the bytes of the masked state (Nr,step) (see
+        clyde128_encrypt_masked) in the traces of fnames. The label 4*j+b is
+        the byte b of the word j of the masked state.
+
+        samples: indexes of the samples to keep, all of them if None. Each
+            process holds 16*D*256*len(samples) floats.
+
+        returns an SNR, the statistics are given by its snr method.
+    """
+    jobs = list(_chunks(fnames,chunk_size))
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return _reduce([pool.submit(snr_chunks,chunks,Nr,step,samples)
+                for chunks in _split(jobs,n_jobs)])
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Leakage assessment of capture files')
+    parser.add_argument(
+            'fnames',
+            nargs='+',
+            help='capture files (random key set for the t-test)'
+            )
+    parser.add_argument(
+            '-f',
+            '--fixed',
+            nargs='+',
+            default=None,
+            help='fixed key capture files, runs a t-test against fnames'
+            )
+    parser.add_argument(
+            '-d',
+            '--order',
+            default=D,
+            type=int,
+            help='maximum order of the t-test'
+            )
+    parser.add_argument(
+            '-t',
+            '--target',
+            default="1,0",
+            help='Nr,step parameters of the SNR target'
+            )
+    parser.add_argument(
+            '-s',
+            '--samples',
+            default=None,
+            help='start,stop of the samples kept for the SNR'
+            )
+    parser.add_argument(
+            '-o',
+            '--out',
+            default='leakage.npz',
+            help='file where the statistics are saved'
+            )
+    parser.add_argument(
+            '-j',
+            '--jobs',
+            default=None,
+            type=int,
+            help='Number of processes'
+            )
+    args = parser.parse_args()
+    if args.fixed is not None:
+        ttest = ttest_files(args.fixed,args.fnames,order=args.order,n_jobs=args.jobs)
+        t = ttest.t()
+        np.savez(args.out,t=t)
+        for d in range(args.order):
+            print("order %d: max |t| = %.2f"%(d+1,np.nanmax(np.abs(t[d]))))
+    else:
+        Nr,step = (int(x) for x in args.target.split(","))
+        samples = None
+        if args.samples is not None:
+            samples = np.arange(*(int(x) for x in args.samples.split(",")))
+        snr = snr_files(args.fnames,Nr=Nr,step=step,samples=samples,n_jobs=args.jobs).snr()
+        np.savez(args.out,snr=snr)
+        print("max SNR = %.4f"%(np.nanmax(snr)))
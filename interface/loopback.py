@@ -0,0 +1,217 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Simulated serial port running the firmware of board_m0/Src/main.c on the host.
+
+LoopbackSerial can be given to SpookTopLevel in place of the serial port such
+that the UART protocol (see protocol.py) is exercised without a board. The
+inputs are parsed exactly as by the MCU, including the frames and their CRC,
+and the operations are run by the firmware model of firmware.py.
+
+PtyLoopback serves the same emulation on a pseudo-terminal such that a real
+serial.Serial can be opened on it (e.g. to benchmark the interface).
+"""
+
+import os
+import pty
+import tty
+import time
+import select
+import struct
+import threading
+from interface.protocol import *
+from interface.parameters import *
+from interface.firmware import FirmwareModel
+
+class LoopbackSerial:
+    # USART1 clock (48 MHz) divided by the oversampling
+    MAX_BAUDRATE = 3000000
+    MIN_BAUDRATE = 1200
+
+    def __init__(self,D=D,MAX_LEN=256):
+        """ D: number of shares of the emulated firmware
+            MAX_LEN: size of the m and ad buffers of the firmware
+        """
+        self.D = D
+        self.MAX_LEN = MAX_LEN
+        self.timeout = 1
+        self.baudrate = DEFAULT_BAUDRATE
+        self.is_open = False
+        self._rx = b""
+        self._tx = b""
+        self._lock = threading.Condition()
+        self._held = None
+        self.firmware = FirmwareModel(D,MAX_LEN)
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    @property
+    def in_waiting(self):
+        return len(self._tx)
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._tx = b""
+
+    def write(self,data):
+        with self._lock:
+            self._rx += bytes(data)
+            self._process()
+            self._lock.notify_all()
+        return len(data)
+
+    def hold(self):
+        """ stops processing the frames, as when the main loop of the MCU is
+            busy. The received frames fill the FRAME_SLOTS slots, further
+            ones are answered with FRAME_ERR_BUSY after the pending frames.
+        """
+        with self._lock:
+            self._held = []
+
+    def release(self):
+        """ processes the frames received since hold.
+        """
+        with self._lock:
+            held,self._held = self._held,None
+            for kind,data in held:
+                self._tx += self._process_frame(data) if kind == "frame" else data
+            self._lock.notify_all()
+
+    def _reply(self,data):
+        # replies of the IRQ are sent after the pending frames
+        if self._held:
+            self._held.append(("reply",data))
+        else:
+            self._tx += data
+
+    def read(self,size=1):
+        """ as serial.Serial.read, waits up to timeout for size bytes.
+        """
+        with self._lock:
+            self._lock.wait_for(lambda: len(self._tx) >= size,self.timeout)
+            out,self._tx = self._tx[:size],self._tx[size:]
+        return out
+
+    def _process(self):
+        # same state machine as HAL_UART_RxCpltCallback
+        while len(self._rx) >= 4:
+            dest,enc_flag,length = struct.unpack("<BBH",self._rx[:4])
+            if len(self._rx) < 4+length:
+                return
+            data,self._rx = self._rx[4:4+length],self._rx[4+length:]
+            if dest in (FRAME_DEST,CONFIG_DEST):
+                # the body of a rejected frame is dropped
+                if length > (FRAME_MAX_LEN if dest == FRAME_DEST else 4):
+                    self._reply(encode_response(FRAME_ERR_LEN))
+                elif length == 0:
+                    self._reply(encode_response(FRAME_ERR_FORMAT))
+                elif dest == CONFIG_DEST:
+                    self._reply(self._process_config(data))
+                elif self._held is None:
+                    self._tx += self._process_frame(data)
+                elif sum(kind == "frame" for kind,_ in self._held) >= FRAME_SLOTS:
+                    self._reply(encode_response(FRAME_ERR_BUSY))
+                else:
+                    self._held.append(("frame",data))
+                continue
+            codes = {v:k for k,v in DEST_CODES.items()}
+            if dest in codes:
+                self.firmware.set_field(codes[dest],data)
+            if enc_flag == 1:
+                self._tx += self.firmware.encrypt()
+            elif enc_flag == 2:
+                self._tx += self.firmware.decrypt()
+
+    def _process_frame(self,body):
+        try:
+            records = decode_frame(body)
+        except FrameError as e:
+            status = FRAME_ERR_CRC if "CRC" in str(e) else FRAME_ERR_FORMAT
+            return encode_response(status)
+        out = b""
+        for fields,op in records:
+            for dest,data in fields:
+                if len(data) > self.firmware.max_len(dest):
+                    return encode_response(FRAME_ERR_FORMAT)
+                self.firmware.set_field(dest,data)
+            if op == 1:
+                out += self.firmware.encrypt()
+            elif op == 2:
+                out += self.firmware.decrypt()
+            if 7+len(out) > FRAME_MAX_LEN:
+                return encode_response(FRAME_ERR_LEN)
+        return encode_response(FRAME_OK,out)
+
+    def _process_config(self,data):
+        requested, = struct.unpack("<I",data.ljust(4,b"\x00"))
+        if self.MIN_BAUDRATE <= requested <= self.MAX_BAUDRATE:
+            self.baudrate = requested
+        return encode_response(FRAME_OK,struct.pack("<IHHB",self.baudrate,
+            FRAME_MAX_LEN,self.MAX_LEN,self.D))
+
+class PtyLoopback:
+    def __init__(self,D=D,emulate_rate=True):
+        """ runs a LoopbackSerial behind a pseudo-terminal in a background
+            thread. The host opens the serial port self.port.
+
+            D: number of shares of the emulated firmware
+            emulate_rate: delay the answers by the transfer time of the
+                bytes at the negotiated baudrate (10 bits per byte)
+        """
+        self.device = LoopbackSerial(D)
+        self.emulate_rate = emulate_rate
+        self._master,self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve,daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while not self._stop.is_set():
+            ready,_,_ = select.select([self._master],[],[],0.05)
+            if len(ready) == 0:
+                continue
+            try:
+                data = os.read(self._master,4096)
+            except OSError:
+                return
+            baudrate = self.device.baudrate
+            self.device.write(data)
+            out = self.device.read(self.device.in_waiting)
+            if self.emulate_rate:
+                time.sleep(10*(len(data)+len(out))/baudrate)
+            if len(out) > 0:
+                os.write(self._master,out)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
@@ -1,3 +1,4 @@
 # !!!! Autogenerated in Makefile
 D = 8
 PRGON = 1
+PRNG_MAX = 256
@@ -0,0 +1,190 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+UART protocol between the host and the MCU (see board_m0/Src/main.c).
+
+Every message starts with a 4 bytes header:
+    DEST | ENC | LEN (2 bytes, little endian)
+followed by LEN bytes of data. With DEST in DEST_CODES, the data is written
+in the corresponding input of the MCU and ENC tells if an encryption (1) or
+a decryption (2) is started afterwards.
+
+With DEST == FRAME_DEST, the data is a frame packing the inputs of one or
+many operations (all integers are little endian):
+    N_RECORDS (2 bytes) | RECORD_0 | ... | RECORD_N-1 | CRC32 (4 bytes)
+    RECORD = N_FIELDS (1 byte) | OP (1 byte) | FIELD_0 | ... | FIELD_N-1
+    FIELD = DEST (1 byte) | LEN (2 bytes) | DATA (LEN bytes)
+The fields of a record are written in order, then the operation OP (0: none,
+1: encryption, 2: decryption) is run. The MCU answers each frame with
+    STATUS (1 byte) | LEN (2 bytes) | OUTPUTS (LEN bytes) | CRC32 (4 bytes)
+where OUTPUTS concatenates the ciphertexts or plaintexts of all the records.
+The MCU receives a frame while processing the previous one, hence the host
+can send a frame before reading the response of the previous one, but not
+more (see FRAME_SLOTS). An extra frame is dropped with status FRAME_ERR_BUSY.
+The CRC32 is the one of zlib computed over all the preceding bytes. A frame
+with a LEN of 0 or above FRAME_MAX_LEN is received and dropped by the MCU,
+then answered with FRAME_ERR_FORMAT or FRAME_ERR_LEN.
+
+With DEST == CONFIG_DEST, the data is the baudrate (4 bytes) requested by the
+host, 0 to keep the current one. The MCU answers as to a frame with
+    BAUDRATE (4 bytes) | FRAME_MAX_LEN (2 bytes) | MAX_LEN (2 bytes) | D (1 byte)
+as payload, then switches to BAUDRATE. The response is sent with the previous
+baudrate. Every board starts at DEFAULT_BAUDRATE.
+"""
+
+import struct
+import zlib
+
+DEST_CODES = {"c":0,"ad":1,"m":2,"npub":3,"k":4,"s":5,"N":6,"f":7}
+FRAME_DEST = 8
+CONFIG_DEST = 9
+DEFAULT_BAUDRATE = 115200
+
+# size of the frame buffers of the MCU (body with CRC, and response)
+FRAME_MAX_LEN = 1024
+# number of frames held by the MCU: one is received while the other is processed
+FRAME_SLOTS = 2
+
+FRAME_OK = 0
+FRAME_ERR_CRC = 1
+FRAME_ERR_FORMAT = 2
+FRAME_ERR_LEN = 3
+FRAME_ERR_BUSY = 4 # the frame arrived while both slots were pending
+
+class FrameError(IOError):
+    pass
+
+def encode_header(dest,enc_flag,length):
+    """ 4 bytes header of a message with length bytes of data.
+    """
+    return struct.pack("<BBH",dest,enc_flag,length)
+
+def encode_record(fields,op=0):
+    """ fields: list of (dest,data) with dest in DEST_CODES and data bytes
+        op: 0 for no operation, 1 for encryption, 2 for decryption
+    """
+    out = struct.pack("<BB",len(fields),op)
+    for dest,data in fields:
+        out += struct.pack("<BH",DEST_CODES[dest],len(data)) + bytes(data)
+    return out
+
+def encode_frame(records,max_len=FRAME_MAX_LEN):
+    """ returns the header and the frame containing the encoded records.
+
+        max_len: size of the frame buffers of the MCU
+    """
+    body = struct.pack("<H",len(records)) + b"".join(records)
+    body += struct.pack("<I",zlib.crc32(body))
+    if len(body) > max_len:
+        raise ValueError("Frame of %d bytes, max is %d"%(len(body),max_len))
+    return encode_header(FRAME_DEST,0,len(body)) + body
+
+def decode_frame(body):
+    """ inverse of encode_frame (without header).
+        returns a list of (fields,op) where fields is a list of (dest,data).
+    """
+    if len(body) < 6 or zlib.crc32(body[:-4]) != struct.unpack("<I",body[-4:])[0]:
+        raise FrameError("Bad frame CRC")
+    codes = {v:k for k,v in DEST_CODES.items()}
+    body = body[:-4]
+    n_records, = struct.unpack_from("<H",body,0)
+    pos = 2
+    records = []
+    try:
+        for _ in range(n_records):
+            n_fields,op = struct.unpack_from("<BB",body,pos)
+            pos += 2
+            fields = []
+            for _ in range(n_fields):
+                dest,length = struct.unpack_from("<BH",body,pos)
+                pos += 3
+                if pos+length > len(body):
+                    raise FrameError("Truncated field")
+                fields.append((codes[dest],body[pos:pos+length]))
+                pos += length
+            records.append((fields,op))
+    except (struct.error,KeyError):
+        raise FrameError("Malformed frame")
+    return records
+
+def encode_response(status,payload=b""):
+    out = struct.pack("<BH",status,len(payload)) + bytes(payload)
+    return out + struct.pack("<I",zlib.crc32(out))
+
+def read_response(ser):
+    """ reads the answer of the MCU to a frame on the serial port ser.
+        returns the concatenated outputs of the records.
+    """
+    head = ser.read(3)
+    if len(head) != 3:
+        raise FrameError("Timeout while waiting for the frame response")
+    status,length = struct.unpack("<BH",head)
+    rest = ser.read(length+4)
+    if len(rest) != length+4:
+        raise FrameError("Timeout while reading the frame response")
+    if zlib.crc32(head+rest[:length]) != struct.unpack("<I",rest[length:])[0]:
+        raise FrameError("Bad response CRC")
+    if status != FRAME_OK:
+        raise FrameError("MCU rejected the frame with status %d"%(status))
+    return rest[:length]
+
+def encode_config(baudrate=0):
+    """ request to switch the UART of the MCU to baudrate.
+    """
+    return encode_header(CONFIG_DEST,0,4) + struct.pack("<I",baudrate)
+
+def decode_config(payload):
+    """ returns the configuration sent by the MCU as a dictionary.
+    """
+    if len(payload) != 9:
+        raise FrameError("Bad configuration length %d"%(len(payload)))
+    baudrate,frame_max_len,max_len,D = struct.unpack("<IHHB",payload)
+    return {"baudrate":baudrate,"frame_max_len":frame_max_len,"max_len":max_len,"D":D}
+
+def split_records(records,out_lens,max_len=FRAME_MAX_LEN):
+    """ groups encoded records in frames such that both the frame and the
+        response fit in the MCU buffers.
+
+        records: list of encoded records
+        out_lens: number of output bytes of each record
+        max_len: size of the frame buffers of the MCU
+
+        returns a list of (records,out_len) for each frame. Raises a
+        ValueError if a record alone does not fit in a frame.
+    """
+    for i,(record,out_len) in enumerate(zip(records,out_lens)):
+        if 6+len(record) > max_len or 7+out_len > max_len:
+            raise ValueError("Record %d too large for a frame"%(i))
+    frames = []
+    current,size,out = [],6,0
+    for record,out_len in zip(records,out_lens):
+        if size+len(record) > max_len or 7+out+out_len > max_len:
+            frames.append((current,out))
+            current,size,out = [],6,0
+        current.append(record)
+        size += len(record)
+        out += out_len
+    if len(current) > 0:
+        frames.append((current,out))
+    return frames
@@ -0,0 +1,199 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Benchmark of the serial link to the MCU.
+
+For each candidate baudrate, the board is switched to it (see
+SpookTopLevel.configure) and the following is measured:
+    - the round-trip latency of a single encryption of a 16 bytes message
+    - the sustained throughput (bytes/s in both directions) of many
+      encryptions packed in frames
+Every output is checked against the reference implementation. A rate is
+stable if all the repetitions succeed without error. The best stable rate is
+reported and can be passed to SpookTopLevel(...,baudrate=rate).
+
+Without --port, the benchmark runs against the firmware emulated behind a
+pseudo-terminal (see loopback.PtyLoopback):
+
+    python3 interface/serial_bench.py
+    python3 interface/serial_bench.py --port /dev/ttyUSB0 -r 115200,921600,2000000
+"""
+
+import os
+import time
+import numpy as np
+from interface import spook
+from interface.SpookTopLevel import SpookTopLevel,mask
+from interface.protocol import *
+from interface.parameters import *
+
+RATES = [115200,230400,460800,921600,1000000,1500000,2000000,3000000]
+
+def bench_rate(dev,baudrate,key,n_latency=20,n_records=64,msg_len=64,repeat=3):
+    """ measures the link at baudrate.
+
+        dev: SpookTopLevel loaded with the masked key with fixed_key set
+        key: unmasked key used to check the ciphertexts
+        n_latency: number of single round trips
+        n_records: number of encryptions in the throughput test
+        msg_len: message length of the throughput test
+        repeat: number of repetitions of the throughput test
+
+        returns a dictionary with the latency (s), the throughput (bytes/s),
+        and the stability of the rate.
+    """
+    result = {"baudrate":baudrate,"latency":None,"throughput":None,"stable":False}
+    try:
+        dev.configure(baudrate)
+    except (FrameError,ValueError) as e:
+        result["error"] = str(e)
+        return result
+
+    n = bytes(16)
+    m = bytes(range(16))
+    expected = spook.spook_encrypt(b"",m,key,n)
+    records = [([("ad",b""),("m",bytes((i+j)%256 for j in range(msg_len))),("npub",n)],1)
+            for i in range(n_records)]
+    expected_records = [spook.spook_encrypt(b"",f[1][1],key,n) for f,_ in records]
+
+    # bytes on the wire: headers, frame overheads and response overheads
+    encoded = [encode_record(f,op) for f,op in records]
+    frames = split_records(encoded,[msg_len+16]*n_records,dev._frame_max_len)
+    n_bytes = sum(len(r) for r in encoded) + 10*len(frames)
+    n_bytes += sum(out for _,out in frames) + 7*len(frames)
+
+    try:
+        latency = []
+        for _ in range(n_latency):
+            start = time.perf_counter()
+            c = dev.encrypt(b"",m,n)
+            latency.append(time.perf_counter()-start)
+            if c != expected:
+                raise FrameError("Wrong ciphertext")
+
+        throughput = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            outputs = dev.set_records(records)
+            throughput.append(n_bytes/(time.perf_counter()-start))
+            if outputs != expected_records:
+                raise FrameError("Wrong ciphertext")
+    except FrameError as e:
+        result["error"] = str(e)
+        return result
+
+    result["latency"] = np.median(latency)
+    result["throughput"] = np.min(throughput)
+    result["stable"] = True
+    return result
+
+def bench(dev,rates=RATES,**kwargs):
+    """ runs bench_rate for all the rates, in increasing order. It stops at
+        the first unstable rate since the link may be lost afterwards.
+
+        returns the list of results and the best stable result (or None).
+    """
+    key = os.urandom(16)
+    dev.set_data(os.urandom(16),dest="s",enc_flag=0)
+    dev.set_data(np.array([1],dtype=np.uint32).tobytes(),dest="N",enc_flag=0)
+    dev.set_data(np.array([1],dtype=np.uint32).tobytes(),dest="f",enc_flag=0)
+    dev.set_data(mask(key,dev._D),dest="k",enc_flag=0)
+
+    results = []
+    for rate in sorted(rates):
+        results.append(bench_rate(dev,rate,key,**kwargs))
+        if not results[-1]["stable"]:
+            break
+    stable = [r for r in results if r["stable"]]
+    best = max(stable,key=lambda r: r["throughput"]) if len(stable) > 0 else None
+    return results,best
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark of the serial link')
+    parser.add_argument(
+            '-p',
+            '--port',
+            default=None,
+            help='serial port of the board, emulated board if not set'
+            )
+    parser.add_argument(
+            '-r',
+            '--rates',
+            default=",".join(str(r) for r in RATES),
+            help='comma separated baudrates to test'
+            )
+    parser.add_argument(
+            '-n',
+            '--records',
+            default=64,
+            type=int,
+            help='Number of encryptions in the throughput test'
+            )
+    parser.add_argument(
+            '-l',
+            '--length',
+            default=64,
+            type=int,
+            help='Message length in the throughput test'
+            )
+    parser.add_argument(
+            '-t',
+            '--timeout',
+            default=1.0,
+            type=float,
+            help='Read timeout of the serial port (s)'
+            )
+    parser.add_argument(
+            '-d',
+            '--shares',
+            default=D,
+            type=int,
+            help='Number of shares of the target'
+            )
+    args = parser.parse_args()
+
+    loopback = None
+    port = args.port
+    if port is None:
+        from interface.loopback import PtyLoopback
+        loopback = PtyLoopback(args.shares)
+        port = loopback.port
+
+    dev = SpookTopLevel("MCU",PORT=port,D=args.shares,timeout=args.timeout)
+    results,best = bench(dev,[int(r) for r in args.rates.split(",")],
+            n_records=args.records,msg_len=args.length)
+    for r in results:
+        if r["stable"]:
+            print("%8d baud: latency %7.2f ms, throughput %9.0f bytes/s"%(
+                r["baudrate"],1000*r["latency"],r["throughput"]))
+        else:
+            print("%8d baud: unstable (%s)"%(r["baudrate"],r.get("error","")))
+    if best is None:
+        print("No stable rate")
+    else:
+        print("Best stable rate: %d baud"%(best["baudrate"]))
+    dev.close()
+    if loopback is not None:
+        loopback.close()
@@ -0,0 +1,225 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+Incremental SNR of every share of the intermediate variables of the first
+round (sbox and lbox layers) of the masked Clyde, which are the ones within
+the traces (see README.md).
+
+Each variable is a sharing of a 32-bit word, named after its position in
+the round (as the rounds of clyde_encrypt_batch, round r is the layer rho of
+the step s with r = 2*s+rho):
+    round0.sbox.in<i>: input word i of the sbox layer
+    round0.sbox.mult<k>: output of the k-th ISW multiplication
+    round0.sbox.refresh: output of the SNI refresh
+    round0.sbox.out<i>: output word i of the sbox layer
+    round0.lbox.out<i>: output word i of the lbox layer
+Each share is sliced in nibbles (or bytes) which are the classes of the SNR.
+The slices of all the shares are the labels of a single leakage.SNR, hence the
+memory usage is n_vars*n_classes*n_samples floats.
+
+The accumulators are saved with the list of processed files. Hence, the SNR
+is updated with new capture files without reading the previous ones again:
+
+    python3 interface/share_snr.py -o snr_d8.npz d8/random_key/*.npz
+"""
+
+import os
+import numpy as np
+from interface.dataset import Dataset
+from interface.leakage import SNR
+from interface.spook_masked import MaskedClyde,Recorder
+
+def first_round_variables():
+    """ names of the variables of the first round, in the order of
+        first_round_intermediates.
+    """
+    return (["round0.sbox.in%d"%(i) for i in range(4)]
+            + ["round0.sbox.mult%d"%(k) for k in range(4)]
+            + ["round0.sbox.refresh"]
+            + ["round0.sbox.out%d"%(i) for i in range(4)]
+            + ["round0.lbox.out%d"%(i) for i in range(4)])
+
+def first_round_intermediates(clyde,nonces,msk_keys,seeds,variables=None):
+    """ records the variables of the first round (all of them if None)
+        with clyde.trace for Nc encryptions.
+
+        nonces,msk_keys,seeds: (Nc,4), (Nc,4*D) and (Nc,4) inputs
+        output: dictionary mapping each variable to a (D,Nc) sharing
+    """
+    D = clyde.D
+    if variables is None:
+        variables = first_round_variables()
+    rec = Recorder(["%s.share%d"%(v,d) for v in variables for d in range(D)],len(nonces))
+    tweak = np.zeros((4,len(nonces)),dtype=np.uint32)
+    clyde.trace(nonces.T,tweak,msk_keys.T,seeds.T,rec)
+    return {v:np.stack([rec["%s.share%d"%(v,d)] for d in range(D)]) for v in variables}
+
+class ShareSNR:
+    def __init__(self,D,n_samples,variables=None,bits=4,samples=None):
+        """ D: number of shares
+            n_samples: number of samples of the traces
+            variables: names of the variables (see first_round_variables)
+            bits: size of the slices of the shares, 4 (nibbles) or 8 (bytes)
+            samples: indexes of the samples to keep, all of them if None
+
+            The variable v is split in n_slices = 32//bits labels per share.
+            The label of the slice j of the share d has index
+            (v*D+d)*n_slices+j. The statistics are accumulated by a
+            leakage.SNR over all these labels.
+        """
+        if bits not in (4,8):
+            raise ValueError("bits must be 4 or 8, got %d"%(bits))
+        self.D = D
+        self.variables = first_round_variables() if variables is None else list(variables)
+        self.bits = bits
+        self.n_slices = 32//bits
+        self.n_classes = 2**bits
+        n_vars = len(self.variables)*D*self.n_slices
+        self.acc = SNR(n_samples,n_vars=n_vars,n_classes=self.n_classes,samples=samples)
+        self.files = []
+        self._clyde = MaskedClyde(D)
+
+    @property
+    def n(self):
+        return self.acc.n
+
+    @property
+    def samples(self):
+        return self.acc.samples
+
+    def labels(self,nonces,msk_keys,seeds):
+        """ (Nc,n_vars) classes of all the labels.
+        """
+        x = first_round_intermediates(self._clyde,nonces,msk_keys,seeds,self.variables)
+        words = np.stack([x[v] for v in self.variables]) # (n_variables,D,Nc)
+        words = words.reshape(-1,len(nonces))
+        shifts = np.arange(self.n_slices,dtype=np.uint32)*self.bits
+        sliced = (words[:,None,:] >> shifts[None,:,None]) & (self.n_classes-1)
+        return sliced.reshape(-1,len(nonces)).T.astype(np.uint8)
+
+    def update(self,traces,nonces,msk_keys,seeds,var_chunk=64):
+        """ adds the traces of Nc encryptions with their inputs.
+
+            var_chunk: number of labels processed at once (see SNR.update)
+        """
+        self.acc.update(traces,self.labels(nonces,msk_keys,seeds),var_chunk=var_chunk)
+
+    def merge(self,other):
+        """ adds the accumulators of other, computed on other files.
+        """
+        if (other.D,other.bits,other.variables) != (self.D,self.bits,self.variables):
+            raise ValueError("Cannot merge the SNR of other variables")
+        self.acc.merge(other.acc)
+        self.files += [x for x in other.files if x not in self.files]
+
+    def update_files(self,fnames,batch_size=1000):
+        """ adds the traces of the capture files fnames that have not been
+            processed yet.
+        """
+        for fname in fnames:
+            name = os.path.abspath(fname)
+            if name in self.files:
+                continue
+            ds = Dataset([fname])
+            if ds.D != self.D:
+                raise ValueError("%s has %d shares, expected %d"%(fname,ds.D,self.D))
+            for batch in ds.batches(batch_size,["traces","nonces","msk_keys","seeds"]):
+                self.update(batch["traces"],batch["nonces"],batch["msk_keys"],batch["seeds"])
+            self.files.append(name)
+
+    def snr(self,variable=None):
+        """ SNR of the labels, (n_vars,n_samples). If variable is given, only
+            its labels are returned as a (D,n_slices,n_samples) array.
+        """
+        out = self.acc.snr()
+        if variable is None:
+            return out
+        v = self.variables.index(variable)
+        return out.reshape(len(self.variables),self.D,self.n_slices,-1)[v]
+
+    def save(self,fname):
+        """ saves the accumulators to fname (.npz), written atomically.
+        """
+        acc = self.acc
+        tmp = fname+".tmp.npz"
+        np.savez(tmp,D=self.D,bits=self.bits,samples=acc.samples,n=acc.n,
+                shift=acc.shift if acc.shift is not None else np.zeros(0),
+                sq=acc.sq,counts=acc.counts,sums=acc.sums,
+                variables=np.array(self.variables),files=np.array(self.files,dtype=str))
+        os.replace(tmp,fname)
+
+    @classmethod
+    def load(cls,fname):
+        with np.load(fname) as f:
+            out = cls(int(f["D"]),0,variables=[str(x) for x in f["variables"]],
+                    bits=int(f["bits"]),samples=f["samples"])
+            acc = out.acc
+            acc.n = int(f["n"])
+            acc.shift = f["shift"] if acc.n > 0 else None
+            acc.sq,acc.counts,acc.sums = f["sq"],f["counts"],f["sums"]
+            out.files = [str(x) for x in f["files"]]
+        return out
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Per share SNR of the first round variables')
+    parser.add_argument(
+            'fnames',
+            nargs='+',
+            help='capture files'
+            )
+    parser.add_argument(
+            '-o',
+            '--out',
+            default='share_snr.npz',
+            help='file of the accumulators, updated if it exists'
+            )
+    parser.add_argument(
+            '-b',
+            '--bits',
+            default=4,
+            type=int,
+            help='size of the slices of the shares (4 or 8)'
+            )
+    parser.add_argument(
+            '-s',
+            '--samples',
+            default=None,
+            help='start,stop of the samples to keep'
+            )
+    args = parser.parse_args()
+    if os.path.exists(args.out):
+        snr = ShareSNR.load(args.out)
+    else:
+        ds = Dataset(args.fnames[:1])
+        n_samples = ds["traces"].shape[1]
+        samples = None
+        if args.samples is not None:
+            samples = np.arange(*(int(x) for x in args.samples.split(",")))
+        snr = ShareSNR(ds.D,n_samples,bits=args.bits,samples=samples)
+    for fname in args.fnames:
+        snr.update_files([fname])
+        snr.save(args.out)
+        print("%s: %d traces"%(fname,snr.n))
@@ -32,14 +32,25 @@ Usage:
     The variant is selected according to the global constant SMALL_PERM and to
     the length of the input k (16 bytes for 'su' and 32 bytes for 'mu').
 
+    shadow_batch applies the same permutation to many states at once. It takes
+    a (N,4,4) uint32 array ((N,3,4) if SMALL_PERM) and is bit-identical to
+    shadow applied on each of the N states. Similarly, clyde_encrypt_batch and
+    clyde_decrypt_batch process N blocks given as (N,4) uint32 arrays, and
+    spook_encrypt_batch and spook_decrypt_batch process N inputs of the same
+    lengths given as 2D uint8 arrays (one row per input).
+
 Implementation details:
     The LS state matrix is mainly represented as a list of 4 integers, each one
     representing a row (little-endian).  A m-LS state is implemented as a list
     of LS states.
+    In the batch functions, the last axis of the arrays holds the rows of the
+    LS states and the first axis indexes the independent states.
 """
 
 __version__= '2.0'
 
+import numpy as np
+
 SMALL_PERM=False
 N_STEPS=6
 
@@ -298,3 +309,411 @@ def spook_decrypt(ad, c, k, n):
         return m
     else:
         return None
+
+
+###############
+### Batch implementation (numpy)
+###############
+def rotr_batch(x, c):
+    return (x >> np.uint32(c)) | (x << np.uint32(32-c))
+
+def lbox_batch(x, y):
+    a = x ^ rotr_batch(x, 12)
+    b = y ^ rotr_batch(y, 12)
+    a = a ^ rotr_batch(a, 3)
+    b = b ^ rotr_batch(b, 3)
+    a = a ^ rotr_batch(x, 17)
+    b = b ^ rotr_batch(y, 17)
+    c = a ^ rotr_batch(a, 31)
+    d = b ^ rotr_batch(b, 31)
+    a = a ^ rotr_batch(d, 26)
+    b = b ^ rotr_batch(c, 25)
+    a = a ^ rotr_batch(c, 15)
+    b = b ^ rotr_batch(d, 15)
+    return (a, b)
+
+def lbox_inv_batch(x, y):
+    a = x ^ rotr_batch(x, 25)
+    b = y ^ rotr_batch(y, 25)
+    c = x ^ rotr_batch(a, 31)
+    d = y ^ rotr_batch(b, 31)
+    c = c ^ rotr_batch(a, 20)
+    d = d ^ rotr_batch(b, 20)
+    a = c ^ rotr_batch(c, 31)
+    b = d ^ rotr_batch(d, 31)
+    c = c ^ rotr_batch(b, 26)
+    d = d ^ rotr_batch(a, 25)
+    a = a ^ rotr_batch(c, 17)
+    b = b ^ rotr_batch(d, 17)
+    a = rotr_batch(a, 16)
+    b = rotr_batch(b, 16)
+    return (a, b)
+
+def lbox_layer_batch(x):
+    y = np.empty_like(x)
+    y[..., 0], y[..., 1] = lbox_batch(x[..., 0], x[..., 1])
+    y[..., 2], y[..., 3] = lbox_batch(x[..., 2], x[..., 3])
+    return y
+
+def lbox_layer_inv_batch(x):
+    y = np.empty_like(x)
+    y[..., 0], y[..., 1] = lbox_inv_batch(x[..., 0], x[..., 1])
+    y[..., 2], y[..., 3] = lbox_inv_batch(x[..., 2], x[..., 3])
+    return y
+
+def sbox_layer_batch(x):
+    y = np.empty_like(x)
+    y[..., 1] = (x[..., 0] & x[..., 1]) ^ x[..., 2]
+    y[..., 0] = (x[..., 3] & x[..., 0]) ^ x[..., 1]
+    y[..., 3] = (y[..., 1] & x[..., 3]) ^ x[..., 0]
+    y[..., 2] = (y[..., 0] & y[..., 1]) ^ x[..., 3]
+    return y
+
+def sbox_layer_inv_batch(x):
+    y = np.empty_like(x)
+    y[..., 3] = (x[..., 0] & x[..., 1]) ^ x[..., 2]
+    y[..., 0] = (x[..., 1] & y[..., 3]) ^ x[..., 3]
+    y[..., 1] = (y[..., 3] & y[..., 0]) ^ x[..., 0]
+    y[..., 2] = (y[..., 0] & y[..., 1]) ^ x[..., 1]
+    return y
+
+def tweakey_batch(key, tweak):
+    """Returns the (3,N,4) tweakeys for the (N,4) key and tweak arrays."""
+    t = tweak
+    tx0 = t[:, 0] ^ t[:, 2]
+    tx1 = t[:, 1] ^ t[:, 3]
+    tk = np.stack((t,
+        np.stack((tx0, tx1, t[:, 0], t[:, 1]), axis=1),
+        np.stack((t[:, 2], t[:, 3], tx0, tx1), axis=1)))
+    return tk ^ key
+
+RC_BATCH = np.array(RC, dtype=np.uint32)
+
+def _blocks_batch(*blocks):
+    """Broadcasts the blocks to (N,4) uint32 arrays. Also returns True if they
+    are all single (4,) blocks, such that the result is returned as a block."""
+    blocks = np.broadcast_arrays(*(np.asarray(v, dtype=np.uint32) for v in blocks))
+    single = blocks[0].ndim == 1
+    return [np.atleast_2d(v) for v in blocks], single
+
+def clyde_encrypt_batch(m, t, k, rounds=False):
+    """Clyde-128 encryption of N blocks in parallel.
+
+    m, t, k: (N,4) uint32 arrays (or broadcastable to it) with the blocks,
+        tweaks and keys. If they are all (4,) blocks, the outputs are returned
+        without the N axis.
+    rounds: if True, also returns a (N,2*N_STEPS,4) array with the state after
+        each round (i.e. after its constant addition and before the tweakey
+        addition that ends a step).
+
+    returns the (N,4) ciphertexts, bit-identical to clyde_encrypt.
+    """
+    (m, t, k), single = _blocks_batch(m, t, k)
+    tk = tweakey_batch(k, t)
+    x = m ^ tk[0]
+    if rounds:
+        trace = np.zeros((len(x), 2*N_STEPS, 4), dtype=np.uint32)
+    for s in range(N_STEPS):
+        for rho in range(2):
+            r = 2*s+rho
+            x = sbox_layer_batch(x)
+            x = lbox_layer_batch(x)
+            x ^= RC_BATCH[r]
+            if rounds:
+                trace[:, r] = x
+        x ^= tk[(s+1)%3]
+    if single:
+        x = x[0]
+        if rounds:
+            trace = trace[0]
+    if rounds:
+        return x, trace
+    return x
+
+def clyde_decrypt_batch(c, t, k, rounds=False):
+    """Clyde-128 decryption of N blocks in parallel.
+
+    c, t, k: (N,4) uint32 arrays (or broadcastable to it) with the ciphertexts,
+        tweaks and keys. If they are all (4,) blocks, the outputs are returned
+        without the N axis.
+    rounds: if True, also returns a (N,2*N_STEPS,4) array where entry r is the
+        state after inverting round r (i.e. after its inverse sbox layer).
+
+    returns the (N,4) plaintexts, bit-identical to clyde_decrypt.
+    """
+    (c, t, k), single = _blocks_batch(c, t, k)
+    tk = tweakey_batch(k, t)
+    x = c.copy()
+    if rounds:
+        trace = np.zeros((len(x), 2*N_STEPS, 4), dtype=np.uint32)
+    for s in reversed(range(N_STEPS)):
+        x ^= tk[(s+1)%3]
+        for rho in reversed(range(2)):
+            r = 2*s+rho
+            x ^= RC_BATCH[r]
+            x = lbox_layer_inv_batch(x)
+            x = sbox_layer_inv_batch(x)
+            if rounds:
+                trace[:, r] = x
+    x ^= tk[0]
+    if single:
+        x = x[0]
+        if rounds:
+            trace = trace[0]
+    if rounds:
+        return x, trace
+    return x
+
+def xtime_batch(x):
+    b = x >> np.uint32(31)
+    return (x << np.uint32(1)) ^ b ^ (b << np.uint32(8))
+
+def dbox_batch(x):
+    if SMALL_PERM:
+        a = x[:, 0] ^ x[:, 1]
+        b = x[:, 0] ^ x[:, 2]
+        c = x[:, 1] ^ b
+        d = a ^ xtime_batch(b)
+        return np.stack((b ^ d, c, d), axis=1)
+    else:
+        y0 = x[:, 0] ^ x[:, 1]
+        y2 = x[:, 2] ^ x[:, 3]
+        y1 = x[:, 1] ^ y2
+        y3 = x[:, 3] ^ xtime_batch(y0)
+        y1 = xtime_batch(y1)
+        y0 = y0 ^ y1
+        y2 = y2 ^ xtime_batch(y3)
+        y1 = y1 ^ y2
+        y3 = y3 ^ y0
+        return np.stack((y0, y1, y2, y3), axis=1)
+
+def shadow_lfsr_constants(n_ls):
+    """Constants added by shadow on a m-LS state with n_ls LS states.
+
+    Returns a (N_STEPS,n_ls) table for the row SHADOW_RA_CST_ROW of each LS
+    state and a (N_STEPS,4) table for the rows of the first LS state.
+    """
+    lfsr = CST_LFSR_INIT_VALUE
+    cst_ls = np.zeros((N_STEPS, n_ls), dtype=np.uint32)
+    cst_rows = np.zeros((N_STEPS, 4), dtype=np.uint32)
+    for s in range(N_STEPS):
+        for i in range(n_ls):
+            cst_ls[s, i] = lfsr
+            lfsr = update_lfsr(lfsr)
+        for i in range(4):
+            cst_rows[s, i] = lfsr
+            lfsr = update_lfsr(lfsr)
+    return cst_ls, cst_rows
+
+def shadow_batch(x):
+    """Shadow permutation applied on N states in parallel.
+
+    x: (N,4,4) uint32 array ((N,3,4) if SMALL_PERM) where x[n] is the m-LS
+        state of the n-th permutation.
+
+    returns a new (N,4,4) uint32 array, bit-identical to shadow(x[n]).
+    """
+    x = np.array(x, dtype=np.uint32)
+    cst_ls, cst_rows = shadow_lfsr_constants(3 if SMALL_PERM else 4)
+    assert x.ndim == 3 and x.shape[1:] == (len(cst_ls[0]), 4)
+    for s in range(N_STEPS):
+        x = lbox_layer_batch(sbox_layer_batch(x))
+        x[:, :, SHADOW_RA_CST_ROW] ^= cst_ls[s]
+        x = sbox_layer_batch(x)
+        x = dbox_batch(x)
+        x[:, 0, :] ^= cst_rows[s]
+    return x
+
+def bytes2state_batch(x):
+    """Converts a (N,16*L) uint8 array to (N,L,4) uint32 LS states."""
+    x = np.ascontiguousarray(x, dtype=np.uint8)
+    return x.view('<u4').reshape(len(x), -1, 4).astype(np.uint32)
+
+def state2bytes_batch(x):
+    """Converts a (N,L,4) (or (N,4)) uint32 array to (N,16*L) uint8 bytes."""
+    x = np.ascontiguousarray(x, dtype='<u4')
+    return x.view(np.uint8).reshape(len(x), -1)
+
+def init_sponge_state_batch(k, n):
+    k = np.asarray(k, dtype=np.uint8)
+    n = bytes2state_batch(n)[:, 0]
+    if k.shape[1] == 32:
+        # mu variant
+        p = k[:, 16:].copy()
+        p[:, -1] &= 0x7F
+        p[:, -1] |= 0x40
+        p = bytes2state_batch(p)[:, 0]
+    else:
+        assert k.shape[1] == 16
+        p = np.zeros_like(n)
+    b = clyde_encrypt_batch(n, p, bytes2state_batch(k[:, :16])[:, 0])
+    if SMALL_PERM:
+        x = np.stack((b, p, n), axis=1)
+    else:
+        x = np.stack((b, p, n, np.zeros_like(n)), axis=1)
+    return shadow_batch(x)
+
+def compress_data_batch(x, data, mode='ENC'):
+    n_ls = BLOCK_SIZE()//LS_SIZE
+    res = np.zeros(data.shape, dtype=np.uint8)
+    for start in range(0, data.shape[1], BLOCK_SIZE()):
+        block = data[:, start:start+BLOCK_SIZE()]
+        nbytes = block.shape[1]
+        pad = nbytes < BLOCK_SIZE()
+        if pad:
+            pb = np.zeros((len(x), BLOCK_SIZE()), dtype=np.uint8)
+            pb[:, :nbytes] = block
+            pb[:, nbytes] = 0x01
+        else:
+            pb = block
+        xb = state2bytes_batch(x[:, :n_ls])
+        r = xb ^ pb
+        if mode == 'ENC':
+            x_bytes = r
+        elif mode == 'DEC':
+            x_bytes = xb.copy()
+            x_bytes[:, :nbytes] = block
+            if pad:
+                x_bytes[:, nbytes] ^= 0x01
+        x[:, :n_ls] = bytes2state_batch(x_bytes)
+        res[:, start:start+nbytes] = r[:, :nbytes]
+        if pad:
+            x[:, -2, 0] ^= 0x2
+        x = shadow_batch(x)
+    return x, res
+
+def spook_encrypt_batch(ad, m, k, n):
+    """Spook encryption of N inputs in parallel.
+
+    ad, m: (N,l_ad) and (N,l_m) uint8 arrays (all the inputs of a batch have
+        the same lengths).
+    k, n: (N,16) (or (N,32) for the mu variant) keys and (N,16) nonces as
+        uint8 arrays.
+
+    returns the (N,l_m+16) ciphertexts, identical to spook_encrypt.
+    """
+    ad, m = (np.asarray(v, dtype=np.uint8).reshape(len(n), -1) for v in (ad, m))
+    key = bytes2state_batch(np.asarray(k, dtype=np.uint8)[:, :16])[:, 0]
+    x = init_sponge_state_batch(k, n)
+    x, _ = compress_data_batch(x, ad)
+    if m.shape[1] > 0:
+        x[:, -2, 0] ^= 0x1
+        x, c = compress_data_batch(x, m)
+    else:
+        c = m
+    x[:, 1, 3] |= 0x80000000
+    tag = state2bytes_batch(clyde_encrypt_batch(x[:, 0], x[:, 1], key))
+    return np.concatenate((c, tag), axis=1)
+
+def spook_decrypt_batch(ad, c, k, n):
+    """Spook decryption of N inputs in parallel, see spook_encrypt_batch.
+
+    returns the (N,l_c-16) plaintexts and a (N,) boolean array telling which
+    tags are valid. spook_decrypt returns None for the invalid ones.
+    """
+    ad, c = (np.asarray(v, dtype=np.uint8).reshape(len(n), -1) for v in (ad, c))
+    key = bytes2state_batch(np.asarray(k, dtype=np.uint8)[:, :16])[:, 0]
+    x = init_sponge_state_batch(k, n)
+    x, _ = compress_data_batch(x, ad)
+    if c.shape[1] > LS_SIZE:
+        x[:, -2, 0] ^= 0x1
+        x, m = compress_data_batch(x, c[:, :-LS_SIZE], mode='DEC')
+    else:
+        m = np.zeros((len(c), 0), dtype=np.uint8)
+    x[:, 1, 3] |= 0x80000000
+    tag = state2bytes_batch(clyde_encrypt_batch(x[:, 0], x[:, 1], key))
+    return m, np.all(tag == c[:, -LS_SIZE:], axis=1)
+
+
+###############
+### Packed implementation
+###############
+# The rows of index r of all the LS states of a m-LS state are packed in a
+# single integer (LS state i in bits 32*i to 32*i+31). The sbox and lbox layers
+# then process all the LS states at once, which makes a single Shadow about
+# twice faster than shadow. It is used for long chains of permutations.
+
+def _packed_constants(n_ls):
+    lanes = lambda v: sum(v << (32*i) for i in range(n_ls))
+    rot = {}
+    for c in (3, 12, 15, 17, 25, 26, 31):
+        lo = lanes(0xFFFFFFFF >> c)
+        rot[c] = (lo, lanes(0xFFFFFFFF) ^ lo)
+    cst_ls, cst_rows = shadow_lfsr_constants(n_ls)
+    cst_ls = [lanes(0) ^ sum(int(cst_ls[s, i]) << (32*i) for i in range(n_ls))
+            for s in range(N_STEPS)]
+    return rot, cst_ls, [[int(v) for v in r] for r in cst_rows]
+
+_PACKED_CONSTANTS = {}
+
+def pack_state(x):
+    """Packs a m-LS state (list of LS states) in 4 integers, one per row."""
+    return [sum(int(xi[r]) << (32*i) for i, xi in enumerate(x)) for r in range(4)]
+
+def unpack_state(x, n_ls):
+    """Inverse of pack_state, returns the list of the n_ls LS states."""
+    return [[(x[r] >> (32*i)) & 0xFFFFFFFF for r in range(4)] for i in range(n_ls)]
+
+def _dbox_lanes(v, n_ls):
+    # dbox on the lanes of a packed row
+    x = [(v >> (32*i)) & 0xFFFFFFFF for i in range(n_ls)]
+    if n_ls == 3:
+        a = x[0] ^ x[1]
+        b = x[0] ^ x[2]
+        c = x[1] ^ b
+        d = a ^ xtime(b)
+        return (b ^ d) | (c << 32) | (d << 64)
+    y0 = x[0] ^ x[1]
+    y2 = x[2] ^ x[3]
+    y1 = x[1] ^ y2
+    y3 = x[3] ^ xtime(y0)
+    y1 = xtime(y1)
+    y0 ^= y1
+    y2 ^= xtime(y3)
+    y1 ^= y2
+    y3 ^= y0
+    return y0 | (y1 << 32) | (y2 << 64) | (y3 << 96)
+
+def shadow_packed(x):
+    """Shadow on a packed state (see pack_state), bit-identical to shadow."""
+    n_ls = 3 if SMALL_PERM else 4
+    if n_ls not in _PACKED_CONSTANTS:
+        _PACKED_CONSTANTS[n_ls] = _packed_constants(n_ls)
+    rot, cst_ls, cst_rows = _PACKED_CONSTANTS[n_ls]
+
+    def rotr(v, c):
+        lo, hi = rot[c]
+        return ((v >> c) & lo) | ((v << (32-c)) & hi)
+
+    def lbox(x, y):
+        a = x ^ rotr(x, 12)
+        b = y ^ rotr(y, 12)
+        a = a ^ rotr(a, 3)
+        b = b ^ rotr(b, 3)
+        a = a ^ rotr(x, 17)
+        b = b ^ rotr(y, 17)
+        c = a ^ rotr(a, 31)
+        d = b ^ rotr(b, 31)
+        a = a ^ rotr(d, 26)
+        b = b ^ rotr(c, 25)
+        a = a ^ rotr(c, 15)
+        b = b ^ rotr(d, 15)
+        return a, b
+
+    def sbox(x0, x1, x2, x3):
+        y1 = (x0 & x1) ^ x2
+        y0 = (x3 & x0) ^ x1
+        y3 = (y1 & x3) ^ x0
+        y2 = (y0 & y1) ^ x3
+        return y0, y1, y2, y3
+
+    x0, x1, x2, x3 = x
+    for s in range(N_STEPS):
+        y0, y1, y2, y3 = sbox(x0, x1, x2, x3)
+        x0, x1 = lbox(y0, y1)
+        x2, x3 = lbox(y2, y3)
+        x1 ^= cst_ls[s]
+        # dbox mixes the LS states, hence the lanes of each row
+        rows = sbox(x0, x1, x2, x3)
+        x0, x1, x2, x3 = (_dbox_lanes(v, n_ls) ^ cst_rows[s][r] for r, v in enumerate(rows))
+    return [x0, x1, x2, x3]
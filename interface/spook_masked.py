@@ -27,187 +27,501 @@ Clyde execution. It takes as inputs key shares, PRNG state and a plaintext.
 
 It reimplements to on board functions in embedded_src/spook_masked/ which
 are actually used by the MCU.
+
+The simulation is implemented by the MaskedClyde class. Each instance has its
+own number of shares D and each call derives its own PRNG tape, such that
+multiple simulations can run concurrently within the same process.
+
+The intermediate variables are recorded during a simulation with a Recorder.
+The probes are named after the variable and the share (or random word) such as
+    round<r>.sbox.in<i>.share<d>: input word i of the sbox layer of round r
+    round<r>.sbox.mult<k>.share<d>: output of the k-th ISW multiplication
+    round<r>.sbox.mult<k>.s<p>: random word of the p-th pair (i,j) with i<j of
+        the multiplication, in the order used by the MCU
+    round<r>.sbox.mult<k>.sp<p>: (a[i]&b[j]) ^ s ^ (a[j]&b[i]) of the p-th pair
+    round<r>.sbox.refresh.share<d>: output of the SNI refresh (even rounds)
+    round<r>.sbox.refresh.r<p>: p-th random word used by the SNI refresh
+    round<r>.sbox.out<i>.share<d>: output word i of the sbox layer
+    round<r>.lbox.out<i>.share<d>: output word i of the lbox layer
+where the round r = 2*s+rho is the layer rho of the step s as in
+spook.clyde_encrypt_batch. As an example,
+
+    rec = Recorder(["round0.sbox.mult2.share3","round0.sbox.mult2.s0"],Nc)
+    clyde128_encrypt_masked(state,t,key,seed,Nr=1,step=0,recorder=rec)
+    rec["round0.sbox.mult2.share3"] # (Nc,) uint32
 """
 
 import numpy as np
 from interface.parameters import D
-from interface.utils import get_random_tape,umask
+from interface.utils import random_tape,RandomTape,umask
 bor = np.bitwise_or
 bxor = np.bitwise_xor
 band = np.bitwise_and
 
-seed_tmp = None
-
-def clyde128_encrypt_masked(state,t,key,seed,Nr=6,step=2):
+def clyde128_encrypt_masked(state,t,key,seed,Nr=6,step=2,cache=None,D=D,recorder=None):
     """
         This function simulates the behavior of
         multiple executions of Nc masked clyde128
+        with D shares (by default, the one from parameters.py).
 
-        inputs:
-            - state (4,Nc) matrix with each column being a plaintext of an execution
-            - t (4,Nc) matrix with each column being a tweak of an execution
-            - key ((4*D),Nc)  matrix with each column being a masked key of an execution
-            - seed (4,Ns) with each column being the state of the PRNG seed at the beginning of the encryption
-
-            - Nr: number of rounds to simulate
-            - step: on what step to stop
-
-        output:
-            - (Nc,4*D) where each column is the masked state of the corresponding inputs.
-
-    """
-    global seed_tmp
-    seed_tmp = seed
-    tk = np.array([[t[0],t[1],t[2],t[3]],
-            [t[0]^t[2],t[1]^t[3],t[0],t[1]],
-            [t[2],t[3],t[0]^t[2],t[1]^t[3]]],dtype=np.uint32)
-    masked_state = key.copy()
-    XORLS_MASK(masked_state,tk[0])
-    XORLS_MASK(masked_state,state)
-    off = 0x924
-    lfsr = 0x8
-    for s in range(0,Nr):
-        sbox_layer_masked(masked_state[0:D],
-                masked_state[D:D*2],
-                masked_state[D*2:D*3],
-                masked_state[D*3:D*4],refresh_flag=1)
-        if s == (Nr-1) and step == 0:
-            return masked_state.T
-        lbox_masked(masked_state)
-        XORCST_MASK(masked_state,lfsr)
-        b = lfsr & 0x1;
-        lfsr = (lfsr^(b<<3) | b<<4)>>1;	# update LFSR
-        sbox_layer_masked(masked_state[0:D],
-                masked_state[D:D*2],
-                masked_state[D*2:D*3],
-                masked_state[D*3:D*4])
-        if s == (Nr-1) and step == 1:
-            return masked_state.T
-        lbox_masked(masked_state)
-        XORCST_MASK(masked_state,lfsr)
-        b = lfsr & 0x1;
-        lfsr = (lfsr^(b<<3) | b<<4)>>1;	# update LFSR
-        off = off>>2
-
-        masked_state ^= key
-        XORLS_MASK(masked_state,tk[off&0x3])
-    return masked_state.T
-
-###############
-### Various operation used by Clyde (see C code for more detailed)
-###############
-def XORLS_MASK(DEST,OP):
+        See MaskedClyde.encrypt for the inputs and outputs.
     """
-        Performs addition of the unmaksed value OP
-        with the shared DEST
-    """
-    DEST[0,:] ^= OP[0];
-    DEST[1*D,:] ^= OP[1];
-    DEST[2*D,:] ^= OP[2];
-    DEST[3*D,:] ^= OP[3];
+    return MaskedClyde(D,cache=cache).encrypt(state,t,key,seed,Nr=Nr,step=step,recorder=recorder)
 
-def XORCST_MASK(DEST,LFSR):
+def clyde128_trace_masked(state,t,key,seed,recorder,cache=None,D=D):
     """
-        Performs round constant addition
-        within the masked state
+        records the probes of recorder by simulating only the part of
+        the Nc masked clyde128 executions they depend on.
+
+        See MaskedClyde.trace.
     """
-    DEST[0] ^= (LFSR>>3) & 0x1;
-    DEST[D] ^= (LFSR>>2) & 0x1;
-    DEST[2*D] ^= (LFSR>>1) & 0x1;
-    DEST[3*D] ^= (LFSR>>0) & 0x1;
+    return MaskedClyde(D,cache=cache).trace(state,t,key,seed,recorder)
 
-def add_shares(out,a,b):
+def n_random_words(Nr=6,step=2,D=D):
     """
-        Performs addition between two sharing a and b
-        and store the result in out.
+        number of random words used by clyde128_encrypt_masked
+        with the same Nr, step and D parameters.
     """
-    for i in range(0,D):
-        out[i] = a[i] ^ b[i]
+    return MaskedClyde(D).n_random_words(Nr,step)
 
-def add_clyde128_masked_state(out,a,b):
+def prng_offset(s,layer=0,D=D):
     """
-        Performs addition of two Clyde states and store
-        the result in out.
+        index in the PRNG tape of the first random word used by
+        the sbox layer (0 or 1) of the round s with D shares.
     """
-    for d in range(D):
+    return MaskedClyde(D).prng_offset(s,layer)
+
+class Recorder:
+    def __init__(self,probes,n_traces=None):
+        """
+            Intermediate variables recorded by MaskedClyde.encrypt.
+
+            probes: list of probe names (see the top of this file), or
+                dictionary mapping each probe name to the (n_traces,) array
+                where it is written (e.g. a memory map)
+            n_traces: number of traces of the arrays allocated for a list
+
+            Successive calls to encrypt write their Nc traces in the next
+            rows of the arrays, starting at row start. Only the probes are
+            stored, the other variables are not copied.
+        """
+        if isinstance(probes,dict):
+            self.arrays = dict(probes)
+        else:
+            self.arrays = {p:np.zeros(n_traces,dtype=np.uint32) for p in probes}
+        self.start = 0
+        self.recorded = set()
+
+        # (variable,part) -> [(index,probe)]
+        self._wanted = {}
+        for p in self.arrays:
+            var,_,last = p.rpartition(".")
+            part = last.rstrip("0123456789")
+            if var == "" or part == last:
+                raise ValueError("Bad probe name %s"%(p))
+            self._wanted.setdefault((var,part),[]).append((int(last[len(part):]),p))
+
+    def __getitem__(self,probe):
+        return self.arrays[probe]
+
+    def wants(self,var,part="share"):
+        return (var,part) in self._wanted
+
+    def record(self,var,x,part="share"):
+        """
+            stores the requested elements of x, a (l,Nc) matrix (e.g., the
+            D shares of var).
+        """
+        for i,p in self._wanted.get((var,part),()):
+            self.arrays[p][self.start:self.start+len(x[i])] = x[i]
+            self.recorded.add(p)
+
+    def check(self):
+        """
+            raises an exception if some probes have never been recorded
+            (e.g., misspelled or beyond the simulated rounds).
+        """
+        missing = sorted(set(self.arrays)-self.recorded)
+        if len(missing) > 0:
+            raise ValueError("Probes not recorded: %s"%(", ".join(missing)))
+
+class MaskedClyde:
+    def __init__(self,D=D,cache=None):
+        """
+            Simulator of the masked Clyde implementation of the MCU.
+
+            D: number of shares
+            cache: optional TapeCache used to derive the PRNG randomness
+
+            An instance does not store any state related to an encryption.
+            The randomness of an encryption is a RandomTape passed to all
+            the gadgets. Hence, the same instance can be used by multiple threads.
+        """
+        if D > 8:
+            raise Exception("SNI refresh is not implemented for D = %d, max D=8"%(D))
+        self.D = D
+        self.cache = cache
+
+        # share pairs (i,j) with i<j of the ISW multiplication in the order
+        # they consume randomness, and the pairs involving each share.
+        self._pair_i,self._pair_j = np.triu_indices(D,1)
+        self._pairs_of_i = [np.flatnonzero(self._pair_i==i) for i in range(D)]
+        self._pairs_of_j = [np.flatnonzero(self._pair_j==j) for j in range(D)]
+
+    def encrypt(self,state,t,key,seed,Nr=6,step=2,recorder=None):
+        """
+            This function simulates the behavior of
+            multiple executions of Nc masked clyde128
+
+            inputs:
+                - state (4,Nc) matrix with each column being a plaintext of an execution
+                - t (4,Nc) matrix with each column being a tweak of an execution
+                - key ((4*D),Nc)  matrix with each column being a masked key of an execution
+                - seed (4,Ns) with each column being the state of the PRNG seed at the beginning of the encryption
+
+                - Nr: number of rounds to simulate
+                - step: on what step to stop
+                - recorder: optional Recorder storing intermediate variables
+
+            output:
+                - (Nc,4*D) where each column is the masked state of the corresponding inputs.
+
+        """
+        r_stop = None if step == 2 else 2*(Nr-1)+step
+        out = self._encrypt(state,t,key,seed,self.n_random_words(Nr,step),Nr,r_stop,recorder)
+        if recorder is not None:
+            recorder.start += len(out)
+        return out
+
+    def trace(self,state,t,key,seed,recorder):
+        """
+            records the probes of recorder for Nc executions (same inputs as
+            encrypt). Only the dependency cone of the probes is simulated:
+            the simulation stops after the last round with a probe and, in
+            that round, only the ISW multiplications needed by a probe are
+            computed. The PRNG tape ends with the last random word used
+            and the words of the skipped multiplications are not read.
+        """
+        r_stop,mults,lbox = self.cone(recorder)
+        s,rho = divmod(r_stop,2)
+        n_words = self.prng_offset(s,rho)+self.layer_words(mults,refresh_flag=rho==0)
+        self._encrypt(state,t,key,seed,n_words,s+1,r_stop,recorder,mults=mults,lbox=lbox)
+        recorder.start += len(state[0])
+        return recorder
+
+    # ISW multiplications needed by each variable of a layer (see sbox_layer_masked)
+    CONE = {"sbox.in":(),"sbox.mult0":(0,),"sbox.mult1":(1,),"sbox.mult2":(0,2),
+            "sbox.mult3":(0,1,3),"sbox.refresh":(0,),"sbox.out0":(1,),"sbox.out1":(0,),
+            "sbox.out2":(0,1,3),"sbox.out3":(0,2),"lbox.out0":(0,1),"lbox.out1":(0,1),
+            "lbox.out2":(0,1,2,3),"lbox.out3":(0,1,2,3)}
+
+    def cone(self,recorder):
+        """
+            returns (r,mults,lbox) where r is the last round with a probe
+            of recorder, mults the ISW multiplications of its sbox layer
+            needed by the probes and lbox if its lbox layer is needed.
+        """
+        rounds = {}
+        for var,_ in recorder._wanted:
+            parts = var.split(".")
+            key = None
+            if len(parts) == 3 and parts[0][:5] == "round" and parts[0][5:].isdigit():
+                name = "in" if parts[2][:2] == "in" else parts[2]
+                key = "%s.%s"%(parts[1],name)
+            if key not in self.CONE:
+                raise ValueError("Unknown variable %s"%(var))
+            rounds.setdefault(int(parts[0][5:]),[]).append(key)
+        if len(rounds) == 0:
+            raise ValueError("No probe to record")
+        r = max(rounds)
+        mults = set()
+        for key in rounds[r]:
+            mults.update(self.CONE[key])
+        lbox = any(key.startswith("lbox") for key in rounds[r])
+        return r,mults,lbox
+
+    def layer_words(self,mults=None,refresh_flag=0):
+        """
+            number of random words read by an sbox layer computing only the
+            ISW multiplications in mults (all of them if None).
+        """
+        if mults is None:
+            mults = range(4)
+        pos = self.mult_offsets(refresh_flag)
+        end = max([pos[k]+len(self._pair_i) for k in mults],default=0)
+        if refresh_flag and 0 in mults:
+            end = max(end,len(self._pair_i)+self.refresh_words())
+        return end
+
+    def mult_offsets(self,refresh_flag=0):
+        """
+            offsets of the random words of the four ISW multiplications within
+            the randomness of an sbox layer. The refresh follows the first one.
+        """
+        M = len(self._pair_i)
+        R = self.refresh_words() if refresh_flag else 0
+        return [0,M+R,2*M+R,3*M+R]
+
+    def _encrypt(self,state,t,key,seed,n_words,Nr,r_stop,rec,mults=None,lbox=False):
+        """
+            runs the Nr steps, or stops after the sbox layer of round r_stop
+            (and its lbox layer if lbox). mults are the ISW multiplications
+            of the last sbox layer to compute.
+        """
+        D = self.D
+        if self.cache is None:
+            tape = RandomTape(random_tape(seed,n_words))
+        else:
+            tape = RandomTape(self.cache.random_tape(seed,n_words))
+        tk = np.array([[t[0],t[1],t[2],t[3]],
+                [t[0]^t[2],t[1]^t[3],t[0],t[1]],
+                [t[2],t[3],t[0]^t[2],t[1]^t[3]]],dtype=np.uint32)
+        masked_state = key.copy()
+        self.XORLS_MASK(masked_state,tk[0])
+        self.XORLS_MASK(masked_state,state)
+        off = 0x924
+        lfsr = 0x8
+        for s in range(0,Nr):
+            for rho in range(2):
+                r = 2*s+rho
+                last = r == r_stop
+                self.sbox_layer_masked(masked_state[0:D],
+                        masked_state[D:D*2],
+                        masked_state[D*2:D*3],
+                        masked_state[D*3:D*4],tape,refresh_flag=1-rho,
+                        rec=rec,name="round%d.sbox"%(r),
+                        mults=mults if last else None)
+                if last and not lbox:
+                    return masked_state.T
+                self.lbox_masked(masked_state)
+                if rec is not None:
+                    self.record_state(rec,"round%d.lbox"%(r),masked_state)
+                if last:
+                    return masked_state.T
+                self.XORCST_MASK(masked_state,lfsr)
+                b = lfsr & 0x1;
+                lfsr = (lfsr^(b<<3) | b<<4)>>1;	# update LFSR
+            off = off>>2
+
+            masked_state ^= key
+            self.XORLS_MASK(masked_state,tk[off&0x3])
+        return masked_state.T
+
+    ###############
+    ### Position of the randomness within the PRNG tape
+    ###############
+    def refresh_words(self):
+        """
+            number of random words used by one SNI refresh
+        """
+        if self.D < 4:
+            return self.D
+        return 2*self.D
+
+    def prng_offset(self,s,layer=0):
+        """
+            index in the PRNG tape of the first random word used by
+            the sbox layer (0 or 1) of the round s. Each round
+            consumes 4 ISW multiplications and a refresh in the first
+            sbox layer and 4 ISW multiplications in the second one.
+        """
+        mult = self.D*(self.D-1)//2
+        return s*(8*mult + self.refresh_words()) + layer*(4*mult + self.refresh_words())
+
+    def n_random_words(self,Nr=6,step=2):
+        """
+            number of random words used by encrypt
+            with the same Nr and step parameters.
+        """
+        if step == 0:
+            return self.prng_offset(Nr-1,1)
+        return self.prng_offset(Nr,0)
+
+    ###############
+    ### Various operation used by Clyde (see C code for more detailed)
+    ###############
+    def XORLS_MASK(self,DEST,OP):
+        """
+            Performs addition of the unmaksed value OP
+            with the shared DEST
+        """
+        D = self.D
+        DEST[0,:] ^= OP[0];
+        DEST[1*D,:] ^= OP[1];
+        DEST[2*D,:] ^= OP[2];
+        DEST[3*D,:] ^= OP[3];
+
+    def XORCST_MASK(self,DEST,LFSR):
+        """
+            Performs round constant addition
+            within the masked state
+        """
+        D = self.D
+        DEST[0] ^= (LFSR>>3) & 0x1;
+        DEST[D] ^= (LFSR>>2) & 0x1;
+        DEST[2*D] ^= (LFSR>>1) & 0x1;
+        DEST[3*D] ^= (LFSR>>0) & 0x1;
+
+    def add_shares(self,out,a,b):
+        """
+            Performs addition between two sharing a and b
+            and store the result in out.
+        """
+        for i in range(0,self.D):
+            out[i] = a[i] ^ b[i]
+
+    def add_clyde128_masked_state(self,out,a,b):
+        """
+            Performs addition of two Clyde states and store
+            the result in out.
+        """
+        D = self.D
+        for d in range(D):
+            for i in range(4):
+                j = (i*D)+d
+                out[j] = a[j] ^ b[j]
+
+    def record_state(self,rec,name,masked_state):
+        """
+            records the four words of a masked state as name.out<i>
+        """
+        D = self.D
         for i in range(4):
-            j = (i*D)+d
-            out[j] = a[j] ^ b[j]
+            rec.record("%s.out%d"%(name,i),masked_state[i*D:(i+1)*D])
 
-def refresh(shares):
-    """
-        Performs SNI refresh on the sharing it is implemented
-        up to 8 shares
-    """
-    if D < 4:
-        refresh_block_j(shares,1)
-    elif D<9:
-        refresh_block_j(shares,1)
-        refresh_block_j(shares,3)
-    else:
-        raise Exception("SNI refresh is not implemented for D = %d, max D=8"%(D))
-
-def refresh_block_j(shares,j):
-    global seed_tmp
-    for i in range(D):
-        r,seed_tmp = get_random_tape(seed_tmp,1)
-        shares[i] ^= r[0];
-        shares[(i+j)%D] ^= r[0]
-
-def mult_shares(out,a,b):
-    """
-        performs ISW multiplication on two sharings a and b.
-        Stores the result in out.
-        Takes randomness from the prng state seed_tmp.
-    """
-    global seed_tmp
+    def refresh(self,shares,tape,rec=None,name=None):
+        """
+            Performs SNI refresh on the sharing it is implemented
+            up to 8 shares
+        """
+        offset = tape.offset
+        if self.D < 4:
+            self.refresh_block_j(shares,1,tape)
+        else:
+            self.refresh_block_j(shares,1,tape)
+            self.refresh_block_j(shares,3,tape)
+        if rec is not None:
+            rec.record(name,tape.tape[offset:tape.offset],"r")
+            rec.record(name,shares)
 
-    for i in range(D):
-        out[i,:] = a[i,:] & b[i,:]
+    def refresh_block_j(self,shares,j,tape):
+        """
+            Adds the random word i to the shares i and (i+j)%D
+            for all the D shares at once.
+        """
+        r = tape.get(self.D)
+        shares ^= r
+        shares ^= np.roll(r,j,axis=0)
 
-    for i in range(D):
-        for j in range(i+1,D):
-            rng,seed_tmp = get_random_tape(seed_tmp,1)
-            s = rng[0,:]
-            tmp = (a[i,:]&b[j,:])^s
-            sp = tmp ^ (a[j,:]&b[i,:])
-            out[i,:] ^= s
-            out[j,:] ^= sp
+    def mult_shares(self,out,a,b,tape,rec=None,name=None):
+        """
+            performs ISW multiplication on two sharings a and b.
+            Stores the result in out.
+            Takes randomness from the random tape.
+
+            All the pairs (i,j) with i<j are processed at once. The random
+            word s of pair (i,j) is added to out[i] and sp to out[j] where
+                s = tape word, consumed in the same order as in the MCU
+                sp = (a[i]&b[j]) ^ s ^ (a[j]&b[i])
+        """
+        I,J = self._pair_i,self._pair_j
+        s = tape.get(len(I))
+        sp = (a[I]&b[J]) ^ s ^ (a[J]&b[I])
+        out[:] = a & b
+        for i in range(self.D):
+            out[i] ^= bxor.reduce(s[self._pairs_of_i[i]],axis=0)
+            out[i] ^= bxor.reduce(sp[self._pairs_of_j[i]],axis=0)
+        if rec is not None:
+            rec.record(name,s,"s")
+            rec.record(name,sp,"sp")
+            rec.record(name,out)
+
+    def sbox_layer_masked(self,a,b,c,d,tape,refresh_flag=0,rec=None,name=None,mults=None):
+        """
+            Applies inplace sbox to the inputs sharings a,b,c,d
+            if refresh_flag, a refresh is inserted after the
+            first XOR of the Sbox according to Tornado tool.
+
+            rec,name: optional Recorder and name of the layer (e.g. round0.sbox)
+            mults: indexes of the ISW multiplications to compute, all if None.
+                The outputs depending on a skipped one are not valid.
+        """
+        if mults is not None:
+            return self._partial_sbox_layer(a,b,c,d,tape,refresh_flag,rec,name,mults)
+        y0 = np.zeros(a.shape,dtype=np.uint32)
+        y1 = np.zeros(a.shape,dtype=np.uint32)
+        y3 = np.zeros(a.shape,dtype=np.uint32)
+        tmp = np.zeros(a.shape,dtype=np.uint32)
+        if rec is not None:
+            for i,x in enumerate((a,b,c,d)):
+                rec.record("%s.in%d"%(name,i),x)
+            mult = ["%s.mult%d"%(name,k) for k in range(4)]
+        else:
+            mult = [None]*4
+
+        self.mult_shares(tmp,a,b,tape,rec,mult[0]);
+        y1[:] = tmp ^ c
+        if refresh_flag:
+            self.refresh(y1,tape,rec,None if rec is None else name+".refresh")
+        self.mult_shares(tmp,d,a,tape,rec,mult[1]);
+        y0[:] = tmp ^ b
+        self.mult_shares(tmp,y1,d,tape,rec,mult[2]);
+        y3[:] = tmp ^ a
+        self.mult_shares(tmp,y0,y1,tape,rec,mult[3]);
+        c[:] = tmp ^ d
+
+        a[:] = y0
+        b[:] = y1
+        d[:] = y3
+        if rec is not None:
+            for i,x in enumerate((a,b,c,d)):
+                rec.record("%s.out%d"%(name,i),x)
+
+    def _partial_sbox_layer(self,a,b,c,d,tape,refresh_flag,rec,name,mults):
+        """
+            sbox_layer_masked computing only the multiplications in mults.
+            The tape is moved to the randomness of each of them.
+        """
+        base = tape.offset
+        pos = self.mult_offsets(refresh_flag)
+        y0,y1,y2,y3 = (np.zeros(a.shape,dtype=np.uint32) for _ in range(4))
+        tmp = np.zeros(a.shape,dtype=np.uint32)
+        if rec is not None:
+            for i,x in enumerate((a,b,c,d)):
+                rec.record("%s.in%d"%(name,i),x)
+        mult = [None if rec is None else "%s.mult%d"%(name,k) for k in range(4)]
+        if 0 in mults:
+            tape.seek(base)
+            self.mult_shares(tmp,a,b,tape,rec,mult[0])
+            y1[:] = tmp ^ c
+            if refresh_flag:
+                self.refresh(y1,tape,rec,None if rec is None else name+".refresh")
+        if 1 in mults:
+            tape.seek(base+pos[1])
+            self.mult_shares(tmp,d,a,tape,rec,mult[1])
+            y0[:] = tmp ^ b
+        if 2 in mults:
+            tape.seek(base+pos[2])
+            self.mult_shares(tmp,y1,d,tape,rec,mult[2])
+            y3[:] = tmp ^ a
+        if 3 in mults:
+            tape.seek(base+pos[3])
+            self.mult_shares(tmp,y0,y1,tape,rec,mult[3])
+            y2[:] = tmp ^ d
+        a[:],b[:],c[:],d[:] = y0,y1,y2,y3
+        if rec is not None:
+            for i,x in enumerate((a,b,c,d)):
+                rec.record("%s.out%d"%(name,i),x)
+
+    def lbox_masked(self,masked_state):
+        """
+        Applies lbox to a masked clyde state. Because it is linear, it is a share-wise
+        operation applied on all the shares at once.
+        """
+        D = self.D
+        masked_state[0:D], masked_state[D:2*D] = lbox(masked_state[0:D],masked_state[D:2*D])
+        masked_state[2*D:3*D], masked_state[3*D:4*D] = lbox(masked_state[2*D:3*D],masked_state[3*D:4*D])
 
-def sbox_layer_masked(a,b,c,d,refresh_flag=0):
-    """
-        Applies inplace sbox to the inputs sharings a,b,c,d
-        if refresh_flag, a refresh is inserted after the
-        first XOR of the Sbox according to Tornado tool.
-    """
-    y0 = np.zeros(a.shape,dtype=np.uint32)
-    y1 = np.zeros(a.shape,dtype=np.uint32)
-    y3 = np.zeros(a.shape,dtype=np.uint32)
-    tmp = np.zeros(a.shape,dtype=np.uint32)
-
-    mult_shares(tmp,a,b);
-    y1[:] = tmp ^ c
-    if refresh_flag:
-        refresh(y1)
-    mult_shares(tmp,d,a);
-    y0[:] = tmp ^ b
-    mult_shares(tmp,y1,d);
-    y3[:] = tmp ^ a
-    mult_shares(tmp,y0,y1);
-    c[:] = tmp ^ d
-
-    a[:] = y0
-    b[:] = y1
-    d[:] = y3
-
-def lbox_masked(masked_state):
-    """
-    Applies lbox to a masked clyde state. Because it is linear, it is a share-wise
-    operation.
-    """
-    for i in range(D):
-        masked_state[(0*D) +i], masked_state[(1*D)+i]= lbox(masked_state[(0*D) +i],masked_state[(1*D)+i])
-        masked_state[(2*D) +i], masked_state[(3*D)+i]= lbox(masked_state[(2*D) +i],masked_state[(3*D)+i])
 def lbox(x, y):
     """
         In place Clyde lbox
@@ -234,7 +548,7 @@ if __name__ == "__main__":
     seeds = np.random.randint(0,2**32,(4,Nc),dtype=np.uint32)
     #random masked keys
     msk_key = np.random.randint(0,2**32,(4*D,Nc),dtype=np.uint32)
-    umsk_key = umask(msk_key.T)
+    umsk_key = umask(msk_key.T,D)
     #random tweak
     tweak = np.random.randint(0,2**32,(4,Nc),dtype=np.uint32)
     #random plaintext
@@ -242,4 +556,4 @@ if __name__ == "__main__":
 
     #output masked state
     msk_state = clyde128_encrypt_masked(plaintext,tweak,msk_key,seeds)
-    umsk_state = umask(msk_state)
+    umsk_state = umask(msk_state,D)
@@ -21,7 +21,9 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 
-from interface.spook import shadow,bytes2state,state2bytes
+from interface.spook import shadow,shadow_batch,bytes2state,state2bytes
+from collections import OrderedDict
+import threading
 import numpy as np
 from interface.parameters import *
 
@@ -29,52 +31,78 @@ bor = np.bitwise_or
 bxor = np.bitwise_xor
 band = np.bitwise_and
 
-def mask(k,D,PRGON=1):
+# default generator of the masks
+_rng = np.random.default_rng()
+
+def mask(k,D=D,PRGON=1,rng=None):
     """
         is used to mask a given key
 
-        k: is a byte array
+        k: is a byte array, or N keys as a (N,16) uint8 or (N,4) uint32 array
         D: is the order
         PRGON: is PRNG active
+        rng: np.random.Generator drawing the masks
+
+        output: the masked key as bytes for a byte array, a (N,4*D) uint32
+            array otherwise. Share d of word i is at index i*D+d.
     """
-    uk = np.frombuffer(k,dtype=np.uint32)
-    muk = np.zeros(len(uk)*D).astype(np.uint32)
-    for i,k in enumerate(uk):
-        acc = k
-        for d in range(D-1):
-            r = np.random.randint(0,(((2**32)-1)*PRGON)+1)
-            muk[i*D + d] = r
-            acc = np.bitwise_xor(r,acc)
-        muk[i*D + (D-1)] = acc
-    return np.ndarray.tobytes(muk)
-
-def simple_refresh(out,inp,seed):
+    as_bytes = isinstance(k,(bytes,bytearray))
+    uk = np.frombuffer(k,dtype=np.uint32) if as_bytes else np.asarray(k)
+    uk = np.ascontiguousarray(uk)
+    if uk.dtype == np.uint8:
+        uk = uk.view(np.uint32)
+    uk = uk.astype(np.uint32).reshape(-1,4)
+    if rng is None:
+        rng = _rng
+
+    muk = np.zeros((len(uk),4,D),dtype=np.uint32)
+    if PRGON:
+        muk[:,:,:D-1] = rng.integers(0,2**32,size=(len(uk),4,D-1),dtype=np.uint32)
+    muk[:,:,D-1] = uk ^ np.bitwise_xor.reduce(muk[:,:,:D-1],axis=2)
+    muk = muk.reshape(len(uk),4*D)
+    if as_bytes:
+        return muk.tobytes()
+    return muk
+
+def simple_refresh(out,inp,seed,D=D):
     """
         perform similar refresh as the one done on the MCU
 
-        out: refreshed key
-        inp: input key
-        seed: state of the PRNG
+        out: refreshed key, (4*D,) or (N,4*D) array
+        inp: input key, (4*D,) or (N,4*D) array
+        seed: state of the PRNG, (4,) or (N,4) with one seed per refreshed key.
+            If a tuple, the PRNG is already initialized (see get_random_tape).
+        D: number of shares
+
+        The PRNG words are used in the order of the firmware: the D-1 first
+        shares of word 0, then the ones of word 1, ...
     """
-    for i in range(4):
-        r = 0;
-        for d in range(0,(D-1)):
-            s,seed = get_random_tape(seed,1)
-            out[(i*D)+d] = s ^ inp[(i*D)+d]
-            r ^= s[0]
-        out[(i*D)+(D-1)] = r ^ inp[(i*D)+(D-1)]
-
-def umask(k):
+    inp = np.asarray(inp,dtype=np.uint32).reshape(-1,4,D)
+    if type(seed) is tuple:
+        n = len(seed[1][0,:])
+        r,_ = get_random_tape(seed,4*(D-1))
+    else:
+        seed = np.asarray(seed,dtype=np.uint32).reshape(-1,4)
+        n = len(seed)
+        r = random_tape(seed.T,4*(D-1))
+    r = np.asarray(r,dtype=np.uint32).reshape(4,D-1,n).transpose(2,0,1)
+    res = np.empty((max(n,len(inp)),4,D),dtype=np.uint32)
+    res[:,:,:D-1] = inp[:,:,:D-1] ^ r
+    res[:,:,D-1] = inp[:,:,D-1] ^ np.bitwise_xor.reduce(r,axis=2)
+    out[...] = res.reshape(np.shape(out))
+
+def umask(k,D=D):
     """"
         unmask N sharing
         N x (4*D) unmask N data in parallel
+
+        D: number of shares
     """
-    out = np.zeros((len(k[:,0]),4),dtype=np.uint32)
-    for i in range(4*D):
-        out[:,i//D] ^= k[:,i]
-    return out
+    k = np.asarray(k).astype(np.uint32)
+    return np.bitwise_xor.reduce(k.reshape(len(k),4,D),axis=2)
 
-MAX = 16
+# size of the PRNG table, same as in prng.c
+MAX = PRNG_MAX
 def get_random_tape(seed,l):
     """
         return the randomness from the on-board PRNG
@@ -91,16 +119,14 @@ def get_random_tape(seed,l):
         seed = np.uint32(seed)
         if isinstance(seed,np.ndarray) and seed.ndim==2:
             rng = np.zeros((l,len(seed[0,:])),dtype=np.uint32)
-            prng_state_core = [np.zeros((4,4),dtype=np.uint32) for i in range(len(seed[0,:]))]
-            for i,state in enumerate(prng_state_core):
-                state[0,:] = seed[:,i]
+            prng_state_core = np.zeros((len(seed[0,:]),4,4),dtype=np.uint32)
+            prng_state_core[:,0,:] = seed.T
             prng_tab = np.zeros((MAX,len(seed[0,:])),dtype=np.uint32)
         else:
             rng = np.zeros(l,dtype=np.uint32)
             prng_tab = np.zeros((MAX,1),dtype=np.uint32)
-            prng_state_core = [np.zeros((4,4),dtype=np.uint32) for i in range(1)]
-            for i,state in enumerate(prng_state_core):
-                state[0,:] = seed
+            prng_state_core = np.zeros((1,4,4),dtype=np.uint32)
+            prng_state_core[0,0,:] = seed
 
         prng_index = MAX
     else:
@@ -122,9 +148,127 @@ def get_random_tape(seed,l):
         rng[:] = 0
     return rng,(prng_index,prng_tab,prng_state_core)
 
+def random_tape(seed,l):
+    """
+        return the first l random words of the on-board PRNG for
+        multiple seeds at once. This is equivalent to a single call
+        to get_random_tape(seed,l) but the whole tape is derived at once.
+
+        seed: (4,Ns) matrix with each column being a PRNG seed, or a single
+            seed of 4 words.
+        l: number of random words to derive
+
+        output: (l,Ns) matrix where the i-th row is the i-th random word
+            returned by the PRNG of each seed.
+    """
+    seed = np.array(seed,dtype=np.uint32).reshape(4,-1)
+    Ns = len(seed[0,:])
+    n_perm = (l+7)//8
+    state = np.zeros((Ns,4,4),dtype=np.uint32)
+    state[:,0,:] = seed.T
+    tape = np.zeros((n_perm*8,Ns),dtype=np.uint32)
+    if PRGON==0:
+        return tape[:l]
+    for i in range(n_perm):
+        state = shadow_batch(state)
+        tape[i*8:(i+1)*8,:] = state[:,0:2,:].reshape(Ns,8).T
+    return tape[:l]
+
+class RandomTape:
+    def __init__(self,tape,offset=0):
+        """
+            Precomputed randomness (see random_tape) read sequentially
+            as the PRNG on the MCU would do it.
+
+            tape: (l,Ns) matrix of random words
+            offset: index of the next word to return
+        """
+        self.tape = tape
+        self.offset = offset
+
+    def get(self,l):
+        """
+            return the next l random words as a (l,Ns) matrix.
+        """
+        if self.offset+l > len(self.tape):
+            raise Exception("Random tape exhausted: %d words requested at offset %d, tape length %d"%(
+                l,self.offset,len(self.tape)))
+        rng = self.tape[self.offset:self.offset+l]
+        self.offset += l
+        return rng
+
+    def seek(self,offset):
+        """
+            move the tape to the word at index offset.
+        """
+        self.offset = offset
+
+class TapeCache:
+    def __init__(self,max_bytes=256*(2**20)):
+        """
+            LRU cache of the random tapes derived by random_tape. It is
+            indexed by seed such that computing multiple intermediate
+            variables on the same traces does not run Shadow again.
+
+            max_bytes: memory budget of the cached tapes. The least recently
+                used tapes are evicted once it is exceeded.
+
+            The cache can be shared by multiple threads.
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._tapes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def random_tape(self,seed,l):
+        """
+            same as random_tape(seed,l) but only derives the tapes of the
+            seeds that are not already cached with at least l words.
+        """
+        seed = np.array(seed,dtype=np.uint32).reshape(4,-1)
+        keys = [seed[:,i].tobytes() for i in range(len(seed[0,:]))]
+        tape = np.zeros((l,len(keys)),dtype=np.uint32)
+        missing = []
+        with self._lock:
+            for i,key in enumerate(keys):
+                cached = self._tapes.get(key)
+                if cached is not None and len(cached) >= l:
+                    self._tapes.move_to_end(key)
+                    tape[:,i] = cached[:l]
+                else:
+                    missing.append(i)
+
+        if len(missing) > 0:
+            tape[:,missing] = random_tape(seed[:,missing],l)
+            with self._lock:
+                for i in missing:
+                    self._store(keys[i],tape[:,i].copy())
+        return tape
+
+    def _store(self,key,tape):
+        old = self._tapes.pop(key,None)
+        if old is not None:
+            self.n_bytes -= old.nbytes
+        if tape.nbytes > self.max_bytes:
+            return
+        self._tapes[key] = tape
+        self.n_bytes += tape.nbytes
+        while self.n_bytes > self.max_bytes:
+            _,old = self._tapes.popitem(last=False)
+            self.n_bytes -= old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._tapes.clear()
+            self.n_bytes = 0
+
 def fill_table(state_all,tab_all):
+    """
+        refill the PRNG tables of all the columns at once.
+
+        state_all: (Ns,4,4) Shadow states of the Ns PRNGs, updated in place
+        tab_all: (MAX,Ns) tables to fill
+    """
     for i in range(0,MAX,8):
-        for j,state in enumerate(state_all):
-            state_all[j] = shadow(state)
-            for n in range(8):
-                tab_all[i+n,j] = state_all[j][n//4][n%4]
+        state_all[:] = shadow_batch(state_all)
+        tab_all[i:i+8,:] = state_all[:,0:2,:].reshape(-1,8).T
@@ -0,0 +1,129 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# Non-blocking readout of the scopes, with MockScope.
+
+import threading
+import numpy as np
+import pytest
+from mock_scope import MockScope
+from acquisition import BufferRing
+
+def scope(**kwargs):
+    return MockScope(n_samples=20,batch_size=4,**kwargs)
+
+def test_result_acquire_async():
+    ps = scope(capture_time=0.01)
+    ps.start_acquire()
+    fut = ps.result_acquire_async()
+    traces = fut.result()
+    assert traces.shape == (4,20) and traces.dtype == np.int16
+
+def test_dest_and_callback():
+    ps = scope()
+    dest = np.zeros((4,20),dtype=np.int16)
+    got = []
+    ps.start_acquire()
+    out = ps.result_acquire_async(dest,callback=got.append).result()
+    assert out is dest and got[0] is dest
+
+def test_bad_dest():
+    ps = scope()
+    with pytest.raises(ValueError):
+        ps.result_acquire_async(np.zeros((4,20),dtype=np.float64))
+
+def test_callback_error():
+    ps = scope()
+    def callback(traces):
+        raise RuntimeError("callback")
+    ps.start_acquire()
+    with pytest.raises(RuntimeError):
+        ps.result_acquire_async(callback=callback).result()
+
+def test_timeout():
+    ps = scope(capture_time=10)
+    ps.start_acquire()
+    with pytest.raises(TimeoutError):
+        ps.result_acquire(timeout=0.01)
+
+class CallbackScope(MockScope):
+    # the end of the capture is signaled as by the ps5000a driver
+    ready_callback = True
+
+    def runBlock(self,pretrig=0.0,segmentIndex=0,callback=None):
+        super().runBlock(pretrig)
+        threading.Timer(self.capture_time,callback,(0,0,None)).start()
+
+    def isReady(self):
+        raise AssertionError("polled with a ready callback")
+
+def test_ready_callback():
+    ps = CallbackScope(n_samples=20,batch_size=4,capture_time=0.01)
+    ps.start_acquire()
+    assert ps.result_acquire().shape == (4,20)
+
+def test_buffer_ring():
+    ps = scope()
+    ring = BufferRing.shared(2,4,20)
+    try:
+        ps.set_buffer_ring(ring)
+        out = []
+        for _ in range(3):
+            ps.start_acquire()
+            out.append(ps.result_acquire())
+        assert out[0] is ring.buffers[0] and out[1] is ring.buffers[1]
+        assert out[2] is ring.buffers[0]
+    finally:
+        ring.close(unlink=True)
+
+class RecordingScope(MockScope):
+    # keeps a copy of every batch downloaded
+    def getDataRawBulk(self,data=None,fromSegment=0,**kwargs):
+        out = super().getDataRawBulk(data,fromSegment,**kwargs)
+        self.batches.append(out[0].copy())
+        return out
+
+def test_pipeline(tmp_path):
+    from interface.SpookTopLevel import SpookTopLevel
+    from interface.loopback import LoopbackSerial
+    from interface.utils import mask,umask
+    from trace_writer import TraceWriter
+    from pipeline import CapturePipeline
+    D,batch_size,n_traces = 2,5,30
+    dev = SpookTopLevel("MCU",D=D,ser=LoopbackSerial(D))
+    m = np.zeros(1,dtype=np.uint32)
+    key = bytes(range(16))
+    dev.set_data(np.array([batch_size],dtype=np.uint32).tobytes(),"N",0)
+    dev.set_data(np.array([1],dtype=np.uint32).tobytes(),"f",0)
+    dev.set_data(bytes(16),"s",0)
+    dev.set_data(bytes(16),"npub",0)
+    dev.set_data(mask(key,D),"k",0)
+    dev.set_data(m.tobytes(),"ad",0)
+    ps = RecordingScope(n_samples=20,batch_size=batch_size,capture_time=0.001)
+    ps.batches = []
+    writer = TraceWriter(str(tmp_path/"capture"),n_traces,20,D,m,m,batch_size=batch_size)
+    CapturePipeline(dev,ps,writer,batch_size,m,depth=1).run(0,n_traces)
+    assert writer.n_done == n_traces
+    assert np.array_equal(writer.traces,np.concatenate(ps.batches))
+    assert (umask(writer.msk_keys,D) == np.frombuffer(key,dtype=np.uint32)).all()
+    assert getattr(ps,"_ring",None) is None
+    writer.close()
@@ -29,7 +29,18 @@ import os
 from SpookTopLevel import SpookTopLevel,mask,send_data_uart
 import numpy as np
 
-spookDUT = SpookTopLevel(target="MCU",PORT="/dev/ttyUSB0")
+# e.g. --baudrate=921600, see interface/serial_bench.py
+baudrate = None
+for arg in sys.argv:
+    if arg.startswith("--baudrate="):
+        baudrate = int(arg.split("=")[1])
+
+if "--loopback" in sys.argv:
+    # run the test vectors against the simulated firmware
+    from loopback import LoopbackSerial
+    spookDUT = SpookTopLevel(target="MCU",ser=LoopbackSerial(D),baudrate=baudrate)
+else:
+    spookDUT = SpookTopLevel(target="MCU",PORT="/dev/ttyUSB0",baudrate=baudrate)
 
 def test_spook_lwc(ad, m, k, n, c):
     p = k[16:]
@@ -78,3 +89,4 @@ def test_tv_file(fname):
 if __name__ == '__main__':
     spook.SMALL_PERM=False
     test_tv_file('tests/LWC_AEAD_KAT_128_128.txt')
+    spookDUT.close()
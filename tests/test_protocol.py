@@ -0,0 +1,125 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# Frames of the UART protocol, against the simulated firmware of loopback.py.
+
+import io
+import zlib
+import struct
+import pytest
+from interface.protocol import *
+from interface.loopback import LoopbackSerial
+
+def frame(records):
+    return encode_frame([encode_record(fields,op) for fields,op in records])
+
+def test_frame_roundtrip():
+    records = [([("m",b"abcd"),("ad",b"")],1),([("k",bytes(range(64)))],0),([],2)]
+    decoded = decode_frame(frame(records)[4:])
+    assert decoded == [([(dest,bytes(data)) for dest,data in fields],op) for fields,op in records]
+
+def test_frame_header():
+    data = frame([([("m",b"abcd")],1)])
+    dest,enc_flag,length = struct.unpack("<BBH",data[:4])
+    assert (dest,enc_flag,length) == (FRAME_DEST,0,len(data)-4)
+
+def test_frame_too_large():
+    with pytest.raises(ValueError):
+        frame([([("m",bytes(FRAME_MAX_LEN))],0)])
+
+def test_split_records():
+    records = [encode_record([("m",bytes(100))],1) for _ in range(30)]
+    frames = split_records(records,[100]*30)
+    assert sum(len(r) for r,_ in frames) == 30
+    for r,out in frames:
+        assert len(encode_frame(r)) <= 4+FRAME_MAX_LEN
+        assert 7+out <= FRAME_MAX_LEN
+
+def test_split_records_oversized():
+    records = [encode_record([("m",b"abcd")],1),encode_record([("m",bytes(2000))],1)]
+    with pytest.raises(ValueError):
+        split_records(records,[4,4])
+
+def test_config_roundtrip():
+    data = encode_config(921600)
+    assert struct.unpack("<BBH",data[:4]) == (CONFIG_DEST,0,4)
+    payload = struct.pack("<IHHB",921600,FRAME_MAX_LEN,256,8)
+    config = decode_config(payload)
+    assert config == {"baudrate":921600,"frame_max_len":FRAME_MAX_LEN,"max_len":256,"D":8}
+    with pytest.raises(FrameError):
+        decode_config(payload[:-1])
+
+def test_response_roundtrip():
+    assert read_response(io.BytesIO(encode_response(FRAME_OK,b"payload"))) == b"payload"
+    with pytest.raises(FrameError):
+        read_response(io.BytesIO(encode_response(FRAME_ERR_CRC)))
+
+def test_config_loopback():
+    ser = LoopbackSerial(3)
+    ser.write(encode_config(0))
+    config = decode_config(read_response(ser))
+    assert config["D"] == 3 and config["frame_max_len"] == FRAME_MAX_LEN
+
+def test_loopback_frame():
+    ser = LoopbackSerial(2)
+    ser.write(frame([([("m",b"abcd")],0)]))
+    assert read_response(ser) == b""
+
+def reply_status(ser):
+    head = ser.read(3)
+    status,length = struct.unpack("<BH",head)
+    rest = ser.read(length+4)
+    assert zlib.crc32(head+rest[:length]) == struct.unpack("<I",rest[length:])[0]
+    return status
+
+def test_crc_mismatch():
+    ser = LoopbackSerial(2)
+    data = bytearray(frame([([("m",b"abcd")],1)]))
+    data[-1] ^= 1
+    ser.write(bytes(data))
+    assert reply_status(ser) == FRAME_ERR_CRC
+
+def test_format():
+    ser = LoopbackSerial(2)
+    ser.write(encode_header(FRAME_DEST,0,0))
+    assert reply_status(ser) == FRAME_ERR_FORMAT
+    # unknown destination within a valid frame
+    body = struct.pack("<HBBBH",1,1,0,99,0)
+    ser.write(encode_header(FRAME_DEST,0,len(body)+4)+body+struct.pack("<I",zlib.crc32(body)))
+    assert reply_status(ser) == FRAME_ERR_FORMAT
+
+def test_len_drops_body():
+    ser = LoopbackSerial(2)
+    ser.write(encode_header(FRAME_DEST,0,FRAME_MAX_LEN+1)+bytes(FRAME_MAX_LEN+1))
+    assert reply_status(ser) == FRAME_ERR_LEN
+    # the link is still in sync
+    ser.write(frame([([("m",b"abcd")],0)]))
+    assert reply_status(ser) == FRAME_OK
+
+def test_busy():
+    ser = LoopbackSerial(2)
+    ser.hold()
+    for _ in range(FRAME_SLOTS+1):
+        ser.write(frame([([("m",b"abcd")],0)]))
+    assert ser.in_waiting == 0
+    ser.release()
+    assert [reply_status(ser) for _ in range(FRAME_SLOTS+1)] == [FRAME_OK]*FRAME_SLOTS+[FRAME_ERR_BUSY]
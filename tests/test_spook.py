@@ -0,0 +1,71 @@
+# MIT Licence
+#
+# Copyright 2020 UCLouvain
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# The batch and masked implementations against the scalar reference of spook.py.
+
+import numpy as np
+import pytest
+from interface import spook
+from interface.spook_masked import clyde128_encrypt_masked
+from interface.utils import mask,umask
+
+N = 20
+
+def words(rng,*shape):
+    return rng.integers(0,2**32,shape,dtype=np.uint32)
+
+def test_clyde_batch():
+    rng = np.random.default_rng(0)
+    m,t,k = words(rng,N,4),words(rng,N,4),words(rng,N,4)
+    c = spook.clyde_encrypt_batch(m,t,k)
+    for i in range(N):
+        assert list(c[i]) == spook.clyde_encrypt(list(m[i]),list(t[i]),list(k[i]))
+    assert np.array_equal(spook.clyde_decrypt_batch(c,t,k),m)
+
+def test_clyde_batch_single_block():
+    rng = np.random.default_rng(1)
+    m,t,k = words(rng,4),words(rng,4),words(rng,4)
+    c,rounds = spook.clyde_encrypt_batch(m,t,k,rounds=True)
+    assert c.shape == (4,) and rounds.shape == (2*spook.N_STEPS,4)
+    assert list(c) == spook.clyde_encrypt(list(m),list(t),list(k))
+    # a single key and tweak broadcast over the blocks
+    ms = words(rng,N,4)
+    assert np.array_equal(spook.clyde_encrypt_batch(ms,t,k)[3],spook.clyde_encrypt_batch(ms[3],t,k))
+
+def test_shadow_batch():
+    rng = np.random.default_rng(2)
+    L = 3 if spook.SMALL_PERM else 4
+    x = words(rng,N,L,4)
+    y = spook.shadow_batch(x)
+    for i in range(N):
+        assert y[i].tolist() == spook.shadow([list(r) for r in x[i]])
+
+@pytest.mark.parametrize("D",[2,3,4,8])
+def test_clyde_masked(D):
+    rng = np.random.default_rng(D)
+    m,t,k,seeds = words(rng,N,4),words(rng,N,4),words(rng,N,4),words(rng,N,4)
+    msk_keys = mask(k,D,rng=rng)
+    c = clyde128_encrypt_masked(m.T,t.T,msk_keys.T,seeds.T,D=D)
+    assert c.shape == (N,4*D)
+    assert np.array_equal(umask(c,D),spook.clyde_encrypt_batch(m,t,k))
+    for i in range(N):
+        assert list(umask(c,D)[i]) == spook.clyde_encrypt(list(m[i]),list(t[i]),list(k[i]))